@@ -0,0 +1,107 @@
+import numpy as np
+import sys
+
+from collections import OrderedDict
+
+# rough per-entry cost of the OrderedDict slot, the cost float and the entry tuple
+ENTRY_OVERHEAD_BYTES = 200
+
+
+class DACache(object):
+    # LRU cache in front of a DeferredAcceptance instance, keyed by the capacity vector. It exposes the same
+    # run/run_from interface, and every other attribute (s, c, arange_c, ...) is forwarded to the wrapped instance.
+    # Matchings are kept as compact integer arrays when store_matches is set (otherwise a hit returns None in their
+    # place); entries are evicted in least recently used order once their estimated size exceeds max_bytes.
+    def __init__(self, da, max_bytes=2 ** 28, store_matches=True):
+        self.da = da
+        self.max_bytes = max_bytes
+        self.store_matches = store_matches
+        self.match_dtype = np.int16 if da.c <= np.iinfo(np.int16).max else np.int32
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getattr__(self, name):
+        if name == 'da':
+            raise AttributeError(name)
+        return getattr(self.da, name)
+
+    def run(self, college_capacities):
+        key = tuple(int(q) for q in college_capacities)
+        entry = self._lookup(key)
+        if entry is not None:
+            return self._to_result(entry)
+        matches_for_students, _, total_cost = self.da.run(college_capacities)
+        self._store(key, matches_for_students, total_cost)
+        return matches_for_students, None, total_cost
+
+    def run_from(self, base_state, new_capacities):
+        # on a hit no DAState is rebuilt, so the second element of the result is None
+        key = tuple(int(q) for q in new_capacities)
+        entry = self._lookup(key)
+        if entry is not None:
+            return self._to_result(entry)
+        matches_for_students, state, total_cost = self.da.run_from(base_state, new_capacities)
+        self._store(key, matches_for_students, total_cost)
+        return matches_for_students, state, total_cost
+
+    def run_batch(self, capacity_matrix, return_matches=False, base_state=None):
+        # only the vectors missing from the cache are passed on, in a single batch; a vector repeated in the batch is
+        # looked up once and its repeats count as hits, so that misses stays the number of DA runs
+        keys = [tuple(int(q) for q in capacities) for capacities in capacity_matrix]
+        found = {key: self._lookup(key) for key in dict.fromkeys(keys)}
+        self.hits += len(keys) - len(found)
+        missing = [key for key, entry in found.items() if entry is None]
+        if len(missing) > 0:
+            matches, total_costs = self.da.run_batch(missing, return_matches=True, base_state=base_state)
+            evaluated = {}
+            for key, matches_for_students, total_cost in zip(missing, matches, total_costs):
+                self._store(key, matches_for_students, total_cost)
+                evaluated[key] = (matches_for_students, total_cost)
+        results = [self._to_result(found[key]) if found[key] is not None
+                   else (evaluated[key][0], None, evaluated[key][1]) for key in keys]
+        total_costs = [result[2] for result in results]
+        if return_matches:
+            return [result[0] for result in results], total_costs
+        return total_costs
+
+    def invalidate(self, unaffected):
+        # drops the entries whose matching unaffected(matches) rejects, e.g. after DeferredAcceptance.update, and all
+        # entries stored without their matching; returns the number of entries dropped
+        dropped = [key for key, (matches, _, _) in self.entries.items() if matches is None or not unaffected(matches)]
+        for key in dropped:
+            self.num_bytes -= self.entries.pop(key)[2]
+        return len(dropped)
+
+    def hit_rate(self):
+        num_lookups = self.hits + self.misses
+        return self.hits / num_lookups if num_lookups > 0 else 0.0
+
+    def _lookup(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return entry
+
+    def _to_result(self, entry):
+        matches, total_cost, _ = entry
+        return (matches.tolist() if matches is not None else None), None, total_cost
+
+    def _store(self, key, matches_for_students, total_cost):
+        matches = np.array(matches_for_students, dtype=self.match_dtype) if self.store_matches else None
+        num_bytes = sys.getsizeof(key) + ENTRY_OVERHEAD_BYTES + (matches.nbytes if matches is not None else 0)
+        if num_bytes > self.max_bytes:
+            return
+        if key in self.entries:
+            self.num_bytes -= self.entries.pop(key)[2]
+        self.entries[key] = (matches, total_cost, num_bytes)
+        self.num_bytes += num_bytes
+        while self.num_bytes > self.max_bytes:
+            _, (_, _, evicted_bytes) = self.entries.popitem(last=False)
+            self.num_bytes -= evicted_bytes
+            self.evictions += 1
@@ -0,0 +1,67 @@
+import multiprocessing
+import numpy as np
+import os
+import time
+
+from ca_algs.shared_da import SharedDA
+
+_worker_da = None
+_worker_state = None
+
+
+def _init_worker(shared, base_capacities):
+    global _worker_da, _worker_state
+    _worker_da = shared.attach()
+    _worker_state = _worker_da.run_from(None, base_capacities)[1] if base_capacities is not None else None
+
+
+def _evaluate(capacity_matrix, return_matches):
+    st_time = time.time()
+    matches, total_costs = _worker_da.run_batch(capacity_matrix, return_matches=True, base_state=_worker_state)
+    return os.getpid(), matches if return_matches else None, total_costs, time.time() - st_time
+
+
+class DAPool(object):
+    # Evaluates batches of capacity vectors on a pool of worker processes. The arrays of the DeferredAcceptance
+    # instance are published once in shared memory for the workers to attach to (see SharedDA), and, when
+    # base_capacities is given, every worker builds the DAState of those capacities once so that it can repair it for
+    # every vector (see DeferredAcceptance.run_from). The base_state argument of run_batch is therefore ignored.
+    # Other attributes are forwarded to the local instance.
+    def __init__(self, da, num_workers, base_capacities=None):
+        self.da = da
+        self.num_workers = num_workers
+        self.shared = SharedDA(da)
+        self.pool = multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                         initargs=(self.shared, base_capacities))
+        self.worker_evaluations = {}
+        self.worker_time = {}
+
+    def __getattr__(self, name):
+        if name == 'da':
+            raise AttributeError(name)
+        return getattr(self.da, name)
+
+    def run(self, college_capacities):
+        matches, total_costs = self.run_batch([college_capacities], return_matches=True)
+        return matches[0], None, total_costs[0]
+
+    def run_batch(self, capacity_matrix, return_matches=False, base_state=None):
+        chunks = [chunk.tolist() for chunk in np.array_split(np.array(capacity_matrix, dtype=int), self.num_workers)
+                  if len(chunk) > 0]
+        results = self.pool.starmap(_evaluate, [(chunk, return_matches) for chunk in chunks])
+        matches = []
+        total_costs = []
+        for chunk, (pid, chunk_matches, chunk_costs, elapsed) in zip(chunks, results):
+            self.worker_evaluations[pid] = self.worker_evaluations.get(pid, 0) + len(chunk)
+            self.worker_time[pid] = self.worker_time.get(pid, 0.0) + elapsed
+            if return_matches:
+                matches.extend(chunk_matches)
+            total_costs.extend(chunk_costs)
+        if return_matches:
+            return matches, total_costs
+        return total_costs
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.shared.close()
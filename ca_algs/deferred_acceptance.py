@@ -1,24 +1,158 @@
+import heapq
 import numpy as np
 import time
 
 
+class DAState(object):
+    # Stable matching for one capacity vector together with the bookkeeping DeferredAcceptance.run_from needs to
+    # resume from it: the students held by every college (and by the sentinel, see DeferredAcceptance._slots) as
+    # min-heaps of (score, student). Derived states share the per-college heaps with their base and copy a heap only
+    # before modifying it.
+    def __init__(self, capacities, s_track, matches, counts, held):
+        self.capacities = capacities
+        self.s_track = s_track
+        self.matches = matches
+        self.counts = counts
+        self.held = held
+        self._owned = set(range(len(capacities)))
+
+    def copy(self):
+        state = DAState(list(self.capacities), list(self.s_track), list(self.matches), list(self.counts),
+                        list(self.held))
+        state._owned = set()
+        return state
+
+    def own(self, j):
+        if j not in self._owned:
+            self.held[j] = list(self.held[j])
+            self._owned.add(j)
+
+    @property
+    def total_cost(self):
+        # s_track[i] is the rank of the college student i is matched with
+        return float(sum(self.s_track))
+
+
 class DeferredAcceptance(object):
-    def __init__(self, student_prefs, college_prefs):
-        self.s, self.c = np.shape(student_prefs)
-        self.s_rank = np.array(student_prefs)
-        self.s_costs = np.argsort(np.array(student_prefs), axis=1)
-        self.c_scores = self.s - np.argsort(np.array(college_prefs).T, axis=0)
+    # arrays from_arrays takes, which SharedDA and the instance cache store
+    ARRAYS = ['s_rank', 's_costs', 'c_scores']
+
+    def __init__(self, student_prefs, college_prefs, backend='matrix'):
+        s_rank = np.array(student_prefs)
+        s_costs = np.argsort(s_rank, axis=1)
+        c_scores = len(s_rank) - np.argsort(np.array(college_prefs).T, axis=0)
+        self._setup(s_rank, s_costs, c_scores, backend)
+
+    @classmethod
+    def from_arrays(cls, s_rank, s_costs, c_scores, backend='matrix'):
+        # Instance around the arrays an earlier instance computed from the preference lists, e.g. views onto shared
+        # memory (see ca_algs.shared_da); they are used as they are, in whatever integer dtype they come in.
+        da = cls.__new__(cls)
+        da._setup(s_rank, s_costs, c_scores, backend)
+        return da
+
+    def _setup(self, s_rank, s_costs, c_scores, backend):
+        if backend not in ['matrix', 'queue']:
+            raise ValueError('unknown backend: {}'.format(backend))
+        self.backend = backend
+        self.s, self.c = np.shape(s_rank)
+        self.s_rank = s_rank
+        self.s_costs = s_costs
+        self.c_scores = c_scores
 
         self.arange_s = np.arange(self.s)
         self.arange_c = np.arange(self.c)
+        # work done so far, for profiling (see ce_algs.profiler): the proposal rounds of the matrix backend and the
+        # single proposals of the queue backend and of run_from
+        self.rounds = 0
+        self.proposals = 0
+
+        # plain lists for the queue backend, whose inner loop touches one element at a time
+        self._s_rank_list = None
+        self._s_scores_list = None
+        if backend == 'queue':
+            self._prepare_lists()
+
+    def _prepare_lists(self):
+        # _s_rank_list[i][k] is the k-th college of student i and _s_scores_list[i][k] the score of student i there
+        if self._s_rank_list is None:
+            self._s_rank_list = self.s_rank.tolist()
+            self._s_scores_list = np.take_along_axis(self.c_scores, self.s_rank, axis=1).tolist()
+
+    def _slots(self, college_capacities):
+        # Seats of every college, followed by the unlimited seats of the sentinel -1 that truncated lists end with
+        # (see TruncatedDeferredAcceptance), so that index -1 of the per-college lists refers to them.
+        return [min(int(q), self.s) for q in college_capacities] + [self.s]
+
+    def _proposals(self, s_track):
+        # colleges the students propose to at positions s_track of their lists, and their scores there
+        proposals = self.s_rank[self.arange_s, s_track]
+        return proposals, self.c_scores[self.arange_s, proposals]
+
+    def applications(self):
+        # student, college, rank of the college in the list of the student and score of the student at the college
+        # of every application, i.e. of every college on the list of a student, ordered by student and rank
+        students = np.repeat(self.arange_s, self.c)
+        colleges = np.asarray(self.s_rank, dtype=int).ravel()
+        return students, colleges, np.tile(self.arange_c, self.s), np.asarray(self.c_scores)[students, colleges]
+
+    def rank_tables(self):
+        # ranks_by_students[i] maps every college on the list of student i to its rank there, and ranks_by_colleges[j]
+        # every student who lists college j to their rank in the list of college j, both in increasing index order
+        return ([dict(enumerate(ranks)) for ranks in np.asarray(self.s_costs).tolist()],
+                [dict(enumerate(ranks)) for ranks in (self.s - np.asarray(self.c_scores, dtype=int)).T.tolist()])
+
+    def update(self, student_prefs=None, college_prefs=None):
+        # Replaces the lists of some students and colleges, given as dicts {index: new list}, in place; read-only
+        # arrays, e.g. memory-mapped ones, are copied first. Returns unaffected(matches_for_students), which tells
+        # whether a matching DA found before the update is still the one it finds (and so has the same cost): it is
+        # when every changed student lists the same colleges down to theirs, and every changed college orders the
+        # students who proposed to it as before, since DA can then make the same proposals with the same outcomes.
+        student_prefs = student_prefs or {}
+        college_prefs = college_prefs or {}
+        old_rows = {i: np.array(self.s_rank[i]) for i in student_prefs}
+        old_scores = {j: np.array(self.c_scores[:, j], dtype=int) for j in college_prefs}
+        for name in self.ARRAYS:
+            if not getattr(self, name).flags.writeable:
+                setattr(self, name, np.array(getattr(self, name)))
+        for i, prefs in student_prefs.items():
+            self.s_rank[i] = prefs
+            self.s_costs[i] = np.argsort(prefs)
+        for j, prefs in college_prefs.items():
+            self.c_scores[:, j] = self.s - np.argsort(prefs)
+        self._s_rank_list = None
+        self._s_scores_list = None
+        if self.backend == 'queue':
+            self._prepare_lists()
+
+        def unaffected(matches_for_students):
+            matches = np.asarray(matches_for_students)
+            for i, old_row in old_rows.items():
+                rank = int(np.flatnonzero(old_row == matches[i])[0])
+                if (self.s_rank[i, :rank + 1] != old_row[:rank + 1]).any():
+                    return False
+            match_costs = self.s_costs[self.arange_s, matches]
+            for j, scores in old_scores.items():
+                proposers = np.flatnonzero(self.s_costs[:, j] <= match_costs)
+                new_scores = np.asarray(self.c_scores[proposers, j], dtype=int)[np.argsort(scores[proposers])]
+                if (np.diff(new_scores) <= 0).any():
+                    return False
+            return True
+        return unaffected
 
     def run(self, college_capacities):
+        if self.backend == 'queue':
+            return self._run_queue(college_capacities)
+        return self._run_matrix(college_capacities)
+
+    def _run_matrix(self, college_capacities):
         slots = np.array(college_capacities)
         slots[slots > self.s] = self.s
         s_track = np.zeros(self.s, dtype=int)
         rejected = np.ones(self.s, dtype=int)
         proposals = None
         while np.sum(rejected) > 0:
+            self.rounds += 1
             proposals = self.s_rank[self.arange_s, s_track]
 
             receptions = np.zeros((self.s, self.c))
@@ -34,6 +168,421 @@ class DeferredAcceptance(object):
         total_cost = np.sum(self.s_costs[self.arange_s, proposals])
         return matches_for_students, None, float(total_cost)
 
+    def envied_colleges(self, matches_for_students):
+        # Boolean mask of the colleges some student prefers to the college they are matched with. A college no
+        # student envies rejected nobody, so an extra seat there leaves the matching unchanged; and since extra seats
+        # only make students weakly better off, it stays unenvied under any larger capacity vector.
+        match_costs = self.s_costs[self.arange_s, np.array(matches_for_students)]
+        return (self.s_costs < match_costs[:, None]).any(axis=0)
+
+    def run_batch(self, capacity_matrix, return_matches=False, base_state=None):
+        # Evaluate K capacity vectors at once and return their K total costs, preceded by their matchings if
+        # return_matches is set. With the matrix backend the K proposal processes advance together in stacked
+        # (K, s, c) arrays; with base_state every vector is repaired from that state instead (see run_from), which is
+        # much cheaper when all of them lie under one ceiling.
+        if base_state is not None:
+            results = [self.run_from(base_state, q) for q in capacity_matrix]
+            matches, total_costs = [r[0] for r in results], [r[2] for r in results]
+        elif self.backend == 'queue':
+            results = [self._run_queue(q) for q in capacity_matrix]
+            matches, total_costs = [r[0] for r in results], [r[2] for r in results]
+        else:
+            matches, total_costs = self._run_matrix_batch(capacity_matrix)
+        if return_matches:
+            return matches, total_costs
+        return total_costs
+
+    def _run_matrix_batch(self, capacity_matrix):
+        # Same rounds as _run_matrix, but instead of sorting a dense (s, c) score matrix per vector, the proposals
+        # of every vector are sorted once by (college, score) and a student is rejected when its rank within its
+        # college's group reaches that college's capacity.
+        # The last column holds the seats of the sentinel -1 (see _slots); its proposals sort before all others.
+        capacity_matrix = np.array(capacity_matrix, dtype=int).reshape(-1, self.c)
+        slots = np.full((len(capacity_matrix), self.c + 1), self.s)
+        slots[:, :self.c] = np.minimum(capacity_matrix, self.s)
+        s_track = np.zeros((len(slots), self.s), dtype=int)
+        active = np.arange(len(slots))
+        while len(active) > 0:
+            self.rounds += 1
+            proposals, prop_scores = self._proposals(s_track[active])
+
+            order = np.argsort(proposals.astype(int) * (self.s + 1) + (self.s - prop_scores), axis=1)
+            sorted_proposals = np.take_along_axis(proposals, order, axis=1)
+            group_starts = np.ones(sorted_proposals.shape, dtype=bool)
+            group_starts[:, 1:] = sorted_proposals[:, 1:] != sorted_proposals[:, :-1]
+            first_positions = np.maximum.accumulate(np.where(group_starts, self.arange_s, 0), axis=1)
+            sorted_rejected = self.arange_s - first_positions >= slots[active[:, None], sorted_proposals]
+            rejected = np.empty(proposals.shape, dtype=bool)
+            np.put_along_axis(rejected, order, sorted_rejected, axis=1)
+
+            s_track[active] += rejected
+            active = active[rejected.any(axis=1)]
+        # the cost of a student is the rank of their college, i.e. their position in their list
+        proposals, _ = self._proposals(s_track)
+        total_costs = np.sum(s_track, axis=1)
+        return proposals.tolist(), [float(total_cost) for total_cost in total_costs]
+
+    def _run_queue(self, college_capacities):
+        # Sequential (McVitie-Wilson) student-proposing DA. Each college keeps its tentatively accepted students
+        # in a min-heap of (score, student) bounded by its capacity, so every proposal costs O(log capacity).
+        # The outcome is the student-optimal stable matching, i.e. the same one the matrix backend finds.
+        # Capacities are assumed to be positive.
+        s_rank = self._s_rank_list
+        s_scores = self._s_scores_list
+        slots = self._slots(college_capacities)
+        held = [[] for _ in slots]
+        s_track = [0] * self.s
+        free = list(range(self.s - 1, -1, -1))
+        while free:
+            i = free.pop()
+            j = s_rank[i][s_track[i]]
+            score = s_scores[i][s_track[i]]
+            heap = held[j]
+            if len(heap) < slots[j]:
+                heapq.heappush(heap, (score, i))
+            elif heap and heap[0][0] < score:
+                _, k = heapq.heapreplace(heap, (score, i))
+                s_track[k] += 1
+                free.append(k)
+            else:
+                s_track[i] += 1
+                free.append(i)
+        matches_for_students = [s_rank[i][s_track[i]] for i in range(self.s)]
+        total_cost = sum(s_track)
+        # every student proposes once more than they are rejected
+        self.proposals += self.s + total_cost
+        return matches_for_students, None, float(total_cost)
+
+    def run_from(self, base_state, new_capacities):
+        # Resident-optimal stable matching for `new_capacities`, obtained by repairing the stable matching stored in
+        # `base_state` (a DAState returned by an earlier run_from call) instead of running DA from scratch.
+        # Every seat removed from a college rejects its worst held student, who continues proposing down their list,
+        # so the work is proportional to the rejection chains the removed seats trigger. Added seats cannot be
+        # repaired this way (undoing a rejection can undo a whole cascade of later ones), so the base state should
+        # dominate the capacities to evaluate, e.g. the current capacities plus the remaining budget; if any
+        # college gains seats, DA is rerun from scratch.
+        # Pass base_state=None to compute the state from scratch. Returns (matches_for_students, state, total_cost).
+        self._prepare_lists()
+        slots = self._slots(new_capacities)
+        if base_state is None or any(q > p for q, p in zip(slots, base_state.capacities)):
+            state = DAState(slots, [0] * self.s, [-1] * self.s, [0] * len(slots), [[] for _ in slots])
+            self.proposals += self.s
+            self._propose(state, list(range(self.s - 1, -1, -1)))
+        else:
+            state = base_state.copy()
+            # every proposal of a repair follows a rejection, which moves a student one position down their list
+            self.proposals -= int(base_state.total_cost)
+            free = []
+            for j in range(self.c):
+                if slots[j] < state.capacities[j]:
+                    state.capacities[j] = slots[j]
+                    state.own(j)
+                    while state.counts[j] > slots[j]:
+                        free.append(self._reject_worst(state, j))
+            self._propose(state, free)
+        total_cost = state.total_cost
+        self.proposals += int(total_cost)
+        return list(state.matches), state, total_cost
+
+    def _reject_worst(self, state, j):
+        _, i = heapq.heappop(state.held[j])
+        state.matches[i] = -1
+        state.counts[j] -= 1
+        state.s_track[i] += 1
+        return i
+
+    def _propose(self, state, free):
+        s_rank = self._s_rank_list
+        s_scores = self._s_scores_list
+        matches = state.matches
+        s_track = state.s_track
+        counts = state.counts
+        while free:
+            i = free.pop()
+            j = s_rank[i][s_track[i]]
+            score = s_scores[i][s_track[i]]
+            state.own(j)
+            heap = state.held[j]
+            if counts[j] < state.capacities[j]:
+                heapq.heappush(heap, (score, i))
+                matches[i] = j
+                counts[j] += 1
+                continue
+            if heap and heap[0][0] < score:
+                free.append(self._reject_worst(state, j))
+                heapq.heappush(heap, (score, i))
+                matches[i] = j
+                counts[j] += 1
+            else:
+                s_track[i] += 1
+                free.append(i)
+
+
+class TruncatedDeferredAcceptance(DeferredAcceptance):
+    # DeferredAcceptance for truncated preference lists, where every student lists only the colleges they apply to
+    # and every college needs to rank only its applicants. Both sides are given as CSR pairs (offsets, indices): the
+    # list of student i is indices[offsets[i]:offsets[i + 1]] (see csr_from_lists). Student lists are stored the same
+    # way, each followed by the sentinel -1 with unlimited seats, together with the score of every application, so
+    # that memory and the work of a DA round grow with the number of applications rather than with s * c.
+    # A student rejected by every college they list stays unmatched: their match is -1 and their cost the length of
+    # their list, as if the sentinel were ranked right after it.
+    ARRAYS = ['offsets', 'colleges', 'scores']
+
+    def __init__(self, student_prefs, college_prefs, backend='matrix'):
+        student_offsets, student_colleges = (np.asarray(indices) for indices in student_prefs)
+        college_offsets, college_students = (np.asarray(indices) for indices in college_prefs)
+        num_students = len(student_offsets) - 1
+        num_colleges = len(college_offsets) - 1
+        lengths = np.diff(student_offsets)
+        # the score of student i at college j is num_students minus the rank of i in the list of j, as with full lists
+        applications = np.repeat(np.arange(num_students), lengths) + student_colleges.astype(np.int64) * num_students
+        college_lengths = np.diff(college_offsets)
+        ranked = np.repeat(np.arange(num_colleges), college_lengths) * num_students + college_students
+        ranks = np.arange(len(college_students)) - np.repeat(college_offsets[:-1], college_lengths)
+        order = np.argsort(ranked)
+        found = np.searchsorted(ranked[order], applications)
+        if (found == len(ranked)).any() or (ranked[order][found] != applications).any():
+            raise ValueError('some students apply to colleges that do not rank them')
+        scores = num_students - ranks[order][found]
+        # one sentinel behind every list
+        offsets = student_offsets + np.arange(num_students + 1)
+        colleges = np.insert(student_colleges, student_offsets[1:], -1)
+        scores = np.insert(scores, student_offsets[1:], 0)
+        self._setup(offsets, colleges, scores, num_colleges, backend)
+
+    @classmethod
+    def from_arrays(cls, offsets, colleges, scores, num_colleges, backend='matrix'):
+        da = cls.__new__(cls)
+        da._setup(offsets, colleges, scores, num_colleges, backend)
+        return da
+
+    def _setup(self, offsets, colleges, scores, num_colleges, backend):
+        if backend not in ['matrix', 'queue']:
+            raise ValueError('unknown backend: {}'.format(backend))
+        self.backend = backend
+        self.s = len(offsets) - 1
+        self.c = num_colleges
+        self.offsets = offsets
+        self.colleges = colleges
+        self.scores = scores
+
+        self.arange_s = np.arange(self.s)
+        self.arange_c = np.arange(self.c)
+        # work done so far, for profiling (see ce_algs.profiler): the proposal rounds of the matrix backend and the
+        # single proposals of the queue backend and of run_from
+        self.rounds = 0
+        self.proposals = 0
+
+        self._s_rank_list = None
+        self._s_scores_list = None
+        if backend == 'queue':
+            self._prepare_lists()
+
+    def _prepare_lists(self):
+        if self._s_rank_list is None:
+            bounds = np.asarray(self.offsets).tolist()
+            colleges = np.asarray(self.colleges).tolist()
+            scores = np.asarray(self.scores).tolist()
+            self._s_rank_list = [colleges[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+            self._s_scores_list = [scores[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    def _proposals(self, s_track):
+        positions = self.offsets[:-1] + s_track
+        return self.colleges[positions], self.scores[positions]
+
+    def _run_matrix(self, college_capacities):
+        # the dense rounds of the base class would materialize (s, c) matrices
+        matches, total_costs = self._run_matrix_batch([college_capacities])
+        return matches[0], None, total_costs[0]
+
+    def _students(self):
+        # the student of every entry of colleges, and the position of the entry in their list
+        students = np.repeat(self.arange_s, np.diff(self.offsets))
+        return students, np.arange(len(students)) - np.asarray(self.offsets)[students]
+
+    def envied_colleges(self, matches_for_students):
+        students, positions = self._students()
+        is_match = self.colleges == np.asarray(matches_for_students)[students]
+        envied = np.zeros(self.c, dtype=bool)
+        envied[self.colleges[positions < positions[is_match][students]]] = True
+        return envied
+
+    def applications(self):
+        students, positions = self._students()
+        listed = np.asarray(self.colleges) >= 0
+        return students[listed], np.asarray(self.colleges, dtype=int)[listed], positions[listed], \
+            np.asarray(self.scores)[listed]
+
+    def rank_tables(self):
+        students, colleges, positions, scores = self.applications()
+        ranks = self.s - scores.astype(int)
+        ranks_by_students = [{} for _ in range(self.s)]
+        for i, j, rank in zip(*(a[np.lexsort((colleges, students))].tolist() for a in [students, colleges, positions])):
+            ranks_by_students[i][j] = rank
+        ranks_by_colleges = [{} for _ in range(self.c)]
+        for i, j, rank in zip(*(a[np.lexsort((students, colleges))].tolist() for a in [students, colleges, ranks])):
+            ranks_by_colleges[j][i] = rank
+        return ranks_by_students, ranks_by_colleges
+
+
+def csr_from_lists(lists):
+    # (offsets, indices) arrays of a list of lists of possibly different lengths
+    offsets = np.zeros(len(lists) + 1, dtype=int)
+    offsets[1:] = np.cumsum([len(indices) for indices in lists])
+    indices = np.fromiter((index for indices in lists for index in indices), dtype=int, count=offsets[-1])
+    return offsets, indices
+
+
+def lists_from_csr(offsets, indices):
+    bounds = np.asarray(offsets).tolist()
+    indices = np.asarray(indices).tolist()
+    return [indices[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def is_truncated(student_prefs, num_colleges):
+    return any(len(prefs) != num_colleges for prefs in student_prefs)
+
+
+def make_deferred_acceptance(student_prefs, college_prefs, da_arrays=None, backend='matrix'):
+    # DeferredAcceptance, or TruncatedDeferredAcceptance if some student does not rank every college, for the
+    # preference lists the algorithms take, built around da_arrays (the arrays its ARRAYS lists) when given
+    num_colleges = len(college_prefs)
+    if not is_truncated(student_prefs, num_colleges):
+        if da_arrays is None:
+            return DeferredAcceptance(student_prefs, college_prefs, backend)
+        return DeferredAcceptance.from_arrays(*da_arrays, backend=backend)
+    if da_arrays is None:
+        return TruncatedDeferredAcceptance(csr_from_lists(student_prefs), csr_from_lists(college_prefs), backend)
+    return TruncatedDeferredAcceptance.from_arrays(*da_arrays, num_colleges=num_colleges, backend=backend)
+
+
+def check_backend_parity(num_instances=20, seed=0):
+    rng = np.random.RandomState(seed)
+    for _ in range(num_instances):
+        num_students = rng.randint(2, 300)
+        num_colleges = rng.randint(1, 20)
+        correlation = rng.random()
+        mixed_scores = (correlation * rng.random(num_colleges)
+                        + (1 - correlation) * rng.random((num_students, num_colleges)))
+        student_prefs = np.argsort(mixed_scores).tolist()
+        college_prefs = [rng.permutation(num_students).tolist() for _ in range(num_colleges)]
+        college_capacities = (rng.multinomial(num_students, np.ones(num_colleges) / num_colleges) + 1).tolist()
+        expected = DeferredAcceptance(student_prefs, college_prefs, backend='matrix').run(college_capacities)
+        actual = DeferredAcceptance(student_prefs, college_prefs, backend='queue').run(college_capacities)
+        assert expected == actual, 'backends disagree on capacities {}'.format(college_capacities)
+        capacity_matrix = [college_capacities] + [
+            (np.array(college_capacities) + rng.randint(0, 3, num_colleges)).tolist() for _ in range(3)]
+        da = DeferredAcceptance(student_prefs, college_prefs)
+        expected = [da.run(q) for q in capacity_matrix]
+        matches, total_costs = da.run_batch(capacity_matrix, return_matches=True)
+        assert [(m, None, cost) for m, cost in zip(matches, total_costs)] == expected, 'run_batch disagrees with run'
+
+
+def check_run_from_parity(num_instances=20, seed=0):
+    rng = np.random.RandomState(seed)
+    for _ in range(num_instances):
+        num_students = rng.randint(2, 300)
+        num_colleges = rng.randint(1, 20)
+        student_prefs = [rng.permutation(num_colleges).tolist() for _ in range(num_students)]
+        college_prefs = [rng.permutation(num_students).tolist() for _ in range(num_colleges)]
+        college_capacities = rng.multinomial(num_students, np.ones(num_colleges) / num_colleges) + 1
+        da = DeferredAcceptance(student_prefs, college_prefs)
+        _, base_state, _ = da.run_from(None, college_capacities + rng.randint(0, 4, num_colleges))
+        for new_capacities in [college_capacities, college_capacities + rng.randint(0, 2, num_colleges)]:
+            matches_for_students, _, total_cost = da.run_from(base_state, new_capacities)
+            expected = da.run(new_capacities)
+            assert (matches_for_students, None, total_cost) == expected, \
+                'run_from disagrees with run on capacities {}'.format(new_capacities)
+
+
+def check_envied_colleges(num_instances=20, seed=0):
+    rng = np.random.RandomState(seed)
+    for _ in range(num_instances):
+        num_students = rng.randint(2, 300)
+        num_colleges = rng.randint(1, 20)
+        correlation = rng.random()
+        mixed_scores = (correlation * rng.random(num_colleges)
+                        + (1 - correlation) * rng.random((num_students, num_colleges)))
+        student_prefs = np.argsort(mixed_scores).tolist()
+        college_prefs = [rng.permutation(num_students).tolist() for _ in range(num_colleges)]
+        college_capacities = rng.multinomial(num_students, np.ones(num_colleges) / num_colleges) + 1
+        da = DeferredAcceptance(student_prefs, college_prefs)
+        matches_for_students, _, total_cost = da.run(college_capacities)
+        envied = da.envied_colleges(matches_for_students)
+        for j in np.flatnonzero(~envied):
+            new_capacities = college_capacities + rng.randint(0, 2, num_colleges)
+            new_capacities[j] += 1
+            without_seat = new_capacities.copy()
+            without_seat[j] -= 1
+            assert da.run(new_capacities) == da.run(without_seat), \
+                'an extra seat at unenvied college {} changed the matching'.format(j)
+
+
+def check_truncated_parity(num_instances=20, seed=0):
+    # a truncated instance matches like the full instance that ranks an extra college with a seat for every student
+    # right after each truncated list, where being matched with that college means being unmatched
+    rng = np.random.RandomState(seed)
+    for _ in range(num_instances):
+        num_students = rng.randint(2, 300)
+        num_colleges = rng.randint(1, 20)
+        student_prefs = [rng.permutation(num_colleges)[:rng.randint(0, num_colleges + 1)].tolist()
+                         for _ in range(num_students)]
+        college_prefs = [rng.permutation(num_students).tolist() for _ in range(num_colleges)]
+        applicants = [[i for i in prefs if j in student_prefs[i]] for j, prefs in enumerate(college_prefs)]
+        college_capacities = rng.multinomial(num_students // 2, np.ones(num_colleges) / num_colleges) + 1
+        full_student_prefs = [prefs + [num_colleges] + [j for j in range(num_colleges) if j not in prefs]
+                              for prefs in student_prefs]
+        full_college_prefs = college_prefs + [list(range(num_students))]
+        full = DeferredAcceptance(full_student_prefs, full_college_prefs)
+        truncated = make_deferred_acceptance(student_prefs, applicants)
+        queue = make_deferred_acceptance(student_prefs, college_prefs, backend='queue')
+        capacity_matrix = [college_capacities + rng.randint(0, 3, num_colleges) for _ in range(4)]
+        _, base_state, _ = truncated.run_from(None, np.max(capacity_matrix, axis=0))
+        for q in capacity_matrix:
+            matches, _, total_cost = full.run(q.tolist() + [num_students])
+            expected = ([-1 if j == num_colleges else j for j in matches], None, total_cost)
+            assert truncated.run(q) == expected, 'truncated run disagrees on capacities {}'.format(q)
+            assert queue.run(q) == expected, 'truncated queue run disagrees on capacities {}'.format(q)
+            assert truncated.run_from(base_state, q)[::2] == expected[::2], 'truncated run_from disagrees'
+            assert (truncated.envied_colleges(expected[0]) == full.envied_colleges(matches)[:num_colleges]).all(), \
+                'truncated envied colleges disagree on capacities {}'.format(q)
+        matches, total_costs = truncated.run_batch(capacity_matrix, return_matches=True)
+        assert list(zip(matches, total_costs)) == [truncated.run(q)[::2] for q in capacity_matrix], \
+            'truncated run_batch disagrees with run'
+        ranks_by_students, ranks_by_colleges = queue.rank_tables()
+        full_ranks_by_students, full_ranks_by_colleges = full.rank_tables()
+        assert ranks_by_students == [{j: full_ranks_by_students[i][j] for j in sorted(prefs)}
+                                     for i, prefs in enumerate(student_prefs)], 'truncated student ranks disagree'
+        assert ranks_by_colleges == [{i: full_ranks_by_colleges[j][i] for i in sorted(prefs)}
+                                     for j, prefs in enumerate(applicants)], 'truncated college ranks disagree'
+
+
+def check_update(num_instances=20, seed=0):
+    # an updated instance matches like one built from the new lists, and matchings it reports unaffected are kept
+    rng = np.random.RandomState(seed)
+    for _ in range(num_instances):
+        num_students = rng.randint(2, 300)
+        num_colleges = rng.randint(1, 20)
+        student_prefs = [rng.permutation(num_colleges).tolist() for _ in range(num_students)]
+        college_prefs = [rng.permutation(num_students).tolist() for _ in range(num_colleges)]
+        capacity_matrix = [rng.multinomial(num_students, np.ones(num_colleges) / num_colleges) + rng.randint(0, 3)
+                           for _ in range(4)]
+        for backend in ['matrix', 'queue']:
+            da = DeferredAcceptance(student_prefs, college_prefs, backend=backend)
+            before = [da.run(q) for q in capacity_matrix]
+            new_student_prefs = {int(i): student_prefs[i][:1] + rng.permutation(student_prefs[i][1:]).tolist()
+                                 for i in rng.choice(num_students, rng.randint(0, 4))}
+            new_college_prefs = {int(j): rng.permutation(num_students).tolist()
+                                 for j in rng.choice(num_colleges, rng.randint(0, 2))}
+            unaffected = da.update(new_student_prefs, new_college_prefs)
+            rebuilt = DeferredAcceptance([new_student_prefs.get(i, prefs) for i, prefs in enumerate(student_prefs)],
+                                         [new_college_prefs.get(j, prefs) for j, prefs in enumerate(college_prefs)],
+                                         backend=backend)
+            for q, (matches, _, total_cost) in zip(capacity_matrix, before):
+                assert da.run(q) == rebuilt.run(q), 'updated run disagrees on capacities {}'.format(q)
+                assert not unaffected(matches) or da.run(q) == (matches, None, total_cost), \
+                    'a matching reported unaffected changed on capacities {}'.format(q)
+
 
 if __name__ == '__main__':
     student_prefs = [
@@ -64,3 +613,19 @@ if __name__ == '__main__':
     print(time.time() - st)
     print(matches_for_students, total_cost)
     st = time.time()
+    da = DeferredAcceptance(student_prefs, college_prefs, backend='queue')
+    matches_for_students, _, total_cost = da.run(college_capacities)
+    print(time.time() - st)
+    print(matches_for_students, total_cost)
+
+    # parity between the matrix and queue backends on random instances
+    check_backend_parity()
+    print('matrix, queue and batched runs agree')
+    check_run_from_parity()
+    print('run_from agrees with run')
+    check_envied_colleges()
+    print('extra seats at unenvied colleges never change the matching')
+    check_truncated_parity()
+    print('truncated lists match like full lists with an unlimited college behind them')
+    check_update()
+    print('updated lists match like rebuilt ones, and unaffected matchings are kept')
@@ -0,0 +1,118 @@
+import multiprocessing
+import numpy as np
+
+from multiprocessing.shared_memory import SharedMemory
+from ca_algs.deferred_acceptance import TruncatedDeferredAcceptance, make_deferred_acceptance
+
+# alignment of every array in the block
+ALIGNMENT = 64
+
+
+def compact_dtype(max_value):
+    for dtype in [np.int16, np.int32]:
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+class SharedDA(object):
+    # The preprocessed arrays (the ARRAYS of its class) of a DeferredAcceptance or TruncatedDeferredAcceptance
+    # instance, published in one block of shared memory so that worker processes attach to them instead of each
+    # receiving a pickled copy of the preference lists and sorting them again. Every array is stored in the smallest
+    # of int16/int32/int64 that holds its values: student ranks and costs are below the number of colleges, college
+    # scores at most the number of students.
+    # Pickling a SharedDA only sends the name and layout of the block, and attach() returns an instance of the same
+    # class whose arrays are read-only views onto it. The process that published the block owns it and frees it
+    # with close().
+    # The workers must be child processes started after the block was published, so that they share the resource
+    # tracker of its owner (another tracker would unlink the block when its worker exits), and must not outlive it.
+    def __init__(self, da):
+        self.cls = type(da)
+        self.backend = da.backend
+        self.num_colleges = da.c
+        self.layout = []
+        size = 0
+        for name in self.cls.ARRAYS:
+            array = getattr(da, name)
+            dtype = compact_dtype(int(array.max()) if array.size > 0 else 0)
+            self.layout.append((name, array.shape, dtype.str, size))
+            size += -(-array.size * dtype.itemsize // ALIGNMENT) * ALIGNMENT
+        self.shm = SharedMemory(create=True, size=max(size, 1))
+        self.name = self.shm.name
+        self.owner = True
+        for name, shape, dtype, offset in self.layout:
+            np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)[...] = getattr(da, name)
+
+    def __getstate__(self):
+        return {'cls': self.cls, 'backend': self.backend, 'num_colleges': self.num_colleges, 'layout': self.layout,
+                'name': self.name}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.shm = None
+        self.owner = False
+
+    def attach(self):
+        if self.shm is None:
+            self.shm = SharedMemory(name=self.name)
+        arrays = {}
+        for name, shape, dtype, offset in self.layout:
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+            arrays[name].flags.writeable = False
+        if issubclass(self.cls, TruncatedDeferredAcceptance):
+            arrays['num_colleges'] = self.num_colleges
+        da = self.cls.from_arrays(backend=self.backend, **arrays)
+        # the views keep the mapping alive only as long as the SharedMemory object is
+        da._shared = self
+        return da
+
+    def nbytes(self):
+        return self.shm.size if self.shm is not None else 0
+
+    def close(self):
+        if self.shm is None:
+            return
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+        self.shm = None
+
+
+def _attached_results(shared, capacity_matrix, base_capacities):
+    da = shared.attach()
+    _, base_state, _ = da.run_from(None, base_capacities)
+    return ([da.run(q) for q in capacity_matrix], da.run_batch(capacity_matrix, return_matches=True),
+            [da.run_from(base_state, q) for q in capacity_matrix], str(getattr(da, da.ARRAYS[-1]).dtype))
+
+
+def check_shared_parity(num_instances=10, seed=0):
+    rng = np.random.RandomState(seed)
+    for n in range(num_instances):
+        num_students = rng.randint(2, 300)
+        num_colleges = rng.randint(1, 20)
+        student_prefs = [rng.permutation(num_colleges).tolist() for _ in range(num_students)]
+        college_prefs = [rng.permutation(num_students).tolist() for _ in range(num_colleges)]
+        college_capacities = rng.multinomial(num_students, np.ones(num_colleges) / num_colleges) + 1
+        capacity_matrix = [(college_capacities + rng.randint(0, 3, num_colleges)).tolist() for _ in range(4)]
+        base_capacities = (college_capacities + 3).tolist()
+        if n % 2 == 1:
+            # every other instance has truncated lists
+            student_prefs = [prefs[:rng.randint(1, num_colleges + 1)] for prefs in student_prefs]
+        da = make_deferred_acceptance(student_prefs, college_prefs)
+        shared = SharedDA(da)
+        try:
+            with multiprocessing.Pool(1) as pool:
+                runs, batch, repaired, dtype = pool.apply(_attached_results, (shared, capacity_matrix, base_capacities))
+        finally:
+            shared.close()
+        _, base_state, _ = da.run_from(None, base_capacities)
+        assert dtype == 'int16', 'college scores of {} students stored as {}'.format(num_students, dtype)
+        assert runs == [da.run(q) for q in capacity_matrix], 'attached run disagrees with run'
+        assert batch == da.run_batch(capacity_matrix, return_matches=True), 'attached run_batch disagrees'
+        assert [r[::2] for r in repaired] == [da.run_from(base_state, q)[::2] for q in capacity_matrix], \
+            'attached run_from disagrees with run_from'
+
+
+if __name__ == '__main__':
+    check_shared_parity()
+    print('instances attached from shared memory agree with their originals')
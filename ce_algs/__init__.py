@@ -1,7 +1,7 @@
-from ce_algs.agg_lin import agg_lin
+from ce_algs.branch_and_bound import branch_and_bound
 from ce_algs.greedy import greedy
-from ce_algs.iqp import iqp
-from ce_algs.lp_heuristic import lp_heuristic
+from ce_algs.local_search import Refined, local_search
+from ce_algs.resolve import Resolver
 from ce_algs.uct_iterative.uct import uct_iterative
 from ce_algs.uct_amaf.uct import uct_amaf
 from ce_algs.uct_batch.uct import uct_batch
@@ -12,3 +12,13 @@ from ce_algs.uct_iterative_priority.uct import uct_iterative_priority
 from ce_algs.uct_iterative_priority.uct import uct_iterative_priority_envy
 from ce_algs.uct_iterative_priority.uct import uct_iterative_priority_popularity
 from ce_algs.uct_iterative_priority.uct import uct_iterative_priority_random
+
+# the MIP algorithms need gurobipy; the others run without it
+try:
+    from ce_algs.agg_lin import agg_lin
+    from ce_algs.hybrid import hybrid
+    from ce_algs.iqp import iqp
+    from ce_algs.lp_heuristic import lp_heuristic
+except ImportError as e:
+    if e.name != 'gurobipy':
+        raise
@@ -1,64 +1,167 @@
+import time
+
 import gurobipy as grb
 import numpy as np
 
-from ca_algs.deferred_acceptance import DeferredAcceptance
+from ca_algs.deferred_acceptance import TruncatedDeferredAcceptance, make_deferred_acceptance
+from ce_algs.application_model import ApplicationModel, BUILDERS
 
 
-def agg_lin(student_prefs, college_prefs, college_capacities, budget, college_budgets, start_capacities=None):
+def agg_lin(student_prefs, college_prefs, college_capacities, budget, college_budgets, start_capacities=None,
+            time_limit=60 * 60, incumbent_callback=None, threads=1, da_arrays=None, builder='matrix',
+            incumbent_bridge=None):
     print('==========Run AggLin Algorithm==========')
+    if builder not in BUILDERS:
+        raise ValueError('unknown model builder: {}'.format(builder))
     num_students = len(student_prefs)
     num_colleges = len(college_prefs)
-    ranks_by_students = [[student_prefs[i].index(j) for j in range(num_colleges)] for i in
-                         range(num_students)]
-    ranks_by_colleges = [[college_prefs[j].index(i) for i in range(num_students)] for j in
-                         range(num_colleges)]
+    da = make_deferred_acceptance(student_prefs, college_prefs, da_arrays)
+
+    model = grb.Model()
+    model.setParam('TimeLimit', time_limit)
+    model.setParam('Threads', threads)
+    start_time = time.time()
+    if builder == 'matrix':
+        t, x_values, w_values, solution = _build_matrix_model(model, da, college_capacities, budget, college_budgets,
+                                                              start_capacities)
+    else:
+        t, x_values, w_values, solution = _build_loop_model(model, da, college_capacities, budget, college_budgets,
+                                                            start_capacities)
+    model.update()
+    build_time = time.time() - start_time
+    print('build time={}'.format(build_time))
+
+    reported_cost = [np.inf]
+
+    def callback(model, where):
+        # an incumbent of the MIP may be any stable matching at the capacities it picks, whose total rank is at least
+        # their DA cost, so the capacities are scored with DA and reported when that cost improves
+        if where == grb.GRB.Callback.MIPSOL and incumbent_callback is not None:
+            t_values = model.cbGetSolution(t)
+            capacities = [college_capacities[j] + int(round(t_values[j])) for j in range(num_colleges)]
+            _, _, total_cost = da.run(capacities)
+            if total_cost < reported_cost[0]:
+                reported_cost[0] = total_cost
+                incumbent_callback(model.cbGet(grb.GRB.Callback.RUNTIME), total_cost, capacities)
+        # a search running alongside passes its solutions in and gets the bound back (see hybrid.IncumbentBridge)
+        if incumbent_bridge is not None:
+            incumbent_bridge.exchange(model, where, solution)
+
+    model.optimize(callback if incumbent_callback is not None or incumbent_bridge is not None else None)
+
+    expanded_capacities = [j for j in college_capacities]
+    best_cost = np.inf
+    best_x = [[0 for _ in range(num_colleges)] for _ in range(num_students)]
+    best_w = [[0 for _ in range(num_colleges)] for _ in range(num_students)]
+    best_t = [0 for _ in range(num_colleges)]
+    if model.Status in [grb.GRB.OPTIMAL, grb.GRB.TIME_LIMIT]:
+        best_x = x_values()
+        best_t = [float(t[j].X) for j in range(num_colleges)]
+        for j in range(num_colleges):
+            expanded_capacities[j] += int(round(best_t[j]))
+        best_w = w_values()
+        best_cost = model.ObjVal
+        print('run time={}'.format(model.Runtime))
+        print('reached time limit={}'.format(model.Status == grb.GRB.TIME_LIMIT))
+        print('gap={}'.format(model.MIPGap))
+        print('node count={}'.format(model.NodeCount))
+        print('x={}'.format(np.array(best_x)))
+        print('t={}'.format(np.array(best_t)))
+        print('objective value={}'.format(best_cost))
+
+    return {
+        'expanded_capacities': expanded_capacities,
+        'best_cost': best_cost,
+        'x': best_x,
+        't': best_t,
+        'w': best_w,
+        'run_time': model.Runtime,
+        'build_time': build_time,
+        'gap': model.MIPGap,
+        'node_count': model.NodeCount,
+        'reached_time_limit': model.Status == grb.GRB.TIME_LIMIT
+    }
+
+
+def _build_matrix_model(model, da, college_capacities, budget, college_budgets, start_capacities):
+    # (t, callables returning the dense values of x and w, solution) of the model built through the matrix API, where
+    # the sums over S[i][j] and T[i][j] read y and u and w linearizes t_j * y, and solution(capacities) returns the
+    # (variables, values) pairs of the matching DA finds for the capacities
+    application = ApplicationModel(model, da, college_capacities, budget, college_budgets)
+    t_of, y, u, q = application.t_of, application.y, application.u, application.capacities
+    w = model.addMVar(len(q), lb=0, vtype=grb.GRB.CONTINUOUS, name='w')
+    if start_capacities is not None:
+        matches_for_students, _, _ = da.run(start_capacities)
+        _, t_start, y_start, _ = application.set_start(matches_for_students, start_capacities)
+        w.Start = t_start[application.colleges] * y_start
+    model.addConstr(t_of - w + q - q * y <= u, name='matching constr')
+    model.addConstr(-w + t_of + budget * y <= budget, name='w constr (a)')
+    model.addConstr(w <= t_of, name='w constr (b)')
+    model.addConstr(w <= budget * y, name='w constr (c)')
+
+    def solution(capacities):
+        matches_for_students, _, _ = da.run(capacities)
+        values = application.solution(matches_for_students, capacities)
+        w_values = values[1][application.colleges] * values[2]
+        return list(zip([application.x, application.t, application.y, application.u, w], values + (w_values,)))
+
+    return application.t, lambda: application.dense(application.x.X), lambda: application.dense(w.X), solution
+
+
+def _build_loop_model(model, da, college_capacities, budget, college_budgets, start_capacities):
+    # (t, callables returning the dense values of x and w, solution) of the model built one variable and constraint at
+    # a time
+    num_students, num_colleges = da.s, da.c
+    # ranks_by_students[i] holds the colleges student i lists and ranks_by_colleges[j] the students who list college j,
+    # so that truncated lists only get variables and constraints for the applications they make
+    ranks_by_students, ranks_by_colleges = da.rank_tables()
     S = []
     for i in range(num_students):
-        S.append([])
-        for j in range(num_colleges):
-            S[i].append([q for q in range(num_colleges) if ranks_by_students[i][q] <= ranks_by_students[i][j]])
+        S.append({})
+        for j in ranks_by_students[i]:
+            S[i][j] = [q for q in ranks_by_students[i] if ranks_by_students[i][q] <= ranks_by_students[i][j]]
     T = []
     for i in range(num_students):
-        T.append([])
-        for j in range(num_colleges):
-            T[i].append([p for p in range(num_students) if ranks_by_colleges[j][p] < ranks_by_colleges[j][i]])
+        T.append({})
+        for j in ranks_by_students[i]:
+            T[i][j] = [p for p in ranks_by_colleges[j] if ranks_by_colleges[j][p] < ranks_by_colleges[j][i]]
+    # on an instance with truncated lists any student may stay unmatched, even one who lists every college, which
+    # costs the length of their list as in DA
+    truncated = list(range(num_students)) if isinstance(da, TruncatedDeferredAcceptance) else []
 
-    model = grb.Model()
-    model.setParam('TimeLimit', 60 * 60)
-    model.setParam('Threads', 1)
     x = []
     for i in range(num_students):
-        x.append([model.addVar(vtype=grb.GRB.BINARY, name='x[{}][{}]'.format(i, j)) for j in range(num_colleges)])
+        x.append({j: model.addVar(vtype=grb.GRB.BINARY, name='x[{}][{}]'.format(i, j)) for j in ranks_by_students[i]})
     t = [model.addVar(lb=0, ub=budget, vtype=grb.GRB.INTEGER, name='t[{}]'.format(j)) for j in range(num_colleges)]
     w = []
     for i in range(num_students):
-        w.append([model.addVar(lb=0, vtype=grb.GRB.CONTINUOUS, name='w[{}][{}]'.format(i, j)) for j in range(num_colleges)])
+        w.append({j: model.addVar(lb=0, vtype=grb.GRB.CONTINUOUS, name='w[{}][{}]'.format(i, j)) for j in x[i]})
     if start_capacities is not None:
-        da = DeferredAcceptance(student_prefs, college_prefs)
         matches_for_students, _, _ = da.run(start_capacities)
         for i in range(num_students):
-            for j in range(num_colleges):
+            for j in x[i]:
                 x[i][j].start = 1 if matches_for_students[i] == j else 0
         for j in range(num_colleges):
             t[j].start = start_capacities[j] - college_capacities[j]
         for i in range(num_students):
-            for j in range(num_colleges):
+            for j in x[i]:
                 w[i][j].start = (start_capacities[j] - college_capacities[j]) * np.sum([1 if matches_for_students[i] == q else 0 for q in S[i][j]])
     model.update()
 
     model.setObjective(
-        grb.quicksum(ranks_by_students[i][j] * x[i][j] for j in range(num_colleges) for i in range(num_students)),
+        grb.quicksum(ranks_by_students[i][j] * x[i][j] for i in range(num_students) for j in x[i])
+        + grb.quicksum(len(x[i]) * (1 - grb.quicksum(x[i][j] for j in x[i])) for i in truncated),
         grb.GRB.MINIMIZE
     )
     model.update()
 
     for i in range(num_students):
-        model.addConstr(grb.quicksum(x[i][j] for j in range(num_colleges)) <= 1, name='student constr[{}]'.format(i))
+        model.addConstr(grb.quicksum(x[i][j] for j in x[i]) <= 1, name='student constr[{}]'.format(i))
     for j in range(num_colleges):
-        model.addConstr(grb.quicksum(x[i][j] for i in range(num_students)) <= college_capacities[j] + t[j], name='college constr[{}]'.format(j))
+        model.addConstr(grb.quicksum(x[i][j] for i in ranks_by_colleges[j]) <= college_capacities[j] + t[j], name='college constr[{}]'.format(j))
     model.addConstr(grb.quicksum(t[j] for j in range(num_colleges)) <= budget)
     for i in range(num_students):
-        for j in range(num_colleges):
+        for j in x[i]:
             model.addConstr(t[j] - w[i][j] + college_capacities[j] * (1 - grb.quicksum(x[i][q] for q in S[i][j]))
                             <= grb.quicksum(x[p][j] for p in T[i][j]), name='matching constr[{}][{}]'.format(i, j))
             model.addConstr(-w[i][j] + t[j] + budget * grb.quicksum(x[i][q] for q in S[i][j]) <= budget,
@@ -69,42 +172,29 @@ def agg_lin(student_prefs, college_prefs, college_capacities, budget, college_bu
     if not (np.array(college_budgets) >= budget).all():
         for j in range(num_colleges):
             model.addConstr(t[j] <= college_budgets[j], name='t constr[{}]'.format(j))
-    model.update()
-
-    model.optimize()
 
-    expanded_capacities = [j for j in college_capacities]
-    best_cost = np.inf
-    best_x = [[0 for _ in range(num_colleges)] for _ in range(num_students)]
-    best_w = [[0 for _ in range(num_colleges)] for _ in range(num_students)]
-    best_t = [0 for _ in range(num_colleges)]
-    if model.Status in [grb.GRB.OPTIMAL, grb.GRB.TIME_LIMIT]:
+    def x_values():
+        best_x = [[0 for _ in range(num_colleges)] for _ in range(num_students)]
         for i in range(num_students):
-            for j in range(num_colleges):
+            for j in x[i]:
                 best_x[i][j] = x[i][j].X
-        for j in range(num_colleges):
-            expanded_capacities[j] += int(t[j].X)
-            best_t[j] = t[j].X
+        return best_x
+
+    def w_values():
+        best_w = [[0 for _ in range(num_colleges)] for _ in range(num_students)]
         for i in range(num_students):
-            for j in range(num_colleges):
+            for j in x[i]:
                 best_w[i][j] = w[i][j].X
-        best_cost = model.ObjVal
-        print('run time={}'.format(model.Runtime))
-        print('reached time limit={}'.format(model.Status == grb.GRB.TIME_LIMIT))
-        print('gap={}'.format(model.MIPGap))
-        print('node count={}'.format(model.NodeCount))
-        print('x={}'.format(np.array(best_x)))
-        print('t={}'.format(np.array(best_t)))
-        print('objective value={}'.format(best_cost))
+        return best_w
 
-    return {
-        'expanded_capacities': expanded_capacities,
-        'best_cost': best_cost,
-        'x': best_x,
-        't': best_t,
-        'w': best_w,
-        'run_time': model.Runtime,
-        'gap': model.MIPGap,
-        'node_count': model.NodeCount,
-        'reached_time_limit': model.Status == grb.GRB.TIME_LIMIT
-    }
+    def solution(capacities):
+        matches_for_students, _, _ = da.run(capacities)
+        variables = [x[i][j] for i in range(num_students) for j in x[i]] + t
+        values = [1 if matches_for_students[i] == j else 0 for i in range(num_students) for j in x[i]]
+        values += [capacities[j] - college_capacities[j] for j in range(num_colleges)]
+        variables += [w[i][j] for i in range(num_students) for j in x[i]]
+        values += [(capacities[j] - college_capacities[j]) * (matches_for_students[i] in S[i][j])
+                   for i in range(num_students) for j in x[i]]
+        return [(variables, values)]
+
+    return t, x_values, w_values, solution
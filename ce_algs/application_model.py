@@ -0,0 +1,178 @@
+import gurobipy as grb
+import numpy as np
+import scipy.sparse as sp
+
+from ca_algs.deferred_acceptance import TruncatedDeferredAcceptance
+
+# Model builders of iqp and agg_lin. 'matrix' adds the variables and constraints of all applications at once through
+# the matrix API of gurobipy (10.0 or later); 'loops' adds them one at a time with the sums over the explicit S and T
+# index lists, as the models were first built.
+BUILDERS = ['matrix', 'loops']
+
+
+class ApplicationModel(object):
+    # The variables and constraints the matrix builders of iqp and agg_lin share, with one entry per application
+    # (a college j on the list of a student i), ordered by student and rank (see DeferredAcceptance.applications):
+    # x says whether i is matched with j, y sums x over the colleges i ranks at least as high as j (the sum over
+    # S[i][j] of the loop builders) and u over the students j ranks higher than i (the sum over T[i][j]).
+    # y and u are prefix sums along the lists of the students and of the colleges, chained by one equality of at most
+    # three terms per application, so the model grows with the number of applications instead of spelling out every
+    # sum; given x they are unique, so the model is equivalent to that of the loop builders.
+    def __init__(self, model, da, college_capacities, budget, college_budgets):
+        self.students, self.colleges, self.ranks, scores = da.applications()
+        self.num_students = da.s
+        self.num_colleges = da.c
+        self.college_capacities = np.asarray(college_capacities)
+        self.capacities = self.college_capacities[self.colleges].astype(float)
+        num_applications = len(self.students)
+        arange = np.arange(num_applications)
+
+        self.x = model.addMVar(num_applications, vtype=grb.GRB.BINARY, name='x')
+        self.t = model.addMVar(self.num_colleges, lb=0, ub=budget, vtype=grb.GRB.INTEGER, name='t')
+        self.y = model.addMVar(num_applications, vtype=grb.GRB.BINARY, name='y')
+        self.u = model.addMVar(num_applications, lb=0, vtype=grb.GRB.CONTINUOUS, name='u')
+        # t of the college of every application
+        self.t_of = self.t[self.colleges]
+
+        # the previous application in the list of the student, and in the priority order of the college
+        follows = self.ranks > 0
+        previous = sp.csr_matrix((np.ones(np.sum(follows)), (arange[follows], arange[follows] - 1)),
+                                 shape=(num_applications, num_applications))
+        self.by_college = np.lexsort((-np.asarray(scores, dtype=int), self.colleges))
+        same_college = self.colleges[self.by_college[1:]] == self.colleges[self.by_college[:-1]]
+        ahead = sp.csr_matrix((np.ones(np.sum(same_college)),
+                               (self.by_college[1:][same_college], self.by_college[:-1][same_college])),
+                              shape=(num_applications, num_applications))
+        model.addConstr(self.y - previous @ self.y == self.x, name='prefix constr')
+        model.addConstr(self.u - ahead @ self.u == ahead @ self.x, name='ahead constr')
+
+        student_sums = sp.csr_matrix((np.ones(num_applications), (self.students, arange)),
+                                     shape=(self.num_students, num_applications))
+        college_sums = sp.csr_matrix((np.ones(num_applications), (self.colleges, arange)),
+                                     shape=(self.num_colleges, num_applications))
+        model.addConstr(student_sums @ self.x <= 1, name='student constr')
+        model.addConstr(college_sums @ self.x - self.t <= self.college_capacities, name='college constr')
+        model.addConstr(self.t.sum() <= budget)
+        if not (np.array(college_budgets) >= budget).all():
+            model.addConstr(self.t <= np.asarray(college_budgets), name='t constr')
+
+        # on an instance with truncated lists any student may stay unmatched, even one who lists every college, which
+        # costs the length of their list as in DA, i.e. the length minus that times y of their last application
+        lengths = np.bincount(self.students, minlength=self.num_students)
+        unmatched_costs = lengths if isinstance(da, TruncatedDeferredAcceptance) else np.zeros(self.num_students)
+        penalties = np.zeros(num_applications)
+        penalties[np.cumsum(lengths)[lengths > 0] - 1] = unmatched_costs[lengths > 0]
+        model.setObjective(self.ranks @ self.x - penalties @ self.y + float(np.sum(unmatched_costs)),
+                           grb.GRB.MINIMIZE)
+
+    def solution(self, matches_for_students, capacities):
+        # values of x, t, y and u at the matching DA finds for `capacities`
+        matches = np.asarray(matches_for_students)[self.students]
+        x = (self.colleges == matches).astype(float)
+        match_ranks = np.full(self.num_students, np.iinfo(np.int64).max)
+        match_ranks[self.students[x > 0]] = self.ranks[x > 0]
+        y = (self.ranks >= match_ranks[self.students]).astype(float)
+        # matched students ahead in the priority order of each college, counted from the start of its group
+        by_college_x = x[self.by_college]
+        counts = np.cumsum(by_college_x) - by_college_x
+        group_starts = np.ones(len(counts), dtype=bool)
+        group_starts[1:] = self.colleges[self.by_college[1:]] != self.colleges[self.by_college[:-1]]
+        u = np.empty(len(counts))
+        u[self.by_college] = counts - np.maximum.accumulate(np.where(group_starts, counts, 0))
+        t = np.asarray(capacities, dtype=float) - self.college_capacities
+        return x, t, y, u
+
+    def set_start(self, matches_for_students, capacities):
+        # starts the solve from the matching DA finds for `capacities`; returns the values of x, t, y and u
+        x, t, y, u = self.solution(matches_for_students, capacities)
+        self.x.Start = x
+        self.t.Start = t
+        self.y.Start = y
+        self.u.Start = u
+        return x, t, y, u
+
+    def dense(self, values):
+        # (num_students, num_colleges) list of lists of per-application values, zero off the applications
+        matrix = np.zeros((self.num_students, self.num_colleges))
+        matrix[self.students, self.colleges] = values
+        return matrix.tolist()
+
+
+def check_builder_parity(num_instances=10, seed=0):
+    # on instances with complete lists, the default path of iqp and agg_lin, both builders find the optimum over all
+    # allocations, and the same allocation and matching when the optimal allocation is unique
+    import itertools
+    from ca_algs.deferred_acceptance import make_deferred_acceptance
+    from ce_algs.agg_lin import agg_lin
+    from ce_algs.iqp import iqp
+    rng = np.random.RandomState(seed)
+    for _ in range(num_instances):
+        num_students = rng.randint(4, 10)
+        num_colleges = rng.randint(2, 4)
+        budget = rng.randint(0, 3)
+        student_prefs = [rng.permutation(num_colleges).tolist() for _ in range(num_students)]
+        college_prefs = [rng.permutation(num_students).tolist() for _ in range(num_colleges)]
+        college_capacities = (rng.multinomial(num_students - num_colleges, np.ones(num_colleges) / num_colleges)
+                              + 1).tolist()
+        college_budgets = [budget] * num_colleges
+        da = make_deferred_acceptance(student_prefs, college_prefs)
+        costs = {}
+        for extra in itertools.combinations_with_replacement(range(num_colleges), budget):
+            capacities = tuple(q + extra.count(j) for j, q in enumerate(college_capacities))
+            costs[capacities] = da.run(list(capacities))[2]
+        optimum = min(costs.values())
+        optima = [capacities for capacities, cost in costs.items() if cost == optimum]
+        instance = (student_prefs, college_prefs, college_capacities, budget, college_budgets)
+        for alg in [iqp, agg_lin]:
+            results = [alg(*instance, builder=builder) for builder in BUILDERS]
+            for builder, result in zip(BUILDERS, results):
+                assert abs(result['best_cost'] - optimum) < 1e-6, \
+                    '{} ({}) reports {} instead of {}'.format(alg.__name__, builder, result['best_cost'], optimum)
+            if len(optima) == 1:
+                assert all(tuple(result['expanded_capacities']) == optima[0] for result in results), \
+                    'the builders of {} pick different capacities'.format(alg.__name__)
+                assert np.array_equal(*(np.round(result['x']) for result in results)), \
+                    'the builders of {} pick different matchings'.format(alg.__name__)
+
+
+def check_truncated_objective(num_instances=20, seed=0):
+    # on instances with truncated lists, some of which list every college, the optimum iqp and agg_lin report is the
+    # DA cost of the capacities they return and the optimum over all allocations, and lp_heuristic reports the DA cost
+    # of its capacities
+    import itertools
+    from ca_algs.deferred_acceptance import make_deferred_acceptance
+    from ce_algs.agg_lin import agg_lin
+    from ce_algs.iqp import iqp
+    from ce_algs.lp_heuristic import lp_heuristic
+    rng = np.random.RandomState(seed)
+    for _ in range(num_instances):
+        num_students = rng.randint(2, 12)
+        num_colleges = rng.randint(2, 5)
+        budget = rng.randint(0, 3)
+        student_prefs = [rng.permutation(num_colleges)[:rng.randint(1, num_colleges + 1)].tolist()
+                         for _ in range(num_students)]
+        student_prefs[0] = student_prefs[0][:num_colleges - 1]
+        college_prefs = [[i for i in rng.permutation(num_students) if j in student_prefs[i]]
+                         for j in range(num_colleges)]
+        college_capacities = rng.randint(1, 3, num_colleges).tolist()
+        college_budgets = [budget] * num_colleges
+        da = make_deferred_acceptance(student_prefs, college_prefs)
+        optimum = min(da.run([q + extra.count(j) for j, q in enumerate(college_capacities)])[2]
+                      for extra in itertools.combinations_with_replacement(range(num_colleges), budget))
+        instance = (student_prefs, college_prefs, college_capacities, budget, college_budgets)
+        for alg in [iqp, agg_lin]:
+            for builder in BUILDERS:
+                result = alg(*instance, builder=builder)
+                assert abs(result['best_cost'] - optimum) < 1e-6, \
+                    '{} ({}) reports {} instead of {}'.format(alg.__name__, builder, result['best_cost'], optimum)
+                assert da.run(result['expanded_capacities'])[2] == optimum, \
+                    '{} ({}) returns capacities that are not optimal'.format(alg.__name__, builder)
+        result = lp_heuristic(*instance)
+        assert result['best_cost'] == da.run(result['expanded_capacities'])[2], 'lp_heuristic misreports its cost'
+
+
+if __name__ == '__main__':
+    check_builder_parity()
+    print('the matrix and loop builders agree on complete lists')
+    check_truncated_objective()
+    print('iqp and agg_lin find the DA optimum on truncated instances')
@@ -0,0 +1,284 @@
+import multiprocessing
+import numpy as np
+import time
+
+from ca_algs.da_cache import DACache
+from ca_algs.deferred_acceptance import make_deferred_acceptance
+from ca_algs.shared_da import SharedDA
+
+# bounds in the order they are tried, from the cheapest to the strongest
+BOUNDS = ['top_choice', 'ceiling', 'lp']
+
+_worker_search = None
+
+
+class BranchAndBound(object):
+    # Depth-first search over the multisets of colleges that get the extra seats, each multiset visited once as the
+    # sorted history uct_amaf uses: the children of a node add a seat at the last college it added or at a later one.
+    # Every node is a solution. Extra seats only make students weakly better off, so the DA cost of a node is an upper
+    # bound on its subtree, and the DA matching at its ceiling (the node plus every seat its subtree can add) gives
+    # every student a rank no completion beats. A seat at a college nobody envies leaves the matching unchanged,
+    # also under any larger capacities (see DeferredAcceptance.envied_colleges), so such colleges are never branched
+    # on. A subtree is pruned when one of these lower bounds reaches the best cost found:
+    # - 'top_choice': the students whose first choice has fewer ceiling seats than applicants cost at least 1 each,
+    # - 'ceiling': the DA cost at the ceiling,
+    # - 'lp': the LP relaxation of assigning every student a college they rank between their ceiling and node
+    #   ranks, with the extra seats limited by the budget left instead of the ceiling alone. It is the tightest,
+    #   but a solve costs more than the DA repairs it saves on the synthetic instances, so it is off by default.
+    # Ceilings only shrink down the tree, so the DA of every node repairs the matching at its parent's ceiling (see
+    # DeferredAcceptance.run_from); the DA runs are memoized by DACache. shared_best, a multiprocessing.Value, shares
+    # the best cost between workers searching different subtrees, and incumbent_callback(elapsed, best_cost,
+    # expanded_capacities) is called whenever the best cost of this search improves.
+    def __init__(self, da, college_capacities, budget, college_budgets, lp_bound=False, cache_bytes=2 ** 28,
+                 shared_best=None, incumbent_callback=None):
+        self.da = DACache(da, max_bytes=cache_bytes)
+        self.college_capacities = np.array(college_capacities, dtype=int)
+        self.budget = budget
+        self.limits = np.minimum(np.array(college_budgets, dtype=int), budget)
+        self.lp_bound = lp_bound
+        self.shared_best = shared_best
+        self.incumbent_callback = incumbent_callback
+        self.st_time = time.time()
+        self.best_cost = np.inf
+        self.best_capacities = None
+        self.nodes = 0
+        self.pruned = {bound: 0 for bound in BOUNDS}
+        self.timed_out = False
+        self.deadline = None
+
+        self.students, self.colleges, self.ranks, _ = da.applications()
+        self.lengths = np.bincount(self.students, minlength=da.s)
+        # rank of every college on the list of every student, and in the last column the cost of staying unmatched,
+        # so that a matching -1 indexes it
+        self.rank_table = np.repeat(self.lengths[:, None], da.c + 1, axis=1)
+        self.rank_table[self.students, self.colleges] = self.ranks
+        first_choices = self.colleges[self.ranks == 0]
+        self.top_counts = np.bincount(first_choices, minlength=da.c)
+
+    def search(self, extra, first, node=None, base_state=None, deadline=None):
+        # searches the subtree of the node with `extra` seats whose children add seats at `first` or later colleges;
+        # node is the (matches, cost) of its capacities if known
+        self.deadline = deadline
+        self._visit(np.array(extra, dtype=int), first, node, base_state)
+        return self.best_cost, self.best_capacities
+
+    def _visit(self, extra, first, node, base_state):
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.timed_out = True
+            return
+        self.nodes += 1
+        capacities = self.college_capacities + extra
+        if node is None:
+            matches, _, cost = self.da.run_from(base_state, capacities.tolist())
+        else:
+            matches, cost = node
+        self._update_best(cost, capacities)
+        remaining = self.budget - int(np.sum(extra))
+        open_colleges = np.flatnonzero(self.da.envied_colleges(matches) & (extra < self.limits))
+        open_colleges = open_colleges[open_colleges >= first]
+        if remaining == 0 or len(open_colleges) == 0:
+            return
+
+        ceiling = capacities.copy()
+        ceiling[open_colleges] += np.minimum(self.limits[open_colleges] - extra[open_colleges], remaining)
+        if np.sum(np.maximum(self.top_counts - ceiling, 0)) >= self._best():
+            self.pruned['top_choice'] += 1
+            return
+        ceiling_matches, ceiling_state, ceiling_cost = self.da.run_from(base_state, ceiling.tolist())
+        # a cached ceiling comes without its state, whose ancestor's state still dominates the subtree
+        ceiling_state = ceiling_state if ceiling_state is not None else base_state
+        if ceiling_cost >= self._best():
+            self.pruned['ceiling'] += 1
+            return
+        # with one seat left the children cost a repair each, less than the LP
+        if self.lp_bound and remaining > 1 and \
+                self._lp_bound(matches, ceiling_matches, capacities, ceiling, remaining) >= self._best():
+            self.pruned['lp'] += 1
+            return
+
+        # dive into the cheapest children first, so that good solutions prune the rest early
+        children = []
+        for j in open_colleges:
+            child_extra = extra.copy()
+            child_extra[j] += 1
+            child_matches, _, child_cost = self.da.run_from(ceiling_state,
+                                                            (self.college_capacities + child_extra).tolist())
+            children.append((child_cost, j, child_extra, child_matches))
+        for child_cost, j, child_extra, child_matches in sorted(children, key=lambda child: child[:2]):
+            self._visit(child_extra, j, (child_matches, child_cost), ceiling_state)
+
+    def _lp_bound(self, matches, ceiling_matches, capacities, ceiling, remaining):
+        # Students whose rank is the same at the node and at its ceiling keep their college in the whole subtree;
+        # the others may take any college they rank in between, or stay unmatched if they are at the node, within
+        # the node's seats plus at most `remaining` extra seats up to the ceiling.
+        # scipy is only needed for this bound, which is off by default
+        import scipy.sparse as sp
+        from scipy.optimize import linprog
+        upper = self.rank_table[self.da.arange_s, matches]
+        lower = self.rank_table[self.da.arange_s, ceiling_matches]
+        movable = lower < upper
+        if not movable.any():
+            return float(np.sum(upper))
+        fixed = np.array(matches)[~movable]
+        free_seats = capacities - np.bincount(fixed[fixed >= 0], minlength=self.da.c)
+        allowed = movable[self.students] & (self.ranks >= lower[self.students]) & (self.ranks <= upper[self.students])
+        students, colleges, ranks = self.students[allowed], self.colleges[allowed], self.ranks[allowed]
+        unmatched = np.flatnonzero(movable & (upper == self.lengths))
+        expandable = np.flatnonzero(ceiling > capacities)
+
+        # variables: the allowed applications, staying unmatched, and the extra seats of the expandable colleges
+        num_x, num_unmatched, num_extra = len(students), len(unmatched), len(expandable)
+        row_of = np.cumsum(movable) - 1
+        a_eq = sp.csr_matrix((np.ones(num_x + num_unmatched),
+                              (row_of[np.concatenate([students, unmatched])], np.arange(num_x + num_unmatched))),
+                             shape=(np.sum(movable), num_x + num_unmatched + num_extra))
+        a_ub = sp.vstack([
+            sp.csr_matrix((np.concatenate([np.ones(num_x), -np.ones(num_extra)]),
+                           (np.concatenate([colleges, expandable]),
+                            np.concatenate([np.arange(num_x), num_x + num_unmatched + np.arange(num_extra)]))),
+                          shape=(self.da.c, num_x + num_unmatched + num_extra)),
+            sp.csr_matrix((np.ones(num_extra), (np.zeros(num_extra, dtype=int),
+                                                num_x + num_unmatched + np.arange(num_extra))),
+                          shape=(1, num_x + num_unmatched + num_extra))
+        ])
+        b_ub = np.concatenate([free_seats, [remaining]])
+        costs = np.concatenate([ranks, self.lengths[unmatched], np.zeros(num_extra)])
+        bounds = np.zeros((num_x + num_unmatched + num_extra, 2))
+        bounds[:num_x + num_unmatched, 1] = 1
+        bounds[num_x + num_unmatched:, 1] = (ceiling - capacities)[expandable]
+        result = linprog(costs, A_ub=a_ub, b_ub=b_ub, A_eq=a_eq, b_eq=np.ones(a_eq.shape[0]), bounds=bounds,
+                         method='highs')
+        if result.status != 0:
+            return -np.inf
+        # the DA cost is a sum of ranks, so the bound rounds up
+        return float(np.sum(upper[~movable]) + np.ceil(result.fun - 1e-6))
+
+    def _best(self):
+        if self.shared_best is not None:
+            return min(self.best_cost, self.shared_best.value)
+        return self.best_cost
+
+    def _update_best(self, cost, capacities):
+        if cost >= self.best_cost:
+            return
+        self.best_cost = cost
+        self.best_capacities = capacities.tolist()
+        if self.shared_best is not None:
+            with self.shared_best.get_lock():
+                self.shared_best.value = min(self.shared_best.value, cost)
+        if self.incumbent_callback is not None:
+            self.incumbent_callback(time.time() - self.st_time, cost, self.best_capacities)
+
+
+def branch_and_bound(student_prefs, college_prefs, college_capacities, budget, college_budgets, start_capacities=None,
+                     time_limit=None, incumbent_callback=None, num_workers=1, split_depth=None, lp_bound=False,
+                     cache_bytes=2 ** 28, da_arrays=None):
+    print('==========Run Branch and Bound Algorithm==========')
+    da = make_deferred_acceptance(student_prefs, college_prefs, da_arrays)
+    st_time = time.time()
+    deadline = st_time + time_limit if time_limit is not None else None
+    best_cost = np.inf
+    best_capacities = [j for j in college_capacities]
+    if start_capacities is not None:
+        _, _, best_cost = da.run(start_capacities)
+        best_capacities = [j for j in start_capacities]
+    num_colleges = len(college_prefs)
+
+    if num_workers == 1:
+        tree = BranchAndBound(da, college_capacities, budget, college_budgets, lp_bound, cache_bytes,
+                              incumbent_callback=incumbent_callback)
+        tree.best_cost = best_cost
+        cost, capacities = tree.search(np.zeros(num_colleges, dtype=int), 0, deadline=deadline)
+        results = [(cost, capacities, tree.nodes, tree.pruned, tree.da.misses, tree.timed_out)]
+    else:
+        # The subtrees rooted at the nodes `split_depth` seats deep (and the shallower nodes without children) are
+        # searched on a pool of workers that attach to the DA arrays in shared memory and share the best cost.
+        limits = np.minimum(np.array(college_budgets, dtype=int), budget)
+        if split_depth is None:
+            split_depth = _split_depth(limits, budget, 4 * num_workers)
+        subtrees = list(_subtrees(np.zeros(num_colleges, dtype=int), 0, limits, min(split_depth, budget)))
+        shared_best = multiprocessing.Value('d', best_cost)
+        shared = SharedDA(da)
+        try:
+            with multiprocessing.Pool(num_workers, initializer=_init_worker,
+                                      initargs=(shared, college_capacities, budget, college_budgets, lp_bound,
+                                                cache_bytes, shared_best)) as pool:
+                results = []
+                # the best cost of every subtree is reported as its search finishes
+                for result in pool.imap_unordered(_search_subtree, [(extra, first, deadline)
+                                                                    for extra, first in subtrees]):
+                    results.append(result)
+                    if incumbent_callback is not None and result[1] is not None and result[0] < best_cost:
+                        best_cost = result[0]
+                        incumbent_callback(time.time() - st_time, result[0], result[1])
+        finally:
+            shared.close()
+
+    for cost, capacities, _, _, _, _ in results:
+        if capacities is not None and cost <= best_cost:
+            best_cost = cost
+            best_capacities = capacities
+    if best_cost == np.inf:
+        _, _, best_cost = da.run(best_capacities)
+    run_time = time.time() - st_time
+    nodes = sum(result[2] for result in results)
+    pruned = {bound: sum(result[3][bound] for result in results) for bound in BOUNDS}
+    proven_optimal = not any(result[5] for result in results)
+    print('run time={}'.format(run_time))
+    print('nodes={}, nodes per sec={}'.format(nodes, nodes / run_time if run_time > 0 else 0.0))
+    print('pruned={}'.format(pruned))
+    print('proven optimal={}'.format(proven_optimal))
+    print('Total cost for expanded capacities {}: {}'.format(best_capacities, best_cost))
+
+    return {
+        'expanded_capacities': best_capacities,
+        'best_cost': best_cost,
+        'run_time': run_time,
+        'nodes': nodes,
+        'nodes_per_sec': nodes / run_time if run_time > 0 else 0.0,
+        'pruned': pruned,
+        'da_evaluations': sum(result[4] for result in results),
+        'proven_optimal': proven_optimal
+    }
+
+
+def _split_depth(limits, budget, num_subtrees):
+    # smallest depth with at least num_subtrees nodes, counting the multisets of colleges within the limits
+    counts = np.zeros(budget + 1, dtype=np.int64)
+    counts[0] = 1
+    for limit in limits:
+        counts = np.convolve(counts, np.ones(limit + 1, dtype=np.int64))[:budget + 1]
+        counts = np.minimum(counts, num_subtrees)
+    for depth in range(budget + 1):
+        if counts[depth] >= num_subtrees:
+            return depth
+    return budget
+
+
+def _subtrees(extra, first, limits, depth):
+    # (extra, first) of the nodes `depth` seats deep and of the shallower nodes without children
+    if depth == 0:
+        yield extra, first
+        return
+    open_colleges = [j for j in range(first, len(limits)) if extra[j] < limits[j]]
+    if len(open_colleges) == 0:
+        yield extra, first
+        return
+    for j in open_colleges:
+        child_extra = extra.copy()
+        child_extra[j] += 1
+        yield from _subtrees(child_extra, j, limits, depth - 1)
+
+
+def _init_worker(shared, college_capacities, budget, college_budgets, lp_bound, cache_bytes, shared_best):
+    global _worker_search
+    _worker_search = (shared.attach(), college_capacities, budget, college_budgets, lp_bound, cache_bytes,
+                      shared_best)
+
+
+def _search_subtree(task):
+    extra, first, deadline = task
+    da, college_capacities, budget, college_budgets, lp_bound, cache_bytes, shared_best = _worker_search
+    tree = BranchAndBound(da, college_capacities, budget, college_budgets, lp_bound, cache_bytes, shared_best)
+    cost, capacities = tree.search(extra, first, deadline=deadline)
+    return cost, capacities, tree.nodes, tree.pruned, tree.da.misses, tree.timed_out
@@ -1,37 +1,71 @@
 import numpy as np
 import time
 
-from ca_algs.deferred_acceptance import DeferredAcceptance
+from ca_algs.deferred_acceptance import make_deferred_acceptance
 
 
-def greedy(student_prefs, college_prefs, college_capacities, budget, college_budgets):
+def greedy(student_prefs, college_prefs, college_capacities, budget, college_budgets, time_limit=None,
+           max_da_evaluations=None, incumbent_callback=None, da_arrays=None, sweep=False):
+    # with sweep, the result also holds the allocation of every smaller budget, i.e. every prefix of the allocation,
+    # and its cost
     print('==========Run Greedy Algorithm==========')
     expanded_capacities = [j for j in college_capacities]
-    best_cost = np.infty
+    best_cost = np.inf
+    budget_capacities = []
+    budget_costs = []
 
-    da = DeferredAcceptance(student_prefs, college_prefs)
+    da = make_deferred_acceptance(student_prefs, college_prefs, da_arrays)
+    num_da_evaluations = 0
     st_time = time.time()
     for b in range(budget):
+        # every prefix of the allocation is a solution, so stopping early still returns the best one found so far
+        if time_limit is not None and time.time() - st_time >= time_limit:
+            print('Reached time limit! Terminate search')
+            break
+        if max_da_evaluations is not None and num_da_evaluations >= max_da_evaluations:
+            print('Reached DA evaluation limit! Terminate search')
+            break
         print('===Search allocation of {}-th extra capacity==='.format(b))
-        new_costs = [-1 for _ in range(len(college_prefs))]
-        for i in range(len(college_prefs)):
+        # every probe only removes seats from this ceiling, so DA repairs its matching instead of starting over
+        ceiling = [expanded_capacities[i] + (expanded_capacities[i] - college_capacities[i] < college_budgets[i])
+                   for i in range(len(college_prefs))]
+        _, ceiling_state, _ = da.run_from(None, ceiling)
+        new_costs = [np.inf for _ in range(len(college_prefs))]
+        probes = [i for i in range(len(college_prefs)) if ceiling[i] > expanded_capacities[i]]
+        probe_capacities = []
+        for i in probes:
             new_capacities = [j for j in expanded_capacities]
             new_capacities[i] += 1
-            if new_capacities[i] - college_capacities[i] > college_budgets[i]:
-                total_cost = np.inf
-            else:
-                _, _, total_cost = da.run(new_capacities)
+            probe_capacities.append(new_capacities)
+        for i, total_cost in zip(probes, da.run_batch(probe_capacities, base_state=ceiling_state)):
             new_costs[i] = total_cost
+        num_da_evaluations += 1 + len(probes)
+        previous_best_cost = best_cost
+        for i in range(len(college_prefs)):
+            total_cost = new_costs[i]
             print('Total cost when {}-th extra capacity is allocated to college {}: {}'.format(b, i, total_cost))
             best_cost = min(best_cost, total_cost)
         min_college_id = np.argmin(new_costs)
         expanded_capacities[min_college_id] += 1
         print('{}-th extra capacity is allocated to college {}: new capacities are {}, new cost is {}'
               .format(b, min_college_id, expanded_capacities, best_cost))
+        budget_capacities.append([j for j in expanded_capacities])
+        budget_costs.append(float(new_costs[min_college_id]))
+        # the best cost of a step is that of the capacities it leaves, so they are reported together when it improves
+        if incumbent_callback is not None and new_costs[min_college_id] < previous_best_cost:
+            incumbent_callback(time.time() - st_time, float(new_costs[min_college_id]),
+                               [j for j in expanded_capacities])
+    if best_cost == np.inf:
+        _, _, best_cost = da.run(expanded_capacities)
     run_time = time.time() - st_time
 
-    return {
+    result = {
         'expanded_capacities': expanded_capacities,
         'best_cost': best_cost,
-        'run_time': run_time
+        'run_time': run_time,
+        'da_evaluations': num_da_evaluations
     }
+    if sweep:
+        result['budget_costs'] = budget_costs
+        result['budget_capacities'] = budget_capacities
+    return result
@@ -0,0 +1,113 @@
+import threading
+import time
+
+import gurobipy as grb
+import numpy as np
+
+from ce_algs.agg_lin import agg_lin
+from ce_algs.uct_iterative_priority.uct import uct_iterative_priority_envy
+
+
+class IncumbentBridge(object):
+    # Connects a search running on another thread to a Gurobi solve. The improving solutions of the search become
+    # incumbents of the solve at its next MIP node, and the bound of the solve stops the search once it proves the best
+    # cost of the search optimal. Both report their improvements to incumbent_callback, timed from the start of the
+    # bridge.
+    def __init__(self, incumbent_callback=None):
+        self.incumbent_callback = incumbent_callback
+        self.lock = threading.Lock()
+        self.st_time = time.time()
+        self.pending_capacities = None
+        self.search_cost = np.inf
+        self.best_cost = np.inf
+        self.bound = -np.inf
+        self.finished = False
+        self.num_injected = 0
+
+    def report(self, elapsed, cost, capacities):
+        with self.lock:
+            if cost >= self.best_cost:
+                return
+            self.best_cost = cost
+        if self.incumbent_callback is not None:
+            self.incumbent_callback(time.time() - self.st_time, cost, capacities)
+
+    def offer(self, elapsed, cost, capacities):
+        # incumbent_callback of the search
+        with self.lock:
+            if cost >= self.search_cost:
+                return
+            self.search_cost = cost
+            self.pending_capacities = list(capacities)
+        self.report(elapsed, cost, capacities)
+
+    def should_stop(self):
+        # the DA cost is a sum of ranks, so a bound within the integer tolerance of it proves it optimal
+        return self.finished or self.search_cost <= np.ceil(self.bound - 1e-6)
+
+    def exchange(self, model, where, solution):
+        # called by the Gurobi callback; solution(capacities) returns the (variables, values) pairs of the matching
+        # DA finds for the capacities
+        if where == grb.GRB.Callback.MIP:
+            self.bound = model.cbGet(grb.GRB.Callback.MIP_OBJBND)
+        elif where == grb.GRB.Callback.MIPNODE and self.pending_capacities is not None:
+            with self.lock:
+                capacities, self.pending_capacities = self.pending_capacities, None
+                cost = self.search_cost
+            if cost >= model.cbGet(grb.GRB.Callback.MIPNODE_OBJBST):
+                return
+            for variables, values in solution(capacities):
+                model.cbSetSolution(variables, values)
+            model.cbUseSolution()
+            self.num_injected += 1
+
+
+def hybrid(student_prefs, college_prefs, college_capacities, budget, college_budgets, start_capacities=None,
+           time_limit=60 * 60, incumbent_callback=None, threads=1, da_arrays=None, mip=agg_lin,
+           search=uct_iterative_priority_envy, search_kwargs=None, **kwargs):
+    # Runs `search` on a thread alongside the solve of `mip` (iqp or agg_lin, whose further kwargs it takes). Every
+    # improving solution of the search is injected into the solve, and the search stops once the bound of the solve
+    # closes the gap to its best cost; the solve stops on its own when an injected solution closes the gap.
+    print('==========Run Hybrid {} + {}=========='.format(search.__name__, mip.__name__))
+    bridge = IncumbentBridge(incumbent_callback)
+    search_results = []
+    search_errors = []
+
+    def run_search():
+        # an exception would end the thread silently, so it is kept and raised again once the solve is over
+        try:
+            search_results.append(search(student_prefs, college_prefs, college_capacities, budget, college_budgets,
+                                         time_limit=time_limit, incumbent_callback=bridge.offer,
+                                         should_stop=bridge.should_stop, da_arrays=da_arrays,
+                                         **(search_kwargs or {})))
+        except BaseException as error:
+            search_errors.append(error)
+
+    search_thread = threading.Thread(target=run_search)
+    search_thread.start()
+    try:
+        result = mip(student_prefs, college_prefs, college_capacities, budget, college_budgets, start_capacities,
+                     time_limit=time_limit, incumbent_callback=bridge.report, threads=threads, da_arrays=da_arrays,
+                     incumbent_bridge=bridge, **kwargs)
+    finally:
+        bridge.finished = True
+        search_thread.join()
+    if search_errors:
+        raise search_errors[0]
+    search_result, log = search_results[0]
+    run_time = time.time() - bridge.st_time
+
+    result['mip_best_cost'] = result['best_cost']
+    result['mip_run_time'] = result['run_time']
+    result['search_best_cost'] = search_result['best_cost']
+    result['search_run_time'] = search_result['run_time']
+    result['num_injected'] = bridge.num_injected
+    result['run_time'] = run_time
+    # the solve may end before it takes in the last solutions of the search
+    if search_result['best_cost'] < result['best_cost']:
+        result['expanded_capacities'] = search_result['expanded_capacities']
+        result['best_cost'] = search_result['best_cost']
+    print('run time={}'.format(run_time))
+    print('injected solutions={}'.format(bridge.num_injected))
+    print('Total cost for expanded capacities {}: {}'.format(result['expanded_capacities'], result['best_cost']))
+    return result, log
@@ -0,0 +1,169 @@
+import numpy as np
+import time
+
+from ca_algs.da_cache import DACache
+from ca_algs.deferred_acceptance import make_deferred_acceptance
+
+# 'first' takes the first improving neighbor of the colleges tried in order, 'steepest' the best neighbor of all
+POLICIES = ['first', 'steepest']
+
+
+class LocalSearch(object):
+    # Descent over the allocations of extra seats. The neighbors of an allocation move one seat from a college a
+    # (or from the unused budget) to a college b, or swap the extra seats of two colleges. Every move to b lies under
+    # the ceiling that adds a seat at every college below its limit, so its DA repairs the matching at that ceiling
+    # (see DeferredAcceptance.run_from), and the DA runs are memoized by DACache, so allocations the descent comes
+    # back to are free. Extra seats only make students weakly better off, so the moves out of a are skipped when
+    # the ceiling without a's seat costs no less than the current allocation, and a move to b is skipped when nobody
+    # envies b under the allocation without a's seat (see DeferredAcceptance.envied_colleges): its matching would be
+    # that of the allocation with one seat less. Swaps lie under the ceiling that gives every college the largest
+    # extra seats it can swap in, and are tried only once no move improves.
+    def __init__(self, da, college_capacities, budget, college_budgets, policy='first', cache_bytes=2 ** 28,
+                 incumbent_callback=None):
+        self.da = DACache(da, max_bytes=cache_bytes)
+        self.college_capacities = np.array(college_capacities, dtype=int)
+        self.budget = budget
+        self.limits = np.minimum(np.array(college_budgets, dtype=int), budget)
+        self.policy = policy
+        self.incumbent_callback = incumbent_callback
+        self.st_time = time.time()
+        self.num_moves = 0
+        self.num_swaps = 0
+        self.num_neighbors = 0
+
+    def descend(self, extra, cost, deadline=None):
+        # improves the allocation `extra` of DA cost `cost` until no neighbor improves or the deadline passes; returns
+        # the final allocation, its cost and whether it is a local optimum
+        extra = np.array(extra, dtype=int)
+        while deadline is None or time.time() < deadline:
+            step = self._move(extra, cost, deadline)
+            if step is None:
+                step = self._swap(extra, cost)
+                if step is None:
+                    return extra, cost, True
+                self.num_swaps += 1
+            else:
+                self.num_moves += 1
+            extra, cost = step
+            if self.incumbent_callback is not None:
+                self.incumbent_callback(time.time() - self.st_time, cost, (self.college_capacities + extra).tolist())
+        return extra, cost, False
+
+    def _move(self, extra, cost, deadline):
+        if not (extra < self.limits).any():
+            return None
+        capacities = self.college_capacities + extra
+        ceiling = capacities + (extra < self.limits)
+        # the states are needed to repair from, so they bypass the cache, which does not keep them
+        _, ceiling_state, _ = self.da.da.run_from(None, ceiling.tolist())
+        _, state, _ = self.da.da.run_from(ceiling_state, capacities.tolist())
+        # the colleges a seat can move out of, tried from the lowest bound on, after the unused budget (-1)
+        bounded = []
+        for a in np.flatnonzero(extra > 0):
+            reduced = ceiling.copy()
+            reduced[a] = capacities[a] - 1
+            bound = self.da.run_from(ceiling_state, reduced.tolist())[2]
+            if bound < cost:
+                bounded.append((bound, a))
+        sources = ([-1] if np.sum(extra) < self.budget else []) + [a for _, a in sorted(bounded)]
+
+        best = None
+        for a in sources:
+            if deadline is not None and time.time() >= deadline:
+                break
+            reduced = capacities.copy()
+            if a >= 0:
+                reduced[a] -= 1
+            matches = self.da.run_from(state, reduced.tolist())[0] if a >= 0 else state.matches
+            targets = np.flatnonzero(self.da.envied_colleges(matches) & (extra < self.limits))
+            targets = targets[targets != a]
+            if len(targets) == 0:
+                continue
+            neighbors = np.repeat(reduced[None, :], len(targets), axis=0)
+            neighbors[np.arange(len(targets)), targets] += 1
+            costs = self.da.run_batch(neighbors.tolist(), base_state=ceiling_state)
+            self.num_neighbors += len(targets)
+            k = int(np.argmin(costs))
+            if costs[k] < cost and (best is None or costs[k] < best[1]):
+                best = (neighbors[k] - self.college_capacities, costs[k])
+                if self.policy == 'first':
+                    break
+        return best
+
+    def _swap(self, extra, cost):
+        # swaps of colleges whose extra seats differ by one are moves, which have been tried already
+        pairs = [(a, b) for a in range(len(extra)) for b in range(a + 1, len(extra))
+                 if abs(extra[a] - extra[b]) > 1 and extra[a] <= self.limits[b] and extra[b] <= self.limits[a]]
+        if len(pairs) == 0:
+            return None
+        neighbors = np.repeat(extra[None, :], len(pairs), axis=0)
+        for k, (a, b) in enumerate(pairs):
+            neighbors[k, a], neighbors[k, b] = extra[b], extra[a]
+        ceiling = self.college_capacities + neighbors.max(axis=0)
+        _, ceiling_state, _ = self.da.da.run_from(None, ceiling.tolist())
+        costs = self.da.run_batch((self.college_capacities + neighbors).tolist(), base_state=ceiling_state)
+        self.num_neighbors += len(pairs)
+        k = int(np.argmin(costs))
+        if costs[k] >= cost:
+            return None
+        return neighbors[k], costs[k]
+
+
+def local_search(student_prefs, college_prefs, college_capacities, budget, college_budgets, start_capacities=None,
+                 time_limit=60, incumbent_callback=None, policy='first', cache_bytes=2 ** 28, da_arrays=None):
+    # Improves start_capacities, e.g. the expanded capacities any other algorithm returns, by the moves of
+    # LocalSearch; without them it starts from no extra seats.
+    print('==========Run Local Search==========')
+    if policy not in POLICIES:
+        raise ValueError('unknown local search policy: {}'.format(policy))
+    da = make_deferred_acceptance(student_prefs, college_prefs, da_arrays)
+    st_time = time.time()
+    deadline = st_time + time_limit if time_limit is not None else None
+    if start_capacities is None:
+        start_capacities = college_capacities
+    extra = np.array(start_capacities, dtype=int) - np.array(college_capacities, dtype=int)
+    _, _, start_cost = da.run(start_capacities)
+
+    search = LocalSearch(da, college_capacities, budget, college_budgets, policy, cache_bytes, incumbent_callback)
+    extra, best_cost, local_optimum = search.descend(extra, start_cost, deadline)
+    expanded_capacities = (np.array(college_capacities, dtype=int) + extra).tolist()
+    run_time = time.time() - st_time
+    print('run time={}'.format(run_time))
+    print('moves={}, swaps={}, neighbors={}'.format(search.num_moves, search.num_swaps, search.num_neighbors))
+    print('local optimum={}'.format(local_optimum))
+    print('Total cost for expanded capacities {}: {} (start cost {})'.format(expanded_capacities, best_cost,
+                                                                             start_cost))
+
+    return {
+        'expanded_capacities': expanded_capacities,
+        'best_cost': best_cost,
+        'start_cost': start_cost,
+        'run_time': run_time,
+        'moves': search.num_moves,
+        'swaps': search.num_swaps,
+        'neighbors': search.num_neighbors,
+        'da_evaluations': search.da.misses,
+        'local_optimum': local_optimum
+    }
+
+
+class Refined(object):
+    # Runs `alg` and then local_search from the expanded capacities it returns, so that any algorithm of ce_algs can be
+    # listed as Refined(alg) in the experiments. It is a class rather than a closure so that run_trials can pickle it.
+    def __init__(self, alg, time_limit=60, policy='first'):
+        self.alg = alg
+        self.time_limit = time_limit
+        self.policy = policy
+        self.__name__ = '{}_local_search'.format(alg.__name__)
+
+    def __call__(self, student_prefs, college_prefs, college_capacities, budget, college_budgets, da_arrays=None,
+                 **kwargs):
+        results = self.alg(student_prefs, college_prefs, college_capacities, budget, college_budgets,
+                           da_arrays=da_arrays, **kwargs)
+        result, log = (results, None) if isinstance(results, dict) else results
+        refined = local_search(student_prefs, college_prefs, college_capacities, budget, college_budgets,
+                               result['expanded_capacities'], self.time_limit, policy=self.policy, da_arrays=da_arrays)
+        refined['alg_best_cost'] = result['best_cost']
+        refined['alg_run_time'] = result['run_time']
+        refined['run_time'] += result['run_time']
+        return refined if log is None else (refined, log)
@@ -1,34 +1,45 @@
 import gurobipy as grb
 import numpy as np
 
-from ca_algs.deferred_acceptance import DeferredAcceptance
+from ca_algs.deferred_acceptance import TruncatedDeferredAcceptance, make_deferred_acceptance
 
 
-def lp_heuristic(student_prefs, college_prefs, college_capacities, budget, college_budgets):
+def lp_heuristic(student_prefs, college_prefs, college_capacities, budget, college_budgets, time_limit=60 * 60,
+                 incumbent_callback=None, threads=1, da_arrays=None):
     print('==========Run LPH Algorithm==========')
     num_students = len(student_prefs)
     num_colleges = len(college_prefs)
-    ranks_by_students = [[student_prefs[i].index(j) for j in range(num_colleges)] for i in range(num_students)]
+    da = make_deferred_acceptance(student_prefs, college_prefs, da_arrays)
+    # ranks_by_students[i] holds the colleges student i lists, ranks_by_colleges[j] the students who list college j
+    ranks_by_students, ranks_by_colleges = da.rank_tables()
+    # on an instance with truncated lists any student may stay unmatched, even one who lists every college, which
+    # costs the length of their list as in DA
+    truncated = list(range(num_students)) if isinstance(da, TruncatedDeferredAcceptance) else []
 
     model = grb.Model()
-    model.setParam('TimeLimit', 60 * 60)
-    model.setParam('Threads', 1)
+    model.setParam('TimeLimit', time_limit)
+    model.setParam('Threads', threads)
     x = []
     for i in range(num_students):
-        x.append([model.addVar(lb=0, ub=1, vtype=grb.GRB.CONTINUOUS, name='x[{}][{}]'.format(i, j)) for j in range(num_colleges)])
+        x.append({j: model.addVar(lb=0, ub=1, vtype=grb.GRB.CONTINUOUS, name='x[{}][{}]'.format(i, j))
+                  for j in ranks_by_students[i]})
     t = [model.addVar(lb=0, ub=budget, vtype=grb.GRB.CONTINUOUS, name='t[{}]'.format(j)) for j in range(num_colleges)]
     model.update()
 
     model.setObjective(
-        grb.quicksum(ranks_by_students[i][j] * x[i][j] for j in range(num_colleges) for i in range(num_students)),
+        grb.quicksum(ranks_by_students[i][j] * x[i][j] for i in range(num_students) for j in x[i])
+        + grb.quicksum(len(x[i]) * (1 - grb.quicksum(x[i][j] for j in x[i])) for i in truncated),
         grb.GRB.MINIMIZE
     )
     model.update()
 
     for i in range(num_students):
-        model.addConstr(grb.quicksum(x[i][j] for j in range(num_colleges)) == 1, name='student constr[{}]'.format(i))
+        if isinstance(da, TruncatedDeferredAcceptance):
+            model.addConstr(grb.quicksum(x[i][j] for j in x[i]) <= 1, name='student constr[{}]'.format(i))
+        else:
+            model.addConstr(grb.quicksum(x[i][j] for j in x[i]) == 1, name='student constr[{}]'.format(i))
     for j in range(num_colleges):
-        model.addConstr(grb.quicksum(x[i][j] for i in range(num_students)) <= college_capacities[j] + t[j], name='college constr[{}]'.format(j))
+        model.addConstr(grb.quicksum(x[i][j] for i in ranks_by_colleges[j]) <= college_capacities[j] + t[j], name='college constr[{}]'.format(j))
     model.addConstr(grb.quicksum(t[j] for j in range(num_colleges)) <= budget)
     if not (np.array(college_budgets) >= budget).all():
         for j in range(num_colleges):
@@ -42,7 +53,7 @@ def lp_heuristic(student_prefs, college_prefs, college_capacities, budget, colle
     best_t = [0 for _ in range(num_colleges)]
     if model.Status in [grb.GRB.OPTIMAL, grb.GRB.TIME_LIMIT]:
         for i in range(num_students):
-            for j in range(num_colleges):
+            for j in x[i]:
                 best_x[i][j] = x[i][j].X
         for j in range(num_colleges):
             expanded_capacities[j] += int(t[j].X)
@@ -52,8 +63,10 @@ def lp_heuristic(student_prefs, college_prefs, college_capacities, budget, colle
         print('x={}'.format(np.array(best_x)))
         print('t={}'.format(np.array(best_t)))
 
-    da = DeferredAcceptance(student_prefs, college_prefs)
     _, _, best_cost = da.run(expanded_capacities)
+    # the rounded LP solution is the only solution this heuristic produces
+    if incumbent_callback is not None:
+        incumbent_callback(model.Runtime, best_cost, expanded_capacities)
     return {
         'expanded_capacities': expanded_capacities,
         'best_cost': best_cost,
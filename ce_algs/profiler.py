@@ -0,0 +1,106 @@
+import time
+
+# Phases of a rollout and the tree methods that run them (a tree lacks some of them). A phase is charged only for the
+# time its method spends outside the other timed methods, so the phases add up to the time of the rollouts: 'play' is
+# UCT replaying moves from the root to build the game of a node, 'da' the calls of the DA cache, lookups included, and
+# 'rollout' what do_rollout and do_rollout_batch do besides, e.g. the random playouts of a batch. UCTAMAF builds the
+# games of the children in 'expand', and follows every path to the leaf in 'backpropagate'.
+PHASES = ['rollout', 'select', 'uct_select', 'expand', 'play', 'simulate', 'da', 'backpropagate', 'evict']
+TREE_METHODS = [('rollout', 'do_rollout'), ('rollout', 'do_rollout_batch'), ('select', '_select'),
+                ('uct_select', '_uct_select'), ('expand', '_expand'), ('play', '_game'), ('simulate', '_simulate'),
+                ('simulate', '_batch_reward'), ('backpropagate', '_backpropagate'), ('evict', '_enforce_budget')]
+DA_METHODS = ['run', 'run_from', 'run_batch', 'envied_colleges']
+DA_COUNTERS = ['da_calls', 'da_evaluations', 'da_rounds', 'da_proposals']
+
+
+class Profiler(object):
+    # Opt-in instrumentation of a search on one worker (see run_rollouts). attach replaces the methods of the tree and
+    # of the DA cache by timed wrappers on those instances only, so a search without a profiler runs the plain
+    # methods. Besides the time of every phase, it counts the DA calls and evaluations (lookups and misses of the
+    # cache), the proposal rounds and proposals of DeferredAcceptance in the calls of the cache, the nodes the
+    # expansions create and the depth of the deepest node a selection reaches.
+    def __init__(self):
+        self.times = dict.fromkeys(PHASES, 0.0)
+        self.da_rounds = 0
+        self.da_proposals = 0
+        self.nodes_created = 0
+        self.max_depth = 0
+        self._stack = []
+        self._caches = []
+
+    def attach(self, tree, da):
+        # a sweep attaches the tree and the cache of every budget, which may be those of the previous budget
+        if 'do_rollout' not in vars(tree):
+            for phase, name in TREE_METHODS:
+                if hasattr(tree, name):
+                    setattr(tree, name, self._timed(phase, getattr(tree, name)))
+            tree._select = self._measure_depth(tree._select)
+            tree._expand = self._count_nodes(tree, tree._expand)
+        if 'run' not in vars(da):
+            for name in DA_METHODS:
+                setattr(da, name, self._count_work(da.da, self._timed('da', getattr(da, name))))
+            self._caches.append((da, da.hits, da.misses))
+
+    def record(self, log):
+        "Append the phase times and counts so far to the per-rollout `log`"
+        for phase, elapsed in self.times.items():
+            log['{}_time'.format(phase)].append(elapsed)
+        for name, count in zip(DA_COUNTERS, self._da_counts()):
+            log[name].append(count)
+        log['nodes_created'].append(self.nodes_created)
+        log['max_depth'].append(self.max_depth)
+
+    def summary(self):
+        "Returns the phase times and counts of the search, for its result"
+        summary = {'{}_time'.format(phase): elapsed for phase, elapsed in self.times.items()}
+        summary.update(zip(DA_COUNTERS, self._da_counts()))
+        summary['cache_hit_rate'] = 1 - summary['da_evaluations'] / summary['da_calls'] if summary['da_calls'] else 0.0
+        summary['nodes_created'] = self.nodes_created
+        summary['max_depth'] = self.max_depth
+        return summary
+
+    def _da_counts(self):
+        hits = sum(da.hits - start_hits for da, start_hits, _ in self._caches)
+        misses = sum(da.misses - start_misses for da, _, start_misses in self._caches)
+        return [hits + misses, misses, self.da_rounds, self.da_proposals]
+
+    def _timed(self, phase, method):
+        stack = self._stack
+        times = self.times
+
+        def timed(*args, **kwargs):
+            # the time of nested timed calls is added to the top of the stack and subtracted from this phase
+            stack.append(0.0)
+            st_time = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - st_time
+                times[phase] += elapsed - stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+        return timed
+
+    def _measure_depth(self, select):
+        def measured(node):
+            path = select(node)
+            self.max_depth = max(self.max_depth, len(path) - 1)
+            return path
+        return measured
+
+    def _count_work(self, da, method):
+        def counted(*args, **kwargs):
+            rounds, proposals = da.rounds, da.proposals
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.da_rounds += da.rounds - rounds
+                self.da_proposals += da.proposals - proposals
+        return counted
+
+    def _count_nodes(self, tree, expand):
+        def counted(node):
+            num_nodes = tree.num_nodes()
+            expand(node)
+            self.nodes_created += tree.num_nodes() - num_nodes
+        return counted
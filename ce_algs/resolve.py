@@ -0,0 +1,92 @@
+import numpy as np
+import time
+
+from ca_algs.da_cache import DACache
+from ca_algs.deferred_acceptance import TruncatedDeferredAcceptance, make_deferred_acceptance
+from ce_algs.search import run_rollouts
+from ce_algs.uct_iterative.capacity_expansion_game import CapacityExpansionGame
+from ce_algs.uct_iterative.uct import UCT
+
+
+class Resolver(object):
+    # Runs uct_iterative and keeps what a solve leaves behind: the DA arrays, the DA cache, the search tree and the
+    # incumbent. After a small change of the instance (see update), the next solve picks up from them instead of
+    # starting over. The DA arrays are patched in place, and only the cached DA results the change affects are
+    # dropped, so the other terminal states keep their scores. The tree keeps its statistics, shrunk so that new
+    # rollouts soon outweigh them (see UCT.restart). The extra seats of the incumbent, applied to the new current
+    # capacities, compete with the best allocation the search finds.
+    # Only complete preference lists are supported, since truncated ones cannot be patched in place.
+    def __init__(self, student_prefs, college_prefs, college_capacities, budget, college_budgets, cache_bytes=2 ** 28,
+                 prune_actions=False, da_arrays=None):
+        da = make_deferred_acceptance(student_prefs, college_prefs, da_arrays)
+        if isinstance(da, TruncatedDeferredAcceptance):
+            raise ValueError('re-solving needs complete preference lists')
+        self.da = DACache(da, max_bytes=cache_bytes)
+        self.student_prefs = [list(prefs) for prefs in student_prefs]
+        self.college_prefs = [list(prefs) for prefs in college_prefs]
+        self.college_capacities = [int(q) for q in college_capacities]
+        self.budget = budget
+        self.college_budgets = [int(b) for b in college_budgets]
+        self.prune_actions = prune_actions
+        self.tree = None
+        self.best_extra = None
+        self.num_invalidated = 0
+
+    def update(self, student_prefs=None, college_prefs=None, college_capacities=None):
+        # Applies a change of the instance: the new lists of some students and colleges, given as dicts {index: new
+        # list}, and the new current capacities. Returns the number of cached DA results the change invalidated.
+        unaffected = self.da.da.update(student_prefs, college_prefs)
+        self.num_invalidated = self.da.invalidate(unaffected)
+        for i, prefs in (student_prefs or {}).items():
+            self.student_prefs[i] = list(prefs)
+        for j, prefs in (college_prefs or {}).items():
+            self.college_prefs[j] = list(prefs)
+        if college_capacities is not None:
+            self.college_capacities = [int(q) for q in college_capacities]
+        # the moves the tree pruned depend on the matching, which the change may have changed
+        if self.prune_actions:
+            self.tree = None
+        return self.num_invalidated
+
+    def solve(self, num_rollouts=None, time_limit=None, max_da_evaluations=None, incumbent_callback=None,
+              should_stop=None):
+        # returns the result and log of uct_iterative, run for 1000 rollouts per seat unless num_rollouts is given
+        print('==========Run UCT Iterative-tree ({})=========='.format('resumed' if self.tree is not None else 'new'))
+        st_time = time.time()
+        # the limits of a solve count its own DA runs
+        self.da.hits = 0
+        self.da.misses = 0
+        ceiling = [self.college_capacities[j] + min(self.college_budgets[j], self.budget)
+                   for j in range(len(self.college_capacities))]
+        _, da_state, _ = self.da.da.run_from(None, ceiling)
+        original_matches, _, original_cost = self.da.run(self.college_capacities)
+        envied = self.da.envied_colleges(original_matches) if self.prune_actions else None
+        game = CapacityExpansionGame(self.da, self.student_prefs, self.college_prefs, self.college_capacities,
+                                     self.budget, self.college_budgets, original_cost, [], False, da_state, envied)
+        if self.tree is None:
+            self.tree = UCT(exploration_weight=np.sqrt(0.002))
+        else:
+            self.tree.restart(game)
+
+        log, _ = run_rollouts(self.tree, game, self.da, 1000 * self.budget if num_rollouts is None else num_rollouts,
+                              1, time_limit, max_da_evaluations, incumbent_callback, should_stop)
+        candidates = [self.tree.best_capacities] if self.tree.best_capacities is not None else []
+        if self.best_extra is not None:
+            candidates.append([q + t for q, t in zip(self.college_capacities, self.best_extra)])
+        if len(candidates) == 0:
+            candidates.append(list(self.college_capacities))
+        costs = self.da.run_batch(candidates, base_state=da_state)
+        best_expanded_capacities = [int(q) for q in candidates[int(np.argmin(costs))]]
+        best_cost = float(np.min(costs))
+        self.best_extra = [q - p for q, p in zip(best_expanded_capacities, self.college_capacities)]
+        run_time = time.time() - st_time
+        print('run time={}'.format(run_time))
+        print('Total cost for expanded capacities {}: {}'.format(best_expanded_capacities, best_cost))
+
+        return {
+            'expanded_capacities': best_expanded_capacities,
+            'best_cost': best_cost,
+            'run_time': run_time,
+            'da_evaluations': self.da.misses,
+            'invalidated': self.num_invalidated
+        }, log
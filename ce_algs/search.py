@@ -0,0 +1,272 @@
+import multiprocessing
+import numpy as np
+import random
+import time
+
+from collections import defaultdict
+from ca_algs.da_cache import DACache
+
+
+def run_rollouts(tree, game, da, num_rollouts, leaf_batch_size=1, time_limit=None, max_da_evaluations=None,
+                 incumbent_callback=None, should_stop=None, profiler=None):
+    "Run up to `num_rollouts` rollouts from `game`, `leaf_batch_size` leaves at a time; returns the log and run time"
+    # The search also stops after `time_limit` seconds or `max_da_evaluations` DA runs (cache misses), and calls
+    # `incumbent_callback(elapsed, best_cost, expanded_capacities)` whenever the best terminal state improves. It also
+    # stops as soon as `should_stop()` returns True, e.g. once an exact solver proves the best cost optimal. With a
+    # profiler (see ce_algs.profiler), the log also gets its phase times and counts after every rollout.
+    if profiler is not None:
+        profiler.attach(tree, da)
+    log = defaultdict(list)
+    best_reported = -np.inf
+    st_time = time.time()
+    for i in range(0, num_rollouts, leaf_batch_size):
+        if i % 100 < leaf_batch_size:
+            print('Run {}-th rollout'.format(i))
+        if tree.is_fully_explored(game):
+            print('Fully explored! Terminate rollout')
+            break
+        if _out_of_budget(st_time, time_limit, da.misses, max_da_evaluations, should_stop):
+            break
+        batch_size = min(leaf_batch_size, num_rollouts - i)
+        if batch_size == 1:
+            tree.do_rollout(game)
+        else:
+            tree.do_rollout_batch(game, batch_size)
+        for _ in range(batch_size):
+            log['reward'].append(tree.best_history_reward)
+            log['run_time'].append(time.time() - st_time)
+            log['cache_hits'].append(da.hits)
+            log['cache_misses'].append(da.misses)
+            log['peak_nodes'].append(tree.peak_nodes())
+            if profiler is not None:
+                profiler.record(log)
+        if incumbent_callback is not None and best_reported < tree.best_history_reward:
+            best_reported = tree.best_history_reward
+            _, _, best_cost = da.run(tree.best_capacities)
+            incumbent_callback(time.time() - st_time, best_cost, tree.best_capacities)
+    return log, time.time() - st_time
+
+
+def run_search(make_search, num_rollouts, leaf_batch_size=1, num_workers=1, parallel='leaf', sync_interval=100,
+               time_limit=None, max_da_evaluations=None, incumbent_callback=None, should_stop=None, profiler=None):
+    "Run the search `make_search(da_workers)` builds; returns the best capacities, log, run time and worker throughputs"
+    # With several workers, parallel='leaf' scores batches of at least `num_workers` selected leaves on a process
+    # pool (virtual loss keeps the selections apart), and parallel='root' grows one independent tree per worker whose
+    # root statistics are merged every `sync_interval` rollouts per worker. A profiler only instruments a search on
+    # one worker.
+    if parallel not in ['leaf', 'root']:
+        raise ValueError('unknown parallel strategy: {}'.format(parallel))
+    if profiler is not None and num_workers > 1:
+        raise ValueError('a profiled search runs on one worker')
+    if num_workers > 1 and parallel == 'root':
+        return _run_root_parallel(make_search, num_rollouts, num_workers, sync_interval, time_limit,
+                                  max_da_evaluations, incumbent_callback, should_stop)
+    if num_workers == 1:
+        tree, game, da = make_search(1)
+        log, run_time = run_rollouts(tree, game, da, num_rollouts, leaf_batch_size, time_limit, max_da_evaluations,
+                                     incumbent_callback, should_stop, profiler)
+        return tree.best_capacities, log, run_time, [_per_sec(len(log['reward']), run_time)]
+    tree, game, da = make_search(num_workers)
+    try:
+        log, run_time = run_rollouts(tree, game, da, num_rollouts, max(leaf_batch_size, num_workers), time_limit,
+                                     max_da_evaluations, incumbent_callback, should_stop)
+    finally:
+        da.da.close()
+    # every cache miss of the search is a rollout scored by one of the workers
+    throughput = [_per_sec(n, run_time) for n in da.da.worker_evaluations.values()]
+    return tree.best_capacities, log, run_time, throughput
+
+
+def sweep_da(da, college_capacities, budget, college_budgets, cache_bytes):
+    "Returns the DA cache, the DA state at the ceiling of `budget` and the current matching and cost a sweep shares"
+    ceiling = [college_capacities[j] + min(college_budgets[j], budget) for j in range(len(college_capacities))]
+    _, da_state, _ = da.run_from(None, ceiling)
+    da = DACache(da, max_bytes=cache_bytes)
+    original_matches, _, original_cost = da.run(college_capacities)
+    return da, da_state, original_matches, original_cost
+
+
+def run_sweep(make_search, budget, college_capacities, college_budgets, time_limit=None, max_da_evaluations=None,
+              incumbent_callback=None, should_stop=None, profiler=None):
+    "Search the budgets 1, ..., `budget` in turn; returns the result of `budget`, with the cost of every budget, and log"
+    # make_search(b, tree) returns the tree, game and DA cache of budget b given the tree of budget b - 1, which it
+    # deepens by a seat where the moves of the tree do not depend on the budget, and all budgets share the DA cache.
+    # Every budget adds the 1000 rollouts per seat a single search gets for the seat it adds, so the sweep costs as
+    # many rollouts as the search of `budget` alone. The best allocation of budget b - 1 plus its best extra seat
+    # (scored by repairing the matching at the ceiling of the game) also competes for budget b. time_limit and
+    # max_da_evaluations apply to every budget, and a profiler adds up the searches of all budgets.
+    log = defaultdict(list)
+    tree = None
+    best_capacities = None
+    budget_capacities = []
+    budget_costs = []
+    budget_run_times = []
+    num_rollouts = 0
+    st_time = time.time()
+    for b in range(1, budget + 1):
+        tree, game, da = make_search(b, tree)
+        budget_log, run_time = run_rollouts(tree, game, da, 1000, 1, time_limit, max_da_evaluations,
+                                            incumbent_callback, should_stop, profiler)
+        for key, values in budget_log.items():
+            log[key].extend(values)
+        log['budget'].extend([b] * len(budget_log['reward']))
+        num_rollouts += len(budget_log['reward'])
+        candidates = [tree.best_capacities] if tree.best_capacities is not None else []
+        if best_capacities is not None:
+            for j in range(len(college_capacities)):
+                if best_capacities[j] - college_capacities[j] < min(college_budgets[j], b):
+                    candidates.append([q + (k == j) for k, q in enumerate(best_capacities)])
+        if len(candidates) == 0:
+            candidates.append([q for q in college_capacities])
+        costs = da.run_batch(candidates, base_state=game.da_state)
+        best_capacities = [int(q) for q in candidates[int(np.argmin(costs))]]
+        budget_capacities.append(best_capacities)
+        budget_costs.append(float(np.min(costs)))
+        budget_run_times.append(run_time)
+        print('Budget {}: total cost for expanded capacities {}: {}'.format(b, best_capacities, budget_costs[-1]))
+    run_time = time.time() - st_time
+    result = {
+        'expanded_capacities': best_capacities,
+        'best_cost': budget_costs[-1],
+        'run_time': run_time,
+        'worker_rollouts_per_sec': [_per_sec(num_rollouts, run_time)],
+        'budget_costs': budget_costs,
+        'budget_capacities': budget_capacities,
+        'budget_run_times': budget_run_times,
+        'da_evaluations': da.misses
+    }
+    if profiler is not None:
+        result['profile'] = profiler.summary()
+    return result, log
+
+
+def _out_of_budget(st_time, time_limit, num_da_evaluations, max_da_evaluations, should_stop=None):
+    if time_limit is not None and time.time() - st_time >= time_limit:
+        print('Reached time limit! Terminate rollout')
+        return True
+    if max_da_evaluations is not None and num_da_evaluations >= max_da_evaluations:
+        print('Reached DA evaluation limit! Terminate rollout')
+        return True
+    if should_stop is not None and should_stop():
+        print('Stopped by the caller! Terminate rollout')
+        return True
+    return False
+
+
+def _per_sec(count, run_time):
+    return count / run_time if run_time > 0 else 0.0
+
+
+def _root_stats(tree, game, external):
+    stats = {}
+    for key, (N, Q) in tree.root_visits(game).items():
+        external_N, external_Q = external.get(key, (0, 0))
+        stats[key] = (N - external_N, Q - external_Q)
+    return stats
+
+
+def _apply_external(tree, game, external, others):
+    # Add the other trees' visits of every root child on top of this tree's own, replacing what the previous merge
+    # added. Only the root level is shared; the subtrees below stay private to each worker.
+    for key in tree.root_visits(game):
+        old_N, old_Q = external.get(key, (0, 0))
+        new_N, new_Q = others.get(key, (0, 0))
+        tree.add_root_visits(game, key, new_N - old_N, new_Q - old_Q)
+        external[key] = (new_N, new_Q)
+
+
+def _root_worker(make_search, seed, conn):
+    random.seed(seed)
+    np.random.seed(seed)
+    tree, game, da = make_search(1)
+    external = {}
+    best_cost = np.inf
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        num_rollouts, others, deadline = message
+        _apply_external(tree, game, external, others)
+        num_done = 0
+        while num_done < num_rollouts and not tree.is_fully_explored(game):
+            if deadline is not None and time.time() >= deadline:
+                break
+            tree.do_rollout(game)
+            num_done += 1
+        if tree.best_capacities is not None:
+            _, _, best_cost = da.run(tree.best_capacities)
+        conn.send((_root_stats(tree, game, external), tree.best_capacities, tree.best_history_reward, best_cost,
+                   num_done, da.misses, tree.is_fully_explored(game), tree.peak_nodes()))
+    conn.close()
+
+
+def _run_root_parallel(make_search, num_rollouts, num_workers, sync_interval, time_limit, max_da_evaluations,
+                       incumbent_callback, should_stop=None):
+    conns = []
+    workers = []
+    for k in range(num_workers):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        worker = multiprocessing.Process(target=_root_worker,
+                                         args=(make_search, np.random.randint(0, 2 ** 31), child_conn))
+        worker.start()
+        conns.append(parent_conn)
+        workers.append(worker)
+
+    log = defaultdict(list)
+    stats = [{} for _ in range(num_workers)]
+    worker_rollouts = [0 for _ in range(num_workers)]
+    worker_da_evaluations = [0 for _ in range(num_workers)]
+    worker_peak_nodes = [0 for _ in range(num_workers)]
+    best_capacities = None
+    best_history_reward = -np.inf
+    best_cost = np.inf
+    total_rollouts = 0
+    st_time = time.time()
+    deadline = st_time + time_limit if time_limit is not None else None
+    try:
+        while total_rollouts < num_rollouts:
+            print('Run {}-th rollout'.format(total_rollouts))
+            if _out_of_budget(st_time, time_limit, sum(worker_da_evaluations), max_da_evaluations, should_stop):
+                break
+            num_remaining = num_rollouts - total_rollouts
+            for k in range(num_workers):
+                num_round = min(sync_interval, num_remaining // num_workers + (k < num_remaining % num_workers))
+                others = defaultdict(lambda: (0, 0))
+                for j in range(num_workers):
+                    if j == k:
+                        continue
+                    for key, (N, Q) in stats[j].items():
+                        others[key] = (others[key][0] + N, others[key][1] + Q)
+                conns[k].send((num_round, dict(others), deadline))
+            fully_explored = False
+            improved = False
+            for k in range(num_workers):
+                (stats[k], capacities, reward, cost, num_done, worker_da_evaluations[k], explored,
+                 worker_peak_nodes[k]) = conns[k].recv()
+                if best_history_reward < reward:
+                    best_history_reward = reward
+                    best_cost = cost
+                    best_capacities = capacities
+                    improved = True
+                worker_rollouts[k] += num_done
+                total_rollouts += num_done
+                fully_explored = fully_explored or explored
+            run_time = time.time() - st_time
+            log['reward'].append(best_history_reward)
+            log['run_time'].append(run_time)
+            log['num_rollouts'].append(total_rollouts)
+            log['peak_nodes'].append(sum(worker_peak_nodes))
+            for k in range(num_workers):
+                log['worker{}_rollouts_per_sec'.format(k)].append(_per_sec(worker_rollouts[k], run_time))
+            if improved and incumbent_callback is not None:
+                incumbent_callback(run_time, best_cost, best_capacities)
+            if fully_explored:
+                print('Fully explored! Terminate rollout')
+                break
+    finally:
+        for conn in conns:
+            conn.send(None)
+        for worker in workers:
+            worker.join()
+    run_time = time.time() - st_time
+    return best_capacities, log, run_time, [_per_sec(n, run_time) for n in worker_rollouts]
@@ -0,0 +1,108 @@
+import numpy as np
+
+# dtype and initial value of every per-node array
+STAT_FIELDS = {
+    'N': (np.int64, 0),
+    'Q': (np.float64, 0.0),
+    'best_reward': (np.float64, np.nan),
+    'fully_explored': (np.bool_, False),
+    'num_children': (np.int32, 0),
+    'num_explored_children': (np.int32, 0),
+}
+TREE_FIELDS = {
+    'terminal': (np.bool_, False),
+    'parent': (np.int32, -1),
+    'move': (np.int32, -1),
+    'first_child': (np.int32, -1),
+    'num_selected_children': (np.int32, 0),
+}
+
+
+class NodeStore(object):
+    # Search node statistics kept as one preallocated NumPy array per statistic instead of attributes of one game
+    # object per node; a node is an index into the arrays. best_reward is nan until a node is fully explored and
+    # num_explored_children counts the children that are, so that full exploration is detected by comparing it with
+    # num_children instead of rescanning them. The arrays double in size whenever they run out of room. Released
+    # nodes are reset to the initial values and their ids handed out again by add_node before the arrays grow.
+    fields = STAT_FIELDS
+
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self.capacity = capacity
+        self.free_ids = []
+        for name, (dtype, fill) in self.fields.items():
+            setattr(self, name, np.full(capacity, fill, dtype=dtype))
+
+    def add_nodes(self, num_nodes):
+        self._reserve(num_nodes)
+        start = self.size
+        self.size += num_nodes
+        return start, self.size
+
+    def add_node(self):
+        if len(self.free_ids) > 0:
+            return self.free_ids.pop()
+        start, _ = self.add_nodes(1)
+        return start
+
+    def release(self, ids):
+        for name, (_, fill) in self.fields.items():
+            getattr(self, name)[ids] = fill
+        self.free_ids.extend(ids)
+
+    def num_nodes(self):
+        return self.size - len(self.free_ids)
+
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.fields)
+
+    def bytes_per_node(self):
+        return self.nbytes() / self.size if self.size > 0 else 0.0
+
+    def _reserve(self, num_nodes):
+        if self.size + num_nodes <= self.capacity:
+            return
+        capacity = self.capacity
+        while capacity < self.size + num_nodes:
+            capacity *= 2
+        for name, (dtype, fill) in self.fields.items():
+            array = np.full(capacity, fill, dtype=dtype)
+            array[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, array)
+        self.capacity = capacity
+
+
+class TreeStore(NodeStore):
+    # NodeStore for a tree. Node 0 is the root. The children of a node are allocated together when it is expanded,
+    # so they occupy the ids first_child[v], ..., first_child[v] + num_children[v] - 1, and move[c] is the action
+    # that leads from parent[c] to c. first_child is -1 until a node is expanded. Children are selected for the
+    # first time in id order, and num_selected_children[v] counts those that have been.
+    fields = dict(STAT_FIELDS, **TREE_FIELDS)
+
+    def add_root(self, terminal):
+        self.add_nodes(1)
+        self.terminal[0] = terminal
+        return 0
+
+    def add_children(self, node, moves, terminal):
+        start, stop = self.add_nodes(len(moves))
+        self.parent[start:stop] = node
+        self.move[start:stop] = moves
+        self.terminal[start:stop] = terminal
+        self.first_child[node] = start
+        self.num_children[node] = stop - start
+        return start, stop
+
+    def is_expanded(self, node):
+        return self.first_child[node] >= 0
+
+    def children(self, node):
+        start = self.first_child.item(node)
+        return start, start + self.num_children.item(node)
+
+    def history(self, node):
+        moves = []
+        while node > 0:
+            moves.append(int(self.move[node]))
+            node = self.parent[node]
+        return moves[::-1]
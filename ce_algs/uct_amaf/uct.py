@@ -1,17 +1,38 @@
+import math
 import numpy as np
-import time
 
-from collections import defaultdict
-from ca_algs.deferred_acceptance import DeferredAcceptance
+from functools import partial
+from ca_algs.da_cache import DACache
+from ca_algs.da_pool import DAPool
+from ca_algs.deferred_acceptance import make_deferred_acceptance
+from ce_algs.profiler import Profiler
+from ce_algs.search import run_search, run_sweep, sweep_da
+from ce_algs.tree_store import NodeStore
 from ce_algs.uct_amaf.capacity_expansion_game import CapacityExpansionGame
 
 
 class UCTAMAF:
-    def __init__(self, depth, exploration_weight=1):
+    # Node statistics live in a NodeStore, indexed by the `id` a node gets when it is added to node_map, and
+    # nodes[id] is the node itself. An expanded node keeps the ids of its children in `child_ids` so that they can be
+    # scored together, and every node the ids of its parents in `parent_ids`.
+    #
+    # With `max_nodes` set, a rollout that leaves more nodes than that in node_map evicts nodes until a tenth of the
+    # budget is free again, and their ids are reused. Fully explored nodes are collapsed first: all that is needed
+    # of them is their best_reward, so they drop their children, and the children no other node leads to are
+    # removed. If that is not enough, the nodes with the fewest visits, unexpanded leaves first among equals, are
+    # removed from their parents together with the descendants no other node leads to. Such a parent keeps counting
+    # the evicted children in num_children, so it is not taken for fully explored, and the next selection that
+    # passes through it adds them back, without their statistics.
+    def __init__(self, depth, exploration_weight=1, max_nodes=None):
         self.exploration_weight = exploration_weight
         self.node_map = [dict() for _ in range(depth + 1)]
         self.best_history = None
         self.best_history_reward = -np.inf
+        self.best_capacities = None
+        self.store = NodeStore()
+        self.nodes = []
+        self.max_nodes = max_nodes
+        self.peak = 0
 
     def choose(self, node):
         "Choose the best successor of node. (Choose a move in the game)"
@@ -21,153 +42,344 @@ class UCTAMAF:
         if node.children is None:
             return node.find_random_child()
 
-        def score(n):
-            if n.fully_explored:
-                return n.best_reward
-            if n.N == 0:
-                return float("-inf")  # avoid unseen moves
-            return n.Q / n.N  # average reward
-
-        return max(node.children, key=score)
+        store = self.store
+        N = store.N[node.child_ids]
+        # average reward, avoiding unseen moves
+        score = np.divide(store.Q[node.child_ids], N, out=np.full(len(N), -np.inf), where=N > 0)
+        score = np.where(store.fully_explored[node.child_ids], store.best_reward[node.child_ids], score)
+        return node.children[int(np.argmax(score))]
 
     def do_rollout(self, node):
         "Make the tree one layer better. (Train for one iteration.)"
+        self._register(node)
         path = self._select(node)
         leaf = path[-1]
         self._expand(leaf)
         reward = self._simulate(leaf)
         self._backpropagate(path, reward)
+        self._enforce_budget()
+
+    def do_rollout_batch(self, node, batch_size):
+        "Run `batch_size` rollouts at once, scoring all of their terminal states in one batched DA call."
+        self._register(node)
+        paths = []
+        playouts = []
+        for _ in range(batch_size):
+            path = self._select(node)
+            leaf = path[-1]
+            self._expand(leaf)
+            # virtual loss: count the visit before its reward is known so that the next selections spread out
+            self.store.N[[n.id for n in path]] += 1
+            paths.append(path)
+            playouts.append(leaf.random_playout())
+        rewards = self._batch_reward(node, [capacities for _, capacities in playouts])
+        for path, (history, capacities), reward in zip(paths, playouts, rewards):
+            self.store.N[[n.id for n in path]] -= 1
+            self._record(history, capacities, reward)
+            self._backpropagate(path, reward)
+        self._enforce_budget()
+
+    def is_fully_explored(self, game):
+        "Whether every terminal state below root `game` has been found"
+        return game.id is not None and bool(self.store.fully_explored[game.id])
+
+    def num_nodes(self):
+        "Number of nodes in node_map"
+        return self.store.num_nodes()
+
+    def peak_nodes(self):
+        "Largest number of nodes node_map has held"
+        return self.peak
+
+    def root_visits(self, game):
+        "Returns the visit count and total reward of every child of root `game`, keyed by its history"
+        if game.children is None:
+            return {}
+        return {tuple(n.history): (int(self.store.N[n.id]), float(self.store.Q[n.id])) for n in game.children}
+
+    def add_root_visits(self, game, history, N, Q):
+        "Add `N` visits with total reward `Q` to the child of root `game` reached by `history`, and to the root"
+        for n in game.children:
+            if tuple(n.history) == tuple(history):
+                self.store.N[[game.id, n.id]] += N
+                self.store.Q[[game.id, n.id]] += Q
+
+    def _register(self, node):
+        "Give `node` a slot in the store and add it to node_map"
+        if node.id is None:
+            node.id = self.store.add_node()
+            if node.id < len(self.nodes):
+                self.nodes[node.id] = node
+            else:
+                self.nodes.append(node)
+            self.node_map[len(node.history)][node.history] = node
+            self.peak = max(self.peak, self.store.num_nodes())
+
+    def _enforce_budget(self):
+        "Evict nodes until node_map is back under the node budget"
+        if self.max_nodes is None or self.store.num_nodes() <= self.max_nodes:
+            return
+        target = self.max_nodes - self.max_nodes // 10
+        store = self.store
+        for node in self.nodes:
+            if node is not None and node.children and store.fully_explored[node.id]:
+                self._collapse(node)
+        if store.num_nodes() <= target:
+            return
+        candidates = [node for node in self.nodes if node is not None and node.parent_ids]
+        expanded = [bool(node.children) for node in candidates]
+        for i in np.lexsort((expanded, store.N[[node.id for node in candidates]])):
+            if store.num_nodes() <= target:
+                break
+            # a candidate may have gone with the subtree of one evicted before it
+            if candidates[i].id is not None:
+                self._evict(candidates[i])
+
+    def _evict(self, node):
+        "Remove `node` from its parents, along with the descendants that no other node leads to"
+        store = self.store
+        for parent_id in node.parent_ids:
+            parent = self.nodes[parent_id]
+            parent.children = [n for n in parent.children if n is not node]
+            parent.child_ids = np.array([n.id for n in parent.children], dtype=np.int64)
+            # the parent counts it again once it is added back and explored
+            if store.fully_explored[node.id]:
+                store.num_explored_children[parent_id] -= 1
+        if node.children:
+            self._collapse(node)
+        self._remove(node)
+
+    def _collapse(self, node):
+        "Drop the children of `node`, removing those that no other node leads to"
+        for child in node.children:
+            child.parent_ids.remove(node.id)
+            if len(child.parent_ids) == 0:
+                if child.children:
+                    self._collapse(child)
+                self._remove(child)
+        node.children = []
+        node.child_ids = np.array([], dtype=np.int64)
+
+    def _remove(self, node):
+        "Take `node` out of node_map and release its slot"
+        del self.node_map[len(node.history)][node.history]
+        self.nodes[node.id] = None
+        self.store.release([node.id])
+        node.id = None
+        node.parent_ids = []
 
     def _select(self, node):
         "Find an unexplored descendent of `node`"
         path = []
         while True:
             path.append(node)
-            if node.children is None or node.terminal:
-                # node is either unexplored or terminal
+            if node.children is not None and len(node.children) < self.store.num_children[node.id] \
+                    and not self.store.fully_explored[node.id]:
+                self._refill(node)
+            if not node.children:
+                # node is either unexplored, terminal or collapsed
                 return path
             # explore first the child node that has never been explored
-            unexplored = {nd for nd in node.children if nd.N == 0}
-            if unexplored:
-                n = unexplored.pop()
-                path.append(n)
+            N = self.store.N[node.child_ids]
+            unexplored = int(N.argmin()) if len(N) > 0 else 0
+            if len(N) > 0 and N[unexplored] == 0:
+                path.append(node.children[unexplored])
                 return path
             # if all child nodes have been explored once, the child node is selected according to UCB values
             node = self._uct_select(node)  # descend a layer deeper
 
     def _expand(self, node):
-        "Update the `children` dict with the children of `node`"
+        "Update the `children` list with the children of `node`"
         if node.children is not None:
             return  # already expanded
-        # node.children = node.find_children()
-        node.children = node.find_children(self.node_map)
-        for n in node.children:
-            n.parents.add(node)
-            self.node_map[len(n.history)][n.history] = n
+        children = list(node.find_children(self.node_map))
+        for n in children:
+            self._register(n)
+            n.parent_ids.append(node.id)
+        node.children = children
+        node.child_ids = np.array([n.id for n in children], dtype=np.int64)
+        self.store.num_children[node.id] = len(children)
+        # children shared with another parent may already be fully explored
+        self.store.num_explored_children[node.id] = np.count_nonzero(self.store.fully_explored[node.child_ids])
+
+    def _refill(self, node):
+        "Add back the children of `node` that were evicted"
+        kept = {n.history for n in node.children}
+        children = [n for n in node.find_children(self.node_map) if n.history not in kept]
+        for n in children:
+            self._register(n)
+            n.parent_ids.append(node.id)
+        node.children.extend(children)
+        node.child_ids = np.array([n.id for n in node.children], dtype=np.int64)
+        self.store.num_explored_children[node.id] += np.count_nonzero(
+            self.store.fully_explored[[n.id for n in children]])
 
     def _simulate(self, node):
         "Returns the reward for a random simulation (to completion) of `node`"
-        while True:
-            if node.is_terminal():
-                reward = node.reward()
-                if self.best_history_reward < reward:
-                    self.best_history_reward = reward
-                    self.best_history = node.history
-                return reward
-            node = node.find_random_child()
+        history, capacities = node.random_playout()
+        reward = node.score(capacities)
+        self._record(history, capacities, reward)
+        return reward
+
+    def _record(self, history, capacities, reward):
+        "Keep track of the best terminal state found so far"
+        if self.best_history_reward < reward:
+            self.best_history_reward = reward
+            self.best_history = history
+            self.best_capacities = capacities
+
+    def _batch_reward(self, game, capacity_matrix):
+        "Returns the rewards of the terminal capacities of `game`, evaluated in one batched DA call"
+        total_costs = game.da.run_batch(capacity_matrix, base_state=game.da_state)
+        return [(game.base_cost - total_cost) / game.base_cost for total_cost in total_costs]
 
     def _backpropagate(self, path, reward):
         "Send the reward back up to the ancestors of the leaf"
+        store = self.store
         for node in reversed(path):
-            node.N += 1
-            node.Q += reward
-            fully_explored = True
-            for n in node.children:
-                fully_explored = fully_explored & n.fully_explored
-                if not fully_explored:
-                    break
-            if fully_explored:
-                node.fully_explored = True
-                if len(node.children) == 0:
-                    node.best_reward = reward
-                else:
-                    node.best_reward = max(node.children, key=lambda n: n.best_reward).best_reward
-        # print('ba')
-        self._rec_backpropagate({path[-1]: 1}, reward)
-
-    def _rec_backpropagate(self, counter, reward):
-        for node, count in counter.items():
-            # print('update node', node.history, count)
-            self._update_node(node, reward, count)
-        parent_counter = defaultdict(int)
-        for node, count in counter.items():
-            for parent in node.parents:
-                parent_counter[parent] += count
-        if len(parent_counter) > 0:
-            self._rec_backpropagate(parent_counter, reward)
-
-    def _update_node(self, node, reward, count):
-        node.N += count
-        node.Q += reward * count
-        fully_explored = True
-        for n in node.children:
-            fully_explored = fully_explored & n.fully_explored
-            if not fully_explored:
-                break
-        if fully_explored:
-            node.fully_explored = True
-            if len(node.children) == 0:
-                node.best_reward = reward
-            else:
-                node.best_reward = max(node.children, key=lambda n: n.best_reward).best_reward
+            store.N[node.id] += 1
+            store.Q[node.id] += reward
+            if not store.fully_explored[node.id] and store.num_explored_children[node.id] == store.num_children[node.id]:
+                self._mark_explored(node, reward)
+        # Every ancestor of the leaf, the leaf included, also gets one visit for each path that leads from it to the
+        # leaf. All parents of a node are one move shorter, so one sweep up from the leaf's layer reaches every
+        # ancestor exactly once, with the path counts of a layer summed into its parents on the way.
+        counts = {path[-1].id: 1}
+        while len(counts) > 0:
+            ids = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            layer_counts = np.fromiter(counts.values(), dtype=np.int64, count=len(counts))
+            store.N[ids] += layer_counts
+            store.Q[ids] += reward * layer_counts
+            explored = ids[~store.fully_explored[ids] & (store.num_explored_children[ids] == store.num_children[ids])]
+            for i in explored:
+                self._mark_explored(self.nodes[i], reward)
+            parent_counts = {}
+            for i, count in counts.items():
+                for parent_id in self.nodes[i].parent_ids:
+                    parent_counts[parent_id] = parent_counts.get(parent_id, 0) + count
+            counts = parent_counts
+
+    def _mark_explored(self, node, reward):
+        # a node is fully explored once all of its children are, which they report to their parents when they
+        # become so
+        store = self.store
+        store.fully_explored[node.id] = True
+        if store.num_children[node.id] == 0:
+            store.best_reward[node.id] = reward
+        else:
+            store.best_reward[node.id] = store.best_reward[node.child_ids].max()
+        store.num_explored_children[node.parent_ids] += 1
 
     def _uct_select(self, node):
         "Select a child of node, balancing exploration & exploitation"
-        log_N_vertex = np.log(node.N)
-
-        def uct(n):
-            "Upper confidence bound for trees"
-            return (n.Q / n.N + self.exploration_weight * np.sqrt(log_N_vertex / n.N)) * (1 - n.fully_explored)
+        store = self.store
+        N = store.N[node.child_ids]
+        # upper confidence bound for trees
+        uct = store.Q[node.child_ids] / N + self.exploration_weight * np.sqrt(math.log(store.N[node.id]) / N)
+        uct[store.fully_explored[node.child_ids]] = 0
+        return node.children[int(uct.argmax())]
 
-        return max(node.children, key=uct)
 
+def uct_amaf(student_prefs, college_prefs, college_capacities, budget, college_budgets, **kwargs):
+    return _uct_amaf(student_prefs, college_prefs, college_capacities, budget, college_budgets, UCTAMAF, **kwargs)
 
-def uct_amaf(student_prefs, college_prefs, college_capacities, budget, college_budgets):
-    return _uct_amaf(student_prefs, college_prefs, college_capacities, budget, college_budgets, UCTAMAF)
 
-
-def _uct_amaf(student_prefs, college_prefs, college_capacities, budget, college_budgets, alg):
+def _uct_amaf(student_prefs, college_prefs, college_capacities, budget, college_budgets, alg,
+              cache_bytes=2 ** 28, leaf_batch_size=1, num_workers=1, parallel='leaf', sync_interval=100,
+              time_limit=None, max_da_evaluations=None, incumbent_callback=None, prune_actions=False,
+              max_nodes=None, da_arrays=None, should_stop=None, sweep=False, profile=False):
     print('==========Run UCT AMAF==========')
-    da = DeferredAcceptance(student_prefs, college_prefs)
-    _, _, original_cost = da.run(college_capacities)
-    tree = alg(budget, exploration_weight=np.sqrt(0.002))
-    game = CapacityExpansionGame(da, student_prefs, college_prefs, college_capacities, budget, college_budgets,
-                                 original_cost, [], False)
-    tree.node_map[0][tuple([])] = game
+    da = make_deferred_acceptance(student_prefs, college_prefs, da_arrays)
+    profiler = Profiler() if profile else None
+    if sweep:
+        if num_workers > 1:
+            raise ValueError('a budget sweep searches on one worker')
+        shared = sweep_da(da, college_capacities, budget, college_budgets, cache_bytes)
+        make_search = partial(_make_sweep_search, shared, student_prefs, college_prefs, college_capacities,
+                              college_budgets, alg, prune_actions, max_nodes)
+        return run_sweep(make_search, budget, college_capacities, college_budgets, time_limit, max_da_evaluations,
+                         incumbent_callback, should_stop, profiler)
+    make_search = partial(_make_search, da, student_prefs, college_prefs, college_capacities, budget, college_budgets,
+                          alg, cache_bytes, prune_actions, max_nodes)
 
     # run rollout
-    log = defaultdict(list)
-    st_time = time.time()
-    for i in range(1000 * budget):
-        if i % 100 == 0:
-            print('Run {}-th rollout'.format(i))
-        if game.fully_explored:
-            print('Fully explored! Terminate rollout')
-            break
-        tree.do_rollout(game)
-        log['reward'].append(tree.best_history_reward)
-        log['run_time'].append(time.time() - st_time)
-
-    run_time = time.time() - st_time
-    best_expanded_capacities = [college_capacities[j] for j in range(len(college_prefs))]
-    for idx in tree.best_history:
-        best_expanded_capacities[idx] += 1
+    best_capacities, log, run_time, throughput = run_search(make_search, 1000 * budget, leaf_batch_size, num_workers,
+                                                            parallel, sync_interval, time_limit, max_da_evaluations,
+                                                            incumbent_callback, should_stop, profiler)
+    # fall back to the current capacities if the search stopped before its first rollout
+    best_expanded_capacities = best_capacities if best_capacities is not None else [j for j in college_capacities]
     _, _, best_cost = da.run(best_expanded_capacities)
     print('run time={}'.format(run_time))
     print('Total cost for expanded capacities {}: {}'.format(best_expanded_capacities, best_cost))
+    peak_nodes = max(log['peak_nodes'], default=1)
+    print('peak nodes={}'.format(peak_nodes))
 
-    return {
+    result = {
         'expanded_capacities': best_expanded_capacities,
         'best_cost': best_cost,
-        'run_time': run_time
-    }, log
+        'run_time': run_time,
+        'worker_rollouts_per_sec': throughput,
+        'peak_nodes': peak_nodes
+    }
+    if profiler is not None:
+        result['profile'] = profiler.summary()
+    return result, log
+
+
+def _make_search(da, student_prefs, college_prefs, college_capacities, budget, college_budgets, alg, cache_bytes,
+                 prune_actions, max_nodes, da_workers):
+    # terminal capacities never exceed this ceiling, so rewards repair its matching instead of rerunning DA
+    ceiling = [college_capacities[j] + min(college_budgets[j], budget) for j in range(len(college_prefs))]
+    _, da_state, _ = da.run_from(None, ceiling)
+    da = DACache(DAPool(da, da_workers, ceiling) if da_workers > 1 else da, max_bytes=cache_bytes)
+    original_matches, _, original_cost = da.run(college_capacities)
+    # colleges nobody envies at the current capacities are never worth a seat (see DeferredAcceptance.envied_colleges)
+    envied = da.envied_colleges(original_matches) if prune_actions else None
+    tree = alg(budget, exploration_weight=np.sqrt(0.002), max_nodes=max_nodes)
+    game = CapacityExpansionGame(da, student_prefs, college_prefs, college_capacities, budget, college_budgets,
+                                 original_cost, [], False, da_state, envied)
+    tree.node_map[0][tuple([])] = game
+    return tree, game, da
+
+
+def _make_sweep_search(shared, student_prefs, college_prefs, college_capacities, college_budgets, alg, prune_actions,
+                       max_nodes, budget, tree):
+    # the nodes of the search graph keep the depth of their game, so every budget starts a new graph
+    da, da_state, original_matches, original_cost = shared
+    envied = da.envied_colleges(original_matches) if prune_actions else None
+    tree = alg(budget, exploration_weight=np.sqrt(0.002), max_nodes=max_nodes)
+    game = CapacityExpansionGame(da, student_prefs, college_prefs, college_capacities, budget, college_budgets,
+                                 original_cost, [], False, da_state, envied)
+    tree.node_map[0][tuple([])] = game
+    return tree, game, da
+
+
+def check_node_budget(num_instances=5, seed=0):
+    # A selection ends at the first child it adds back, so a rollout adds at most the evicted children of one node
+    # and the children of its leaf before the budget is enforced again.
+    import contextlib
+    import os
+    import random
+    rng = np.random.RandomState(seed)
+    for _ in range(num_instances):
+        num_students = rng.randint(20, 100)
+        # search graphs of hundreds of nodes, several times the budget
+        num_colleges = rng.randint(4, 8)
+        budget = rng.randint(3, 5)
+        max_nodes = rng.randint(20, 50)
+        # correlated lists, so that some students miss their first choice
+        student_prefs = np.argsort(0.8 * rng.random(num_colleges) + 0.2 * rng.random((num_students, num_colleges)))
+        college_prefs = [rng.permutation(num_students).tolist() for _ in range(num_colleges)]
+        college_capacities = (rng.multinomial(num_students - num_colleges, np.ones(num_colleges) / num_colleges)
+                              + 1).tolist()
+        random.seed(seed)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            result, _ = uct_amaf(student_prefs.tolist(), college_prefs, college_capacities, budget,
+                                 [budget] * num_colleges, max_nodes=max_nodes)
+        assert result['peak_nodes'] <= max_nodes + 2 * num_colleges, \
+            'peak of {} nodes over a budget of {}'.format(result['peak_nodes'], max_nodes)
+
+
+if __name__ == '__main__':
+    check_node_budget()
+    print('node_map stays within the node budget')
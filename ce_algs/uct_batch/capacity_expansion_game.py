@@ -1,8 +1,10 @@
+import numpy as np
+
 from random import choice
 
 
 class CapacityExpansionGame(object):
-    def __init__(self, da, student_prefs, college_prefs, college_capacities, budget, college_budgets, original_cost, history, terminal, order):
+    def __init__(self, da, student_prefs, college_prefs, college_capacities, budget, college_budgets, original_cost, history, terminal, order, da_state=None, envied=None):
         self.student_prefs = student_prefs
         self.college_prefs = college_prefs
         self.college_capacities = college_capacities
@@ -14,6 +16,7 @@ class CapacityExpansionGame(object):
         self.history = [h for h in history]
         self.terminal = terminal
         self.da = da
+        self.da_state = da_state
         remain_budget = budget - sum(history)
         self.actions = []
         for i in range(budget + 1):
@@ -29,19 +32,21 @@ class CapacityExpansionGame(object):
             if len(history) < self.num_colleges and i > college_budgets[order[len(history)]]:
                 continue
             self.actions.append(i)
-        self.N = 0
-        self.Q = 0
-        self.children = None
-        self.fully_explored = False
-        self.best_reward = None
         self.order = order
+        self.envied = envied
+        self.actions = self._prune(self.actions, len(self.history))
 
-    def find_children(self):
+    def find_actions(self):
         if self.terminal:  # If the game is finished then no moves can be made
-            return set()
-        # Otherwise, you can make a move in each of the empty spots
+            return []
+        if self.envied is not None:
+            self._update_envied()
+        return self.actions
+
+    def find_children(self):
+        # you can make a move in each of the empty spots
         return {
-            self.make_move(i) for i in self.actions
+            self.make_move(i) for i in self.find_actions()
         }
 
     def find_random_child(self):
@@ -49,23 +54,71 @@ class CapacityExpansionGame(object):
             return None  # If the game is finished then no moves can be made
         return self.make_move(choice(self.actions))
 
+    def _prune(self, actions, position):
+        # extra seats at a college nobody envies cannot change the matching, so it only gets the fewest seats that
+        # still let the remaining colleges use up the budget
+        if self.envied is None or position == self.num_colleges or self.envied[self.order[position]]:
+            return actions
+        return actions[:1]
+
+    def _update_envied(self):
+        # refine the inherited mask with the matching at this node's own capacities
+        new_capacities = self.capacities()
+        if self.da_state is None:
+            matches_for_students, _, _ = self.da.run(new_capacities)
+        else:
+            matches_for_students, _, _ = self.da.run_from(self.da_state, new_capacities)
+        self.envied = self.envied & self.da.envied_colleges(matches_for_students)
+        self.actions = self._prune(self.actions, len(self.history))
+
+    def random_playout(self):
+        # Plays the same moves as calling find_random_child until the game ends, drawing from the same random
+        # stream, but without building the intermediate games; returns the final history and capacities
+        history = list(self.history)
+        used = sum(history)
+        # the most seats the colleges from each position of the order on can still take
+        max_remaining = np.append(np.cumsum([self.college_budgets[j] for j in self.order][::-1])[::-1], 0).tolist()
+        while len(history) < self.depth:
+            position = len(history)
+            low = max(0, self.budget - used - max_remaining[position + 1])
+            high = min(self.budget - used, self.college_budgets[self.order[position]])
+            num_seats = choice(self._prune(list(range(low, high + 1)), position))
+            history.append(num_seats)
+            used += num_seats
+        new_capacities = np.array(self.college_capacities)
+        new_capacities[np.asarray(self.order)] += history
+        return history, new_capacities.tolist()
+
+    def capacities(self):
+        new_capacities = [self.college_capacities[j] for j in range(self.num_colleges)]
+        for j, num_seats in zip(self.order, self.history):
+            new_capacities[j] += num_seats
+        return new_capacities
+
     def reward(self):
         if not self.terminal:
             raise RuntimeError(f"reward called on nonterminal board {self}")
-        new_capacities = [self.college_capacities[j] for j in range(self.num_colleges)]
-        for i, j in enumerate(self.order):
-            new_capacities[j] += self.history[i]
-        _, _, total_cost = self.da.run(new_capacities)
+        return self.score(self.capacities())
+
+    def score(self, new_capacities):
+        if self.da_state is None:
+            _, _, total_cost = self.da.run(new_capacities)
+        else:
+            _, _, total_cost = self.da.run_from(self.da_state, new_capacities)
         return (self.base_cost - total_cost) / self.base_cost
 
     def is_terminal(self):
         return self.terminal
 
     def make_move(self, index):
-        history = self.history + [index]
+        return self.play([index])
+
+    def play(self, moves):
+        history = self.history + list(moves)
         is_terminal = len(history) == self.depth
         return CapacityExpansionGame(self.da, self.student_prefs, self.college_prefs, self.college_capacities,
-                                     self.budget, self.college_budgets, self.base_cost, history, is_terminal, self.order)
+                                     self.budget, self.college_budgets, self.base_cost, history, is_terminal, self.order, self.da_state,
+                                     self.envied)
 
     def __hash__(self):
         return hash(tuple(self.history))
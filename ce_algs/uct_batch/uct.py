@@ -1,19 +1,22 @@
 import numpy as np
-import time
 
-from collections import defaultdict
-from ca_algs.deferred_acceptance import DeferredAcceptance
+from functools import partial
+from ca_algs.da_cache import DACache
+from ca_algs.da_pool import DAPool
+from ca_algs.deferred_acceptance import make_deferred_acceptance
+from ce_algs.profiler import Profiler
+from ce_algs.search import run_search, run_sweep, sweep_da
 from ce_algs.uct_batch.capacity_expansion_game import CapacityExpansionGame
 from ce_algs.uct_iterative.uct import UCT
 
 
-def uct_batch(student_prefs, college_prefs, college_capacities, budget, college_budgets):
+def uct_batch(student_prefs, college_prefs, college_capacities, budget, college_budgets, **kwargs):
     def default_order(matches):
         return list(range(len(college_prefs)))
-    return _uct_batch(student_prefs, college_prefs, college_capacities, budget, college_budgets, UCT, default_order)
+    return _uct_batch(student_prefs, college_prefs, college_capacities, budget, college_budgets, UCT, default_order, **kwargs)
 
 
-def uct_batch_envy(student_prefs, college_prefs, college_capacities, budget, college_budgets):
+def uct_batch_envy(student_prefs, college_prefs, college_capacities, budget, college_budgets, **kwargs):
     def envy_order(matches):
         envy = np.zeros(len(college_prefs))
         for i in range(len(student_prefs)):
@@ -23,59 +26,91 @@ def uct_batch_envy(student_prefs, college_prefs, college_capacities, budget, col
                 envy[j] += 1
         order = np.argsort(-envy)
         return order
-    return _uct_batch(student_prefs, college_prefs, college_capacities, budget, college_budgets, UCT, envy_order)
+    return _uct_batch(student_prefs, college_prefs, college_capacities, budget, college_budgets, UCT, envy_order, **kwargs)
 
 
-def uct_batch_popularity(student_prefs, college_prefs, college_capacities, budget, college_budgets):
+def uct_batch_popularity(student_prefs, college_prefs, college_capacities, budget, college_budgets, **kwargs):
     def popularity_order(matches):
         student_scores = np.zeros((len(student_prefs), len(college_prefs)))
         for i in range(len(student_prefs)):
-            for j in range(len(college_prefs)):
-                student_scores[i][student_prefs[i][j]] += j
+            # colleges a truncated list leaves out rank behind all the listed ones
+            student_scores[i] = len(student_prefs[i])
+            for rank, j in enumerate(student_prefs[i]):
+                student_scores[i][j] = rank
         mean_preference = np.mean(student_scores, axis=0)
         order = np.argsort(mean_preference)
         return order
-    return _uct_batch(student_prefs, college_prefs, college_capacities, budget, college_budgets, UCT, popularity_order)
+    return _uct_batch(student_prefs, college_prefs, college_capacities, budget, college_budgets, UCT, popularity_order, **kwargs)
 
 
-def uct_batch_random(student_prefs, college_prefs, college_capacities, budget, college_budgets):
+def uct_batch_random(student_prefs, college_prefs, college_capacities, budget, college_budgets, **kwargs):
     def random_order(matches):
         return np.random.permutation(range(len(college_prefs)))
-    return _uct_batch(student_prefs, college_prefs, college_capacities, budget, college_budgets, UCT, random_order)
+    return _uct_batch(student_prefs, college_prefs, college_capacities, budget, college_budgets, UCT, random_order, **kwargs)
 
 
-def _uct_batch(student_prefs, college_prefs, college_capacities, budget, college_budgets, alg, order_calculator):
+def _uct_batch(student_prefs, college_prefs, college_capacities, budget, college_budgets, alg, order_calculator,
+               cache_bytes=2 ** 28, leaf_batch_size=1, num_workers=1, parallel='leaf', sync_interval=100,
+               time_limit=None, max_da_evaluations=None, incumbent_callback=None, prune_actions=False,
+               da_arrays=None, should_stop=None, sweep=False, profile=False):
     print('==========Run UCT {} Batch-tree=========='.format(order_calculator.__name__))
-    da = DeferredAcceptance(student_prefs, college_prefs)
-    matches, _, original_cost = da.run(college_capacities)
-    tree = alg(exploration_weight=np.sqrt(0.002))
+    da = make_deferred_acceptance(student_prefs, college_prefs, da_arrays)
+    matches, _, _ = da.run(college_capacities)
     order = order_calculator(matches)
-    game = CapacityExpansionGame(da, student_prefs, college_prefs, college_capacities, budget, college_budgets,
-                                 original_cost, [], False, order)
+    profiler = Profiler() if profile else None
+    if sweep:
+        if num_workers > 1:
+            raise ValueError('a budget sweep searches on one worker')
+        shared = sweep_da(da, college_capacities, budget, college_budgets, cache_bytes)
+        make_search = partial(_make_sweep_search, shared, student_prefs, college_prefs, college_capacities,
+                              college_budgets, alg, order, prune_actions)
+        return run_sweep(make_search, budget, college_capacities, college_budgets, time_limit, max_da_evaluations,
+                         incumbent_callback, should_stop, profiler)
+    make_search = partial(_make_search, da, student_prefs, college_prefs, college_capacities, budget, college_budgets,
+                          alg, order, cache_bytes, prune_actions)
 
     # run rollout
-    log = defaultdict(list)
-    st_time = time.time()
-    for i in range(1000 * budget):
-        if i % 100 == 0:
-            print('Run {}-th rollout'.format(i))
-        if game.fully_explored:
-            print('Fully explored! Terminate rollout')
-            break
-        tree.do_rollout(game)
-        log['reward'].append(tree.best_history_reward)
-        log['run_time'].append(time.time() - st_time)
-
-    run_time = time.time() - st_time
-    best_expanded_capacities = [college_capacities[j] for j in range(len(college_prefs))]
-    for i, j in enumerate(order):
-        best_expanded_capacities[j] += tree.best_history[i]
+    best_capacities, log, run_time, throughput = run_search(make_search, 1000 * budget, leaf_batch_size, num_workers,
+                                                            parallel, sync_interval, time_limit, max_da_evaluations,
+                                                            incumbent_callback, should_stop, profiler)
+    # fall back to the current capacities if the search stopped before its first rollout
+    best_expanded_capacities = best_capacities if best_capacities is not None else [j for j in college_capacities]
     _, _, best_cost = da.run(best_expanded_capacities)
     print('run time={}'.format(run_time))
     print('Total cost for expanded capacities {}: {}'.format(best_expanded_capacities, best_cost))
 
-    return {
+    result = {
         'expanded_capacities': best_expanded_capacities,
         'best_cost': best_cost,
-        'run_time': run_time
-    }, log
+        'run_time': run_time,
+        'worker_rollouts_per_sec': throughput
+    }
+    if profiler is not None:
+        result['profile'] = profiler.summary()
+    return result, log
+
+
+def _make_search(da, student_prefs, college_prefs, college_capacities, budget, college_budgets, alg, order,
+                 cache_bytes, prune_actions, da_workers):
+    # terminal capacities never exceed this ceiling, so rewards repair its matching instead of rerunning DA
+    ceiling = [college_capacities[j] + min(college_budgets[j], budget) for j in range(len(college_prefs))]
+    _, da_state, _ = da.run_from(None, ceiling)
+    da = DACache(DAPool(da, da_workers, ceiling) if da_workers > 1 else da, max_bytes=cache_bytes)
+    original_matches, _, original_cost = da.run(college_capacities)
+    # colleges nobody envies at the current capacities are never worth a seat (see DeferredAcceptance.envied_colleges)
+    envied = da.envied_colleges(original_matches) if prune_actions else None
+    tree = alg(exploration_weight=np.sqrt(0.002))
+    game = CapacityExpansionGame(da, student_prefs, college_prefs, college_capacities, budget, college_budgets,
+                                 original_cost, [], False, order, da_state, envied)
+    return tree, game, da
+
+
+def _make_sweep_search(shared, student_prefs, college_prefs, college_capacities, college_budgets, alg, order,
+                       prune_actions, budget, tree):
+    # a level of the tree holds the seats of a college, which range up to the budget, so every budget starts a new tree
+    da, da_state, original_matches, original_cost = shared
+    envied = da.envied_colleges(original_matches) if prune_actions else None
+    tree = alg(exploration_weight=np.sqrt(0.002))
+    game = CapacityExpansionGame(da, student_prefs, college_prefs, college_capacities, budget, college_budgets,
+                                 original_cost, [], False, order, da_state, envied)
+    return tree, game, da
@@ -1,139 +1,285 @@
+import math
 import numpy as np
-import time
 
-from collections import defaultdict
-from ca_algs.deferred_acceptance import DeferredAcceptance
+from functools import partial
+from random import choice
+from ca_algs.da_cache import DACache
+from ca_algs.da_pool import DAPool
+from ca_algs.deferred_acceptance import make_deferred_acceptance
+from ce_algs.profiler import Profiler
+from ce_algs.search import run_search, run_sweep, sweep_da
+from ce_algs.tree_store import TreeStore
 from ce_algs.uct_iterative.capacity_expansion_game import CapacityExpansionGame
 
 
 class UCT:
+    # Node statistics live in a TreeStore and nodes are referred to by their id in it. Game objects are only built
+    # from the root game, to list the moves of a node when it is expanded and to play out rollouts.
     def __init__(self, exploration_weight=1):
         self.exploration_weight = exploration_weight
         self.best_history = None
         self.best_history_reward = -np.inf
+        self.best_capacities = None
+        self.root = None
+        self.store = TreeStore()
 
     def choose(self, node):
         "Choose the best successor of node. (Choose a move in the game)"
-        if node.is_terminal():
+        store = self.store
+        if store.terminal[node]:
             raise RuntimeError(f"choose called on terminal node {node}")
 
-        if node.children is None:
-            return node.find_random_child()
+        if not store.is_expanded(node):
+            return choice(self._game(node).find_actions())
 
-        def score(n):
-            if n.fully_explored:
-                return n.best_reward
-            if n.N == 0:
-                return float("-inf")  # avoid unseen moves
-            return n.Q / n.N  # average reward
+        start, stop = store.children(node)
+        N = store.N[start:stop]
+        # average reward, avoiding unseen moves
+        score = np.divide(store.Q[start:stop], N, out=np.full(stop - start, -np.inf), where=N > 0)
+        score = np.where(store.fully_explored[start:stop], store.best_reward[start:stop], score)
+        return int(store.move[start + np.argmax(score)])
 
-        return max(node.children, key=score)
-
-    def do_rollout(self, node):
+    def do_rollout(self, game):
         "Make the tree one layer better. (Train for one iteration.)"
-        path = self._select(node)
+        path = self._select(self._root(game))
         leaf = path[-1]
         self._expand(leaf)
         reward = self._simulate(leaf)
         self._backpropagate(path, reward)
 
+    def do_rollout_batch(self, game, batch_size):
+        "Run `batch_size` rollouts at once, scoring all of their terminal states in one batched DA call."
+        root = self._root(game)
+        paths = []
+        playouts = []
+        for _ in range(batch_size):
+            path = self._select(root)
+            leaf = path[-1]
+            self._expand(leaf)
+            # virtual loss: count the visit before its reward is known so that the next selections spread out
+            self.store.N[path] += 1
+            paths.append(path)
+            playouts.append(self._game(leaf).random_playout())
+        rewards = self._batch_reward(self.root, [capacities for _, capacities in playouts])
+        for path, (history, capacities), reward in zip(paths, playouts, rewards):
+            self.store.N[path] -= 1
+            self._record(history, capacities, reward)
+            self._backpropagate(path, reward)
+
+    def is_fully_explored(self, game):
+        "Whether every terminal state below root `game` has been found"
+        return self.root is not None and bool(self.store.fully_explored[0])
+
+    def num_nodes(self):
+        "Number of nodes in the tree"
+        return self.store.num_nodes()
+
+    def peak_nodes(self):
+        "Largest number of nodes the tree has held"
+        return self.store.size
+
+    def root_visits(self, game):
+        "Returns the visit count and total reward of every child of root `game`, keyed by its history"
+        store = self.store
+        if self.root is None or not store.is_expanded(0):
+            return {}
+        start, stop = store.children(0)
+        return {(int(store.move[n]),): (int(store.N[n]), float(store.Q[n])) for n in range(start, stop)}
+
+    def add_root_visits(self, game, history, N, Q):
+        "Add `N` visits with total reward `Q` to the child of root `game` reached by `history`, and to the root"
+        store = self.store
+        start, stop = store.children(0)
+        n = start + list(store.move[start:stop]).index(history[-1])
+        store.N[[0, n]] += N
+        store.Q[[0, n]] += Q
+
+    def restart(self, game, decay=0.1):
+        "Make `game`, the root game of a changed search, the root, keeping the statistics of the nodes"
+        # The rewards the nodes got may be off for the new root, so the visits of every node shrink by `decay`
+        # (keeping its mean reward and at least one visit) and the new rollouts soon outweigh them. Whether nodes are
+        # fully explored has to be found again, and the best terminal state is forgotten.
+        store = self.store
+        if store.size == 0:
+            return
+        self.root = game
+        N = store.N[:store.size]
+        visited = N > 0
+        shrunk = np.maximum(1, np.round(N[visited] * decay)).astype(N.dtype)
+        store.Q[:store.size][visited] *= shrunk / N[visited]
+        N[visited] = shrunk
+        store.fully_explored[:store.size] = False
+        store.num_explored_children[:store.size] = 0
+        store.best_reward[:store.size] = np.nan
+        self.best_history = None
+        self.best_history_reward = -np.inf
+        self.best_capacities = None
+
+    def deepen(self, game, decay=0.1):
+        "Make `game`, the root game with one seat more to allocate, the root; the terminal nodes become leaves"
+        # as restart, whose decay lets the higher rewards of the new budget soon outweigh those of the old one
+        store = self.store
+        self.restart(game, decay)
+        leaves = np.flatnonzero(store.terminal[:store.size])
+        store.terminal[leaves] = False
+        store.first_child[leaves] = -1
+        store.num_selected_children[leaves] = 0
+
+    def _root(self, game):
+        if self.root is None:
+            self.root = game
+            self.store.add_root(game.is_terminal())
+        return 0
+
+    def _game(self, node):
+        "Returns the game state of `node`, played from the root"
+        if node == 0:
+            return self.root
+        return self.root.play(self.store.history(node))
+
     def _select(self, node):
         "Find an unexplored descendent of `node`"
+        store = self.store
         path = []
         while True:
             path.append(node)
-            if node.children is None or node.terminal:
+            if not store.is_expanded(node) or store.terminal[node]:
                 # node is either unexplored or terminal
                 return path
             # explore first the child node that has never been explored
-            unexplored = {nd for nd in node.children if nd.N == 0}
-            if unexplored:
-                n = unexplored.pop()
-                path.append(n)
+            start, stop = store.children(node)
+            unexplored = start + store.num_selected_children.item(node)
+            if unexplored < stop:
+                store.num_selected_children[node] += 1
+                path.append(unexplored)
                 return path
             # if all child nodes have been explored once, the child node is selected according to UCB values
             node = self._uct_select(node)  # descend a layer deeper
 
     def _expand(self, node):
-        "Update the `children` dict with the children of `node`"
-        if node.children is not None:
+        "Add the children of `node` to the tree"
+        if self.store.is_expanded(node):
             return  # already expanded
-        node.children = node.find_children()
+        game = self._game(node)
+        moves = game.find_actions()
+        self.store.add_children(node, moves, len(game.history) + 1 == game.depth)
 
     def _simulate(self, node):
         "Returns the reward for a random simulation (to completion) of `node`"
-        while True:
-            if node.is_terminal():
-                reward = node.reward()
-                if self.best_history_reward < reward:
-                    self.best_history_reward = reward
-                    self.best_history = node.history
-                return reward
-            node = node.find_random_child()
+        game = self._game(node)
+        history, capacities = game.random_playout()
+        reward = game.score(capacities)
+        self._record(history, capacities, reward)
+        return reward
+
+    def _record(self, history, capacities, reward):
+        "Keep track of the best terminal state found so far"
+        if self.best_history_reward < reward:
+            self.best_history_reward = reward
+            self.best_history = history
+            self.best_capacities = capacities
+
+    def _batch_reward(self, game, capacity_matrix):
+        "Returns the rewards of the terminal capacities of `game`, evaluated in one batched DA call"
+        total_costs = game.da.run_batch(capacity_matrix, base_state=game.da_state)
+        return [(game.base_cost - total_cost) / game.base_cost for total_cost in total_costs]
 
     def _backpropagate(self, path, reward):
         "Send the reward back up to the ancestors of the leaf"
+        store = self.store
         for node in reversed(path):
-            node.N += 1
-            node.Q += reward
-            fully_explored = True
-            for n in node.children:
-                fully_explored = fully_explored & n.fully_explored
-                if not fully_explored:
-                    break
-            if fully_explored:
-                node.fully_explored = True
-                if len(node.children) == 0:
-                    node.best_reward = reward
-                else:
-                    node.best_reward = max(node.children, key=lambda n: n.best_reward).best_reward
+            store.N[node] += 1
+            store.Q[node] += reward
+            # a node is fully explored once all of its children are, which they report to it when they become so
+            if store.fully_explored[node] or store.num_explored_children[node] < store.num_children[node]:
+                continue
+            store.fully_explored[node] = True
+            start, stop = store.children(node)
+            if stop == start:
+                store.best_reward[node] = reward
+            else:
+                store.best_reward[node] = store.best_reward[start:stop].max()
+            if node > 0:
+                store.num_explored_children[store.parent[node]] += 1
 
     def _uct_select(self, node):
         "Select a child of node, balancing exploration & exploitation"
-        log_N_vertex = np.log(node.N)
-
-        def uct(n):
-            "Upper confidence bound for trees"
-            return (n.Q / n.N + self.exploration_weight * np.sqrt(log_N_vertex / n.N)) * (1 - n.fully_explored)
-
-        return max(node.children, key=uct)
+        store = self.store
+        start, stop = store.children(node)
+        N = store.N[start:stop]
+        # upper confidence bound for trees
+        uct = store.Q[start:stop] / N + self.exploration_weight * np.sqrt(math.log(store.N[node]) / N)
+        uct[store.fully_explored[start:stop]] = 0
+        return start + int(uct.argmax())
 
 
-def uct_iterative(student_prefs, college_prefs, college_capacities, budget, college_budgets):
-    return _uct_iterative(student_prefs, college_prefs, college_capacities, budget, college_budgets, UCT)
+def uct_iterative(student_prefs, college_prefs, college_capacities, budget, college_budgets, **kwargs):
+    return _uct_iterative(student_prefs, college_prefs, college_capacities, budget, college_budgets, UCT, **kwargs)
 
 
-def _uct_iterative(student_prefs, college_prefs, college_capacities, budget, college_budgets, alg):
+def _uct_iterative(student_prefs, college_prefs, college_capacities, budget, college_budgets, alg,
+                   cache_bytes=2 ** 28, leaf_batch_size=1, num_workers=1, parallel='leaf', sync_interval=100,
+                   time_limit=None, max_da_evaluations=None, incumbent_callback=None, prune_actions=False,
+                   da_arrays=None, should_stop=None, sweep=False, profile=False):
     print('==========Run UCT Iterative-tree==========')
-    da = DeferredAcceptance(student_prefs, college_prefs)
-    _, _, original_cost = da.run(college_capacities)
-    tree = alg(exploration_weight=np.sqrt(0.002))
-    game = CapacityExpansionGame(da, student_prefs, college_prefs, college_capacities, budget, college_budgets,
-                                 original_cost, [], False)
+    da = make_deferred_acceptance(student_prefs, college_prefs, da_arrays)
+    profiler = Profiler() if profile else None
+    if sweep:
+        if num_workers > 1:
+            raise ValueError('a budget sweep searches on one worker')
+        shared = sweep_da(da, college_capacities, budget, college_budgets, cache_bytes)
+        make_search = partial(_make_sweep_search, shared, student_prefs, college_prefs, college_capacities,
+                              college_budgets, alg, prune_actions)
+        return run_sweep(make_search, budget, college_capacities, college_budgets, time_limit, max_da_evaluations,
+                         incumbent_callback, should_stop, profiler)
+    make_search = partial(_make_search, da, student_prefs, college_prefs, college_capacities, budget, college_budgets,
+                          alg, cache_bytes, prune_actions)
 
     # run rollout
-    log = defaultdict(list)
-    st_time = time.time()
-    for i in range(1000 * budget):
-        if i % 100 == 0:
-            print('Run {}-th rollout'.format(i))
-        if game.fully_explored:
-            print('Fully explored! Terminate rollout')
-            break
-        tree.do_rollout(game)
-        log['reward'].append(tree.best_history_reward)
-        log['run_time'].append(time.time() - st_time)
-
-    run_time = time.time() - st_time
-    best_expanded_capacities = [college_capacities[j] for j in range(len(college_prefs))]
-    for idx in tree.best_history:
-        best_expanded_capacities[idx] += 1
+    best_capacities, log, run_time, throughput = run_search(make_search, 1000 * budget, leaf_batch_size, num_workers,
+                                                            parallel, sync_interval, time_limit, max_da_evaluations,
+                                                            incumbent_callback, should_stop, profiler)
+    # fall back to the current capacities if the search stopped before its first rollout
+    best_expanded_capacities = best_capacities if best_capacities is not None else [j for j in college_capacities]
     _, _, best_cost = da.run(best_expanded_capacities)
     print('run time={}'.format(run_time))
     print('Total cost for expanded capacities {}: {}'.format(best_expanded_capacities, best_cost))
 
-    return {
+    result = {
         'expanded_capacities': best_expanded_capacities,
         'best_cost': best_cost,
-        'run_time': run_time
-    }, log
+        'run_time': run_time,
+        'worker_rollouts_per_sec': throughput
+    }
+    if profiler is not None:
+        result['profile'] = profiler.summary()
+    return result, log
+
+
+def _make_search(da, student_prefs, college_prefs, college_capacities, budget, college_budgets, alg, cache_bytes,
+                 prune_actions, da_workers):
+    # terminal capacities never exceed this ceiling, so rewards repair its matching instead of rerunning DA
+    ceiling = [college_capacities[j] + min(college_budgets[j], budget) for j in range(len(college_prefs))]
+    _, da_state, _ = da.run_from(None, ceiling)
+    da = DACache(DAPool(da, da_workers, ceiling) if da_workers > 1 else da, max_bytes=cache_bytes)
+    original_matches, _, original_cost = da.run(college_capacities)
+    # colleges nobody envies at the current capacities are never worth a seat (see DeferredAcceptance.envied_colleges)
+    envied = da.envied_colleges(original_matches) if prune_actions else None
+    tree = alg(exploration_weight=np.sqrt(0.002))
+    game = CapacityExpansionGame(da, student_prefs, college_prefs, college_capacities, budget, college_budgets,
+                                 original_cost, [], False, da_state, envied)
+    return tree, game, da
+
+
+def _make_sweep_search(shared, student_prefs, college_prefs, college_capacities, college_budgets, alg, prune_actions,
+                       budget, tree):
+    # the moves of the tree do not depend on the budget, so the tree of the previous budget is deepened by a seat
+    da, da_state, original_matches, original_cost = shared
+    envied = da.envied_colleges(original_matches) if prune_actions else None
+    game = CapacityExpansionGame(da, student_prefs, college_prefs, college_capacities, budget, college_budgets,
+                                 original_cost, [], False, da_state, envied)
+    if tree is None:
+        tree = alg(exploration_weight=np.sqrt(0.002))
+    else:
+        tree.deepen(game)
+    return tree, game, da
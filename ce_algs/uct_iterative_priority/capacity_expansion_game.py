@@ -1,8 +1,10 @@
+import numpy as np
+
 from random import choice
 
 
 class CapacityExpansionGame(object):
-    def __init__(self, da, student_prefs, college_prefs, college_capacities, budget, college_budgets, original_cost, history, terminal, order):
+    def __init__(self, da, student_prefs, college_prefs, college_capacities, budget, college_budgets, original_cost, history, terminal, order, da_state=None, envied=None):
         self.student_prefs = student_prefs
         self.college_prefs = college_prefs
         self.college_capacities = college_capacities
@@ -13,6 +15,7 @@ class CapacityExpansionGame(object):
         self.history = [h for h in history]
         self.terminal = terminal
         self.da = da
+        self.da_state = da_state
         remain_budget = budget - len(history)
         remain_budgets = [b for b in college_budgets]
         for i in range(self.num_colleges):
@@ -25,19 +28,21 @@ class CapacityExpansionGame(object):
             if sum(remain_budgets[order[j]] for j in range(self.num_colleges) if j >= i) < remain_budget:
                 continue
             self.actions.append(i)
-        self.N = 0
-        self.Q = 0
-        self.children = None
-        self.fully_explored = False
-        self.best_reward = None
         self.order = order
+        self.envied = envied
+        self.actions = self._prune(self.actions)
 
-    def find_children(self):
+    def find_actions(self):
         if self.terminal:  # If the game is finished then no moves can be made
-            return set()
-        # Otherwise, you can make a move in each of the empty spots
+            return []
+        if self.envied is not None:
+            self._update_envied()
+        return self.actions
+
+    def find_children(self):
+        # you can make a move in each of the empty spots
         return {
-            self.make_move(i) for i in self.actions
+            self.make_move(i) for i in self.find_actions()
         }
 
     def find_random_child(self):
@@ -45,23 +50,74 @@ class CapacityExpansionGame(object):
             return None  # If the game is finished then no moves can be made
         return self.make_move(choice(self.actions))
 
-    def reward(self):
-        if not self.terminal:
-            raise RuntimeError(f"reward called on nonterminal board {self}")
+    def _prune(self, actions):
+        # an extra seat at a college nobody envies cannot change the matching; if no such seat is left, one action
+        # is enough to complete the allocation
+        if self.envied is None:
+            return actions
+        pruned = [i for i in actions if self.envied[self.order[i]]]
+        return pruned if len(pruned) > 0 else actions[:1]
+
+    def _update_envied(self):
+        # refine the inherited mask with the matching at this node's own capacities
+        new_capacities = self.capacities()
+        if self.da_state is None:
+            matches_for_students, _, _ = self.da.run(new_capacities)
+        else:
+            matches_for_students, _, _ = self.da.run_from(self.da_state, new_capacities)
+        self.envied = self.envied & self.da.envied_colleges(matches_for_students)
+        self.actions = self._prune(self.actions)
+
+    def random_playout(self):
+        # Plays the same moves as calling find_random_child until the game ends, drawing from the same random
+        # stream, but without building the intermediate games; returns the final history and capacities
+        history = list(self.history)
+        # budgets and seats taken by position in the order
+        budgets = np.array([self.college_budgets[j] for j in self.order])
+        counts = np.bincount(history, minlength=self.num_colleges)
+        while len(history) < self.depth:
+            # the positions from i on must still be able to absorb the remaining budget
+            feasible = np.cumsum((budgets - counts)[::-1])[::-1] >= self.depth - len(history)
+            if len(history) > 0:
+                feasible[:history[-1]] = False
+                feasible &= counts + 1 <= budgets
+            i = choice(self._prune(np.flatnonzero(feasible).tolist()))
+            history.append(i)
+            counts[i] += 1
+        new_capacities = np.array(self.college_capacities)
+        np.add.at(new_capacities, np.asarray(self.order)[history], 1)
+        return history, new_capacities.tolist()
+
+    def capacities(self):
         new_capacities = [self.college_capacities[j] for j in range(self.num_colleges)]
         for idx in self.history:
             new_capacities[self.order[idx]] += 1
-        _, _, total_cost = self.da.run(new_capacities)
+        return new_capacities
+
+    def reward(self):
+        if not self.terminal:
+            raise RuntimeError(f"reward called on nonterminal board {self}")
+        return self.score(self.capacities())
+
+    def score(self, new_capacities):
+        if self.da_state is None:
+            _, _, total_cost = self.da.run(new_capacities)
+        else:
+            _, _, total_cost = self.da.run_from(self.da_state, new_capacities)
         return (self.base_cost - total_cost) / self.base_cost
 
     def is_terminal(self):
         return self.terminal
 
     def make_move(self, index):
-        history = self.history + [index]
+        return self.play([index])
+
+    def play(self, moves):
+        history = self.history + list(moves)
         is_terminal = len(history) == self.depth
         return CapacityExpansionGame(self.da, self.student_prefs, self.college_prefs, self.college_capacities,
-                                     self.depth, self.college_budgets, self.base_cost, history, is_terminal, self.order)
+                                     self.depth, self.college_budgets, self.base_cost, history, is_terminal, self.order, self.da_state,
+                                     self.envied)
 
     def __hash__(self):
         return hash(tuple(self.history))
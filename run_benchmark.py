@@ -0,0 +1,53 @@
+import argparse
+import json
+import os
+import sys
+
+from runner.benchmark import ALGS, DA_GRIDS, compare, run_benchmarks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of DA and of the capacity expansion algorithms')
+    parser.add_argument('--part', choices=['da', 'algs', 'all'], default='all',
+                        help='DA microbenchmarks, end-to-end runs of the algorithms, or both')
+    parser.add_argument('--scale', choices=list(DA_GRIDS), default='quick',
+                        help='instance sizes; quick checks for regressions, full draws the scaling curves')
+    parser.add_argument('--seed', type=int, default=0, help='random seed of the instances and of the searches')
+    parser.add_argument('--min_time', type=float, default=0.5, help='seconds to repeat every DA call for')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='times to repeat every measurement, keeping the fastest')
+    parser.add_argument('--max_cells', type=int, default=10 ** 7,
+                        help='largest number of students times colleges of a DA benchmark')
+    parser.add_argument('--algs', nargs='+', choices=list(ALGS), default=None,
+                        help='algorithms to run end to end; all of them by default')
+    parser.add_argument('--time_limit', type=float, default=None,
+                        help='time limit of every algorithm; by default the searches run all their rollouts')
+    parser.add_argument('--save', default=None, help='path of the JSON file to save the results to as a baseline')
+    parser.add_argument('--compare', default=None, help='path of a saved baseline to compare the results with')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative loss of throughput or growth of peak RSS reported as a regression')
+    parser.add_argument('--cost_tolerance', type=float, default=0.0,
+                        help='relative growth of the best cost reported as a regression')
+    args = parser.parse_args()
+
+    parts = ['da', 'algs'] if args.part == 'all' else [args.part]
+    report = run_benchmarks(parts, args.scale, args.seed, args.min_time, args.max_cells, args.algs, args.time_limit,
+                            args.repeats)
+    if args.save is not None:
+        os.makedirs(os.path.dirname(args.save) or '.', exist_ok=True)
+        with open(args.save, mode='wt') as f:
+            json.dump(report, f, indent=1)
+    if args.compare is not None:
+        with open(args.compare, mode='rt') as f:
+            baseline = json.load(f)
+        regressions = compare(report['records'], baseline['records'], args.tolerance, args.cost_tolerance)
+        print('=========={} regressions against {}=========='.format(len(regressions), args.compare))
+        for regression in regressions:
+            print(regression)
+        # a non-zero exit status lets a CI job fail on regressions
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,40 @@
 import argparse
 import numpy as np
 
-from ca_algs.deferred_acceptance import DeferredAcceptance
+from ca_algs.deferred_acceptance import make_deferred_acceptance
 from ce_algs import *
 from runner import utils
-from runner.runner import make_real_data_instance, run_algs
+from runner.runner import REAL_DATA_GENERATORS, load_or_make_instance, make_real_data_instance, run_trials
 
 
-def run_exp(num_trials, budget, load_seed, algs):
+def run_exp(num_trials, budget, load_seed, algs, jobs, gurobi_threads, generator, chunk_size, sweep=False,
+            profile=False):
+    trials = []
     for n in range(num_trials):
         print('==========Run {}-th trial=========='.format(n))
         base_path = 'log/tokyo/budget{}/trial{}'.format(budget, n)
 
-        # set random seed
-        seed = utils.get_seed(base_path, load_seed)
-        rng = np.random.RandomState(seed)
-
-        # create instance
-        student_prefs, college_prefs, college_capacities, college_budgets = make_real_data_instance(rng)
+        # create instance from a new or the saved random seed, or load it from the instance cache
+        seed, generator, instance_hash, instance = load_or_make_instance(
+            base_path, load_seed, lambda rng, generator: make_real_data_instance(rng, generator, chunk_size), generator)
+        student_prefs, college_prefs = utils.preference_lists(instance)
+        college_capacities = instance['college_capacities'].tolist()
+        college_budgets = instance['college_budgets'].tolist()
 
         # save created instance setting
-        da = DeferredAcceptance(student_prefs, college_prefs)
+        da = make_deferred_acceptance(student_prefs, college_prefs, instance['da_arrays'])
         _, _, cost = da.run(college_capacities)
-        utils.save_setting(base_path, seed=seed, student_prefs=student_prefs, college_prefs=college_prefs,
+        utils.save_setting(base_path, seed=seed, generator=generator, instance=instance_hash,
                            college_capacities=college_capacities, budget=budget, cost=cost)
         print('Instance:\nstudent_prefs {},\ncollege_prefs {},\ncollege_capacities {},\nbudget {},\ncollege budgets {}'
-              .format(np.array(student_prefs), np.array(college_prefs), college_capacities, budget, college_budgets))
+              .format(np.array(student_prefs, dtype=object), np.array(college_prefs, dtype=object), college_capacities,
+                      budget, college_budgets))
+
+        trials.append((student_prefs, college_prefs, college_capacities, budget, college_budgets, cost, base_path,
+                       instance['da_arrays']))
 
-        # run each algorithm
-        run_algs(student_prefs, college_prefs, college_capacities, budget, college_budgets, cost, algs, base_path)
+    # run each algorithm on each trial
+    run_trials(trials, algs, jobs, gurobi_threads, sweep, profile)
 
 
 def main():
@@ -36,6 +42,17 @@ def main():
     parser.add_argument('--budget', type=int, required=True, help='budget for the extra spots to allocate')
     parser.add_argument('--num_trials', type=int, default=10, help='number of trials to run experiments')
     parser.add_argument('--load_seed', action='store_true', help='whether to load a random seed')
+    parser.add_argument('--jobs', type=int, default=1, help='number of cores to run trials and algorithms on')
+    parser.add_argument('--gurobi_threads', type=int, default=1, help='number of threads for each Gurobi solve')
+    parser.add_argument('--generator', choices=REAL_DATA_GENERATORS, default='vectorized',
+                        help='instance generator for new seeds; legacy reproduces published instances exactly, '
+                             'truncated cuts the preference lists after the dummy college')
+    parser.add_argument('--chunk_size', type=int, default=None,
+                        help='number of random scores the vectorized generator draws at once')
+    parser.add_argument('--sweep', action='store_true',
+                        help='also report the cost of every smaller budget, for the algorithms that support it')
+    parser.add_argument('--profile', action='store_true',
+                        help='also report the time of every phase of the UCT searches and the work of their DA runs')
     args = parser.parse_args()
 
     budget = args.budget
@@ -44,14 +61,18 @@ def main():
     algs = [
         greedy,
         lp_heuristic,
+        # local_search,
         # iqp,
         agg_lin,
+        # hybrid,
+        # branch_and_bound,
         uct_iterative,
         uct_amaf,
         uct_iterative_priority,
         uct_iterative_priority_random,
         uct_iterative_priority_popularity,
         uct_iterative_priority_envy,
+        # Refined(uct_iterative_priority_envy),
         # uct_batch,
         uct_batch_popularity,
         uct_batch_envy,
@@ -60,7 +81,8 @@ def main():
 
     # run experiments
     print('==========Run experiment over {} trials=========='.format(args.num_trials))
-    run_exp(args.num_trials, budget, args.load_seed, algs)
+    run_exp(args.num_trials, budget, args.load_seed, algs, args.jobs, args.gurobi_threads, args.generator,
+            args.chunk_size, args.sweep, args.profile)
 
 
 if __name__ == '__main__':
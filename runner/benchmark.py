@@ -0,0 +1,235 @@
+import contextlib
+import multiprocessing
+import numpy as np
+import os
+import platform
+import random
+import resource
+import sys
+import time
+
+from ca_algs.deferred_acceptance import DeferredAcceptance
+from ce_algs import (greedy, uct_amaf, uct_batch, uct_batch_envy, uct_iterative, uct_iterative_priority,
+                     uct_iterative_priority_envy)
+from runner.runner import make_synthetic_instance
+
+# Sizes of the DA microbenchmarks, as the students, colleges and correlations whose every combination is run, and of
+# the end-to-end runs, as (num_students, num_colleges, budget, correlation); 'quick' checks for regressions in a few
+# minutes, 'full' draws the scaling curves
+DA_GRIDS = {
+    'quick': ([1000, 10000], [15, 100], [0.0, 0.8]),
+    'full': ([1000, 10000, 50000, 200000], [15, 100, 500, 2000], [0.0, 0.4, 0.8])
+}
+ALG_INSTANCES = {
+    'quick': [(1000, 15, 10, 0.4)],
+    'full': [(1000, 15, 30, 0.4), (5000, 50, 30, 0.4), (10000, 100, 20, 0.4)]
+}
+# the DA calls of a microbenchmark: a matrix run, a queue run, and run_from repairing the matching at the ceiling of
+# the capacity vectors, as the searches score their terminal states
+DA_METHODS = ['matrix', 'queue', 'run_from']
+# extra seats of the capacity vectors the DA microbenchmarks evaluate
+DA_BUDGET = 10
+ALGS = {alg.__name__: alg for alg in [greedy, uct_iterative, uct_amaf, uct_iterative_priority,
+                                      uct_iterative_priority_envy, uct_batch, uct_batch_envy]}
+# metrics compared with a baseline, and whether higher values are better; the best cost is compared on its own
+PERF_METRICS = {'calls_per_sec': True, 'rollouts_per_sec': True, 'da_calls_per_sec': True, 'lookups_per_sec': True,
+                'peak_rss_mb': False}
+
+
+def run_benchmarks(parts, scale, seed=0, min_time=0.5, max_cells=10 ** 7, algs=None, time_limit=None, repeats=3):
+    # Runs the DA microbenchmarks ('da') and the end-to-end runs ('algs') of `scale` on the instances seed draws,
+    # each in a fresh process so that its peak RSS is its own, and returns the report: the machine and the records.
+    # Every measurement is repeated `repeats` times and the fastest one kept, since a single one is too noisy to
+    # compare with a baseline.
+    # DA instances with more than max_cells students times colleges are skipped, since their dense arrays take
+    # several bytes per cell; the algorithms run their default number of rollouts unless time_limit stops them first.
+    records = []
+    if 'da' in parts:
+        students, colleges, correlations = DA_GRIDS[scale]
+        for num_students in students:
+            for num_colleges in colleges:
+                if num_students * num_colleges > max_cells:
+                    print('Skip DA benchmark of {} students and {} colleges'.format(num_students, num_colleges))
+                    continue
+                for correlation in correlations:
+                    for record in _isolated(bench_da, num_students, num_colleges, correlation, seed, min_time,
+                                            repeats):
+                        print(describe(record))
+                        records.append(record)
+    if 'algs' in parts:
+        for num_students, num_colleges, budget, correlation in ALG_INSTANCES[scale]:
+            for name in (algs or list(ALGS)):
+                record = _isolated(bench_alg, name, num_students, num_colleges, budget, correlation, seed, time_limit,
+                                   repeats)
+                print(describe(record))
+                records.append(record)
+    machine = {
+        'platform': platform.platform(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__
+    }
+    return {'machine': machine, 'scale': scale, 'seed': seed, 'repeats': repeats, 'records': records}
+
+
+def bench_da(num_students, num_colleges, correlation, seed, min_time, repeats=1):
+    rng = np.random.RandomState(seed)
+    student_prefs, college_prefs, college_capacities, _ = make_synthetic_instance(
+        num_students, num_colleges, DA_BUDGET, correlation, False, rng, 'vectorized')
+    st_time = time.perf_counter()
+    da = DeferredAcceptance(student_prefs, college_prefs)
+    setup_time = time.perf_counter() - st_time
+    queue = DeferredAcceptance.from_arrays(da.s_rank, da.s_costs, da.c_scores, backend='queue')
+    capacity_matrix = college_capacities + rng.multinomial(DA_BUDGET, np.ones(num_colleges) / num_colleges, size=32)
+    _, ceiling_state, _ = da.run_from(None, college_capacities + DA_BUDGET)
+    calls = {
+        'matrix': (da, da.run),
+        'queue': (queue, queue.run),
+        'run_from': (da, lambda capacities: da.run_from(ceiling_state, capacities))
+    }
+    records = []
+    for method in DA_METHODS:
+        instance, call = calls[method]
+        rounds, proposals = instance.rounds, instance.proposals
+        samples = [_time_calls(call, capacity_matrix, min_time) for _ in range(repeats)]
+        num_calls, elapsed = max(samples, key=lambda sample: sample[0] / sample[1])
+        total_calls = sum(sample[0] for sample in samples)
+        records.append({
+            'part': 'da',
+            'num_students': num_students,
+            'num_colleges': num_colleges,
+            'correlation': correlation,
+            'method': method,
+            'setup_time': setup_time,
+            'calls': num_calls,
+            'time_per_call': elapsed / num_calls,
+            'calls_per_sec': num_calls / elapsed,
+            'rounds_per_call': (instance.rounds - rounds) / total_calls,
+            'proposals_per_call': (instance.proposals - proposals) / total_calls
+        })
+    peak_rss_mb = _peak_rss_mb()
+    for record in records:
+        record['peak_rss_mb'] = peak_rss_mb
+    return records
+
+
+def bench_alg(name, num_students, num_colleges, budget, correlation, seed, time_limit, repeats=1):
+    rng = np.random.RandomState(seed)
+    student_prefs, college_prefs, college_capacities, college_budgets = (
+        values.tolist() for values in make_synthetic_instance(num_students, num_colleges, budget, correlation, False,
+                                                              rng, 'vectorized'))
+    _, _, original_cost = DeferredAcceptance(student_prefs, college_prefs).run(college_capacities)
+    kwargs = {'time_limit': time_limit} if time_limit is not None else {}
+    runs = []
+    for _ in range(repeats):
+        random.seed(seed)
+        np.random.seed(seed)
+        # the algorithms report their progress on stdout
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results = ALGS[name](student_prefs, college_prefs, college_capacities, budget, college_budgets, **kwargs)
+        runs.append(results if isinstance(results, tuple) else (results, None))
+    # the runs draw the same random numbers, so without a time limit they only differ in their speed
+    result, log = max(runs, key=lambda run: _da_evaluations(*run) / run[0]['run_time'])
+    run_time = result['run_time']
+    record = {
+        'part': 'algs',
+        'num_students': num_students,
+        'num_colleges': num_colleges,
+        'budget': budget,
+        'correlation': correlation,
+        'alg': name,
+        'best_cost': float(result['best_cost']),
+        'improvement_rate': (original_cost - result['best_cost']) / original_cost,
+        'run_time': run_time
+    }
+    record['da_evaluations'] = _da_evaluations(result, log)
+    record['da_calls_per_sec'] = record['da_evaluations'] / run_time
+    if log is not None:
+        record['rollouts'] = len(log['reward'])
+        record['rollouts_per_sec'] = record['rollouts'] / run_time
+        # a hit of the DA cache is a dictionary lookup, so the lookups are reported apart from the DA runs
+        record['cache_lookups'] = log['cache_hits'][-1] + log['cache_misses'][-1]
+        record['lookups_per_sec'] = record['cache_lookups'] / run_time
+    record['peak_rss_mb'] = _peak_rss_mb()
+    return record
+
+
+def compare(records, baseline_records, tolerance=0.2, cost_tolerance=0.0):
+    # Returns a message for every metric of a record that is worse than in the baseline record of the same benchmark,
+    # by more than the relative `tolerance` for the PERF_METRICS and by more than `cost_tolerance` for the best cost.
+    # Benchmarks missing from either side are not compared.
+    baseline = {_key(record): record for record in baseline_records}
+    regressions = []
+    for record in records:
+        old = baseline.get(_key(record))
+        if old is None:
+            continue
+        for metric, higher_is_better in PERF_METRICS.items():
+            if metric not in record or metric not in old or old[metric] <= 0:
+                continue
+            ratio = record[metric] / old[metric]
+            if (ratio < 1 - tolerance) if higher_is_better else (ratio > 1 + tolerance):
+                regressions.append('{}: {} {:.4g} -> {:.4g}'.format(describe(record, False), metric, old[metric],
+                                                                    record[metric]))
+        if 'best_cost' in record and record['best_cost'] > old['best_cost'] * (1 + cost_tolerance):
+            regressions.append('{}: best_cost {} -> {}'.format(describe(record, False), old['best_cost'],
+                                                               record['best_cost']))
+    return regressions
+
+
+def describe(record, with_metrics=True):
+    if record['part'] == 'da':
+        name = 'DA {} on {} students, {} colleges, correlation {}'.format(
+            record['method'], record['num_students'], record['num_colleges'], record['correlation'])
+        metrics = '{:.1f} calls/s, {:.3g} ms/call, {:.3g} rounds and {:.0f} proposals/call, peak RSS {:.0f} MB'.format(
+            record['calls_per_sec'], record['time_per_call'] * 1000, record['rounds_per_call'],
+            record['proposals_per_call'], record['peak_rss_mb'])
+    else:
+        name = '{} on {} students, {} colleges, budget {}, correlation {}'.format(
+            record['alg'], record['num_students'], record['num_colleges'], record['budget'], record['correlation'])
+        metrics = 'cost {} ({:.2%} better), {:.2f} s, {:.1f} DA calls/s, peak RSS {:.0f} MB'.format(
+            record['best_cost'], record['improvement_rate'], record['run_time'], record['da_calls_per_sec'],
+            record['peak_rss_mb'])
+        if 'rollouts_per_sec' in record:
+            metrics += ', {:.1f} rollouts/s, {:.1f} cache lookups/s'.format(
+                record['rollouts_per_sec'], record['lookups_per_sec'])
+    return '{}: {}'.format(name, metrics) if with_metrics else name
+
+
+def _key(record):
+    if record['part'] == 'da':
+        return 'da', record['num_students'], record['num_colleges'], record['correlation'], record['method']
+    return 'algs', record['num_students'], record['num_colleges'], record['budget'], record['correlation'], \
+        record['alg']
+
+
+def _da_evaluations(result, log):
+    # the DA runs of the searches are the misses of their DA cache
+    if log is not None:
+        return log['cache_misses'][-1]
+    return result['da_evaluations']
+
+
+def _isolated(task, *args):
+    # spawned rather than forked, so that the peak RSS of the process does not start from that of this one
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(task, args)
+
+
+def _time_calls(call, capacity_matrix, min_time):
+    # calls `call` on the capacity vectors in turn, at least once, until min_time seconds have passed
+    num_calls = 0
+    st_time = time.perf_counter()
+    while True:
+        call(capacity_matrix[num_calls % len(capacity_matrix)])
+        num_calls += 1
+        elapsed = time.perf_counter() - st_time
+        if elapsed >= min_time:
+            return num_calls, elapsed
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss / 2 ** 20 if sys.platform == 'darwin' else peak_rss / 2 ** 10
@@ -1,10 +1,51 @@
 import numpy as np
 import pickle
 
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from ca_algs.shared_da import compact_dtype
 from runner import utils
 
+# algorithms that take the best solution of the heuristics as a warm start, the heuristics, those solved by Gurobi,
+# and those that also run a search on one more core alongside Gurobi; local_search refines the best solution of the
+# heuristics before it and becomes the warm start of those after it
+WARM_STARTED = ['iqp', 'agg_lin', 'non_agg_lin', 'hybrid', 'branch_and_bound', 'local_search']
+HEURISTICS = ['greedy', 'lp_heuristic', 'local_search']
+GUROBI = ['iqp', 'agg_lin', 'non_agg_lin', 'lp_heuristic', 'hybrid']
+HYBRID = ['hybrid']
+# algorithms that also return the cost of every smaller budget when asked to sweep the budgets
+SWEEPS = ['greedy', 'uct_iterative', 'uct_amaf', 'uct_iterative_priority', 'uct_iterative_priority_envy',
+          'uct_iterative_priority_popularity', 'uct_iterative_priority_random', 'uct_batch', 'uct_batch_envy',
+          'uct_batch_popularity', 'uct_batch_random']
+# algorithms that can time the phases of their search when asked to profile (see ce_algs.profiler)
+PROFILED = ['uct_iterative', 'uct_amaf', 'uct_iterative_priority', 'uct_iterative_priority_envy',
+            'uct_iterative_priority_popularity', 'uct_iterative_priority_random', 'uct_batch', 'uct_batch_envy',
+            'uct_batch_popularity', 'uct_batch_random']
+# instances of every experiment, keyed by their hash (see utils.save_instance)
+INSTANCE_CACHE = 'log/instances'
+# The 'legacy' instance generators reproduce the instances of a seed exactly as they were first published, as lists.
+# The 'vectorized' ones return NumPy arrays in compact dtypes and draw from the same distribution; the synthetic one
+# even draws the same instance, while the real-data one samples the applications differently.
+GENERATORS = ['vectorized', 'legacy']
+# The 'truncated' real-data generator draws the 'vectorized' instance, but ends every student's list with the dummy
+# college, which has a seat for every student and so never rejects anyone, and keeps every college's list only for
+# its applicants. The lists are returned as CSR pairs (offsets, indices), the matching is the same.
+REAL_DATA_GENERATORS = GENERATORS + ['truncated']
 
-def make_synthetic_instance(num_students, num_colleges, budget, correlation, with_college_wise_budget, rng):
+
+def make_synthetic_instance(num_students, num_colleges, budget, correlation, with_college_wise_budget, rng,
+                            generator='vectorized', chunk_size=None):
+    # chunk_size bounds the number of random scores the vectorized generator draws at once (see _argsort_rows)
+    if generator not in GENERATORS:
+        raise ValueError('unknown generator: {}'.format(generator))
+    if generator == 'vectorized':
+        common_scores = correlation * rng.random(num_colleges)
+        student_prefs = _argsort_rows(
+            lambda start, stop: common_scores + (1 - correlation) * rng.random((stop - start, num_colleges)),
+            num_students, num_colleges, chunk_size)
+        college_prefs = _permutations(num_colleges, num_students, rng)
+        college_capacities = rng.multinomial(num_students - num_colleges, np.ones(num_colleges) / num_colleges) + 1
+        college_budgets = _make_college_budgets(num_colleges, budget, with_college_wise_budget, rng)
+        return student_prefs, college_prefs, college_capacities, college_budgets
     common_scores = rng.random(num_colleges)
     student_scores = rng.random((num_students, num_colleges))
     mixed_scores = correlation * common_scores + (1 - correlation) * student_scores
@@ -22,6 +63,36 @@ def make_synthetic_instance(num_students, num_colleges, budget, correlation, wit
     return student_prefs, college_prefs, college_capacities, college_budgets
 
 
+def _make_college_budgets(num_colleges, budget, with_college_wise_budget, rng):
+    if not with_college_wise_budget:
+        return np.full(num_colleges, budget)
+    while True:
+        college_budgets = rng.multinomial(rng.randint(budget, budget * num_colleges),
+                                          np.ones(num_colleges) / num_colleges) + 1
+        if (college_budgets < budget).all():
+            return college_budgets
+
+
+def _argsort_rows(draw_rows, num_rows, num_cols, chunk_size=None):
+    # Row-wise stable argsort of the (num_rows, num_cols) score matrix whose rows start, ..., stop - 1
+    # draw_rows(start, stop) returns. The rows are drawn in order, so the result does not depend on chunk_size, which
+    # only bounds the number of scores held at once; it is kept in the smallest integer dtype that holds it.
+    rows_per_chunk = num_rows if chunk_size is None else max(1, chunk_size // num_cols)
+    order = np.empty((num_rows, num_cols), dtype=compact_dtype(num_cols - 1))
+    for start in range(0, num_rows, rows_per_chunk):
+        stop = min(start + rows_per_chunk, num_rows)
+        order[start:stop] = np.argsort(draw_rows(start, stop), axis=1, kind='stable')
+    return order
+
+
+def _permutations(num_rows, n, rng):
+    # one uniformly random permutation of range(n) per row, drawn from rng as the legacy generators draw them
+    permutations = np.empty((num_rows, n), dtype=compact_dtype(n - 1))
+    for j in range(num_rows):
+        permutations[j] = rng.permutation(n)
+    return permutations
+
+
 def make_real_data_student_preferences(apply_cluster, regional_cap, rng):
     # make student's preferences
     student_apply = {}  # key: [0,...,regional_cap-1], value: list of colleges applied by student i
@@ -54,38 +125,185 @@ def make_real_data_student_preferences(apply_cluster, regional_cap, rng):
     return student_preference.astype(int).tolist()
 
 
-def make_real_data_instance(rng):
+def _sample_real_data_applicants(apply_cluster, regional_cap, rng):
+    # Same distribution as make_real_data_student_preferences. Its rejection sampling draws the applicants of every
+    # college uniformly without replacement among the students with fewer than 8 applications, and colleges are
+    # served in order, so a student's applications are in increasing order.
+    applicants = []
+    num_applications = np.zeros(regional_cap, dtype=int)
+    for j in range(len(apply_cluster)):
+        applicants.append(rng.choice(np.flatnonzero(num_applications < 8), int(apply_cluster[j]), replace=False))
+        num_applications[applicants[j]] += 1
+    return applicants
+
+
+def _make_real_data_student_preference_array(apply_cluster, regional_cap, rng, chunk_size=None):
+    # the applications are followed by the dummy college K and then by the other colleges, also in increasing order,
+    # which a stable sort of these keys reproduces
+    K = len(apply_cluster)
+    keys = np.full((regional_cap, K + 1), 2, dtype=np.int8)
+    keys[:, K] = 1
+    for j, applicants in enumerate(_sample_real_data_applicants(apply_cluster, regional_cap, rng)):
+        keys[applicants, j] = 0
+    return _argsort_rows(lambda start, stop: keys[start:stop], regional_cap, K + 1, chunk_size)
+
+
+def _make_truncated_real_data_prefs(apply_cluster, num_students, rng):
+    # CSR pairs of the applications of every student followed by the dummy college K, and of the applicants of every
+    # college in the order of its priorities, drawn as the vectorized generator draws them
+    K = len(apply_cluster)
+    applicants = _sample_real_data_applicants(apply_cluster, num_students, rng) + [np.arange(num_students)]
+    students = np.concatenate(applicants)
+    colleges = np.repeat(np.arange(K + 1), [len(students_j) for students_j in applicants])
+    student_offsets = np.zeros(num_students + 1, dtype=int)
+    student_offsets[1:] = np.cumsum(np.bincount(students, minlength=num_students))
+    student_prefs = colleges[np.lexsort((colleges, students))].astype(compact_dtype(K))
+    college_offsets = np.zeros(K + 2, dtype=int)
+    college_offsets[1:] = np.cumsum([len(students_j) for students_j in applicants])
+    college_prefs = np.empty(len(students), dtype=compact_dtype(num_students - 1))
+    applied = np.zeros(num_students, dtype=bool)
+    for j in range(K + 1):
+        permutation = rng.permutation(num_students)
+        applied[:] = False
+        applied[applicants[j]] = True
+        college_prefs[college_offsets[j]:college_offsets[j + 1]] = permutation[applied[permutation]]
+    return (student_offsets, student_prefs), (college_offsets, college_prefs)
+
+
+def make_real_data_instance(rng, generator='vectorized', chunk_size=None):
+    if generator not in REAL_DATA_GENERATORS:
+        raise ValueError('unknown generator: {}'.format(generator))
     with open('./data/tokyo.pkl', 'rb') as f:
         data = pickle.load(f)
         college_capacities = data[0].tolist()
         college_budgets = data[1].astype(int).tolist()
         apply_cluster = data[2]
+    if generator == 'truncated':
+        student_prefs, college_prefs = _make_truncated_real_data_prefs(apply_cluster, np.sum(college_capacities) // 2,
+                                                                       rng)
+        return student_prefs, college_prefs, np.array(college_capacities), np.array(college_budgets)
+    if generator == 'vectorized':
+        num_students = np.sum(college_capacities) // 2
+        student_prefs = _make_real_data_student_preference_array(apply_cluster, num_students, rng, chunk_size)
+        college_prefs = _permutations(len(college_capacities), num_students, rng)
+        return student_prefs, college_prefs, np.array(college_capacities), np.array(college_budgets)
     student_prefs = make_real_data_student_preferences(apply_cluster, np.sum(college_capacities) // 2, rng)
     college_prefs = [rng.permutation(np.arange(len(student_prefs))).tolist() for _ in range(len(college_capacities))]
     return student_prefs, college_prefs, college_capacities, college_budgets
 
 
-def run_algs(student_prefs, college_prefs, college_capacities, budget, college_budgets, original_cost, algs, save_path):
+def load_or_make_instance(save_path, load_seed, make_instance, generator='vectorized'):
+    # Returns the seed of a trial, the generator and hash of its instance and the instance as utils.load_instance
+    # returns it. The instance is made by make_instance(rng, generator) from the seed, saved or new, and stored in the
+    # instance cache; with load_seed, the instance setting.json refers to is loaded from the cache instead while it is
+    # still there, and otherwise remade with the generator it was made with (settings that do not record one were
+    # made by the legacy generator).
+    seed = utils.get_seed(save_path, load_seed)
+    if load_seed and utils.get_setting(save_path, 'seed') is not None:
+        generator = utils.get_setting(save_path, 'generator') or 'legacy'
+        key = utils.get_setting(save_path, 'instance')
+        instance = utils.load_instance(INSTANCE_CACHE, key)
+        if instance is not None:
+            return seed, generator, key, instance
+    student_prefs, college_prefs, college_capacities, college_budgets = \
+        make_instance(np.random.RandomState(seed), generator)
+    key = utils.save_instance(INSTANCE_CACHE, student_prefs, college_prefs, college_capacities, college_budgets)
+    return seed, generator, key, utils.load_instance(INSTANCE_CACHE, key)
+
+
+def run_algs(student_prefs, college_prefs, college_capacities, budget, college_budgets, original_cost, algs, save_path,
+             gurobi_threads=1, da_arrays=None, sweep=False, profile=False):
     best_cost_by_heuristics = np.inf
     best_solution_by_heuristics = None
     # run each algorithm
     for i in range(len(algs)):
-        log = None
-        if algs[i].__name__ in ['iqp', 'agg_lin', 'non_agg_lin']:
-            result = algs[i](student_prefs, college_prefs, college_capacities, budget, college_budgets, best_solution_by_heuristics)
-        else:
-            results = algs[i](student_prefs, college_prefs, college_capacities, budget, college_budgets)
-            if not isinstance(results, dict):
-                result = results[0]
-                log = results[1]
-            else:
-                result = results
-            if best_cost_by_heuristics > result['best_cost'] and algs[i].__name__ in ['greedy', 'lp_heuristic']:
-                best_solution_by_heuristics = result['expanded_capacities']
-                best_cost_by_heuristics = result['best_cost']
-        result['improvement_rate'] = (original_cost - result['best_cost']) / original_cost
-        print('Allocated capacities are {}'.format(np.array(result['expanded_capacities']) - np.array(college_capacities)))
-        print('Expanded capacities are {}, new cost is {}, improvement rate is {}'
-              .format(result['expanded_capacities'], result['best_cost'], result['improvement_rate']))
-        # save result
-        utils.save_result('{}/{}'.format(save_path, algs[i].__name__), result, log)
+        result = run_alg(algs[i], student_prefs, college_prefs, college_capacities, budget, college_budgets,
+                         original_cost, best_solution_by_heuristics, save_path, gurobi_threads, da_arrays, sweep,
+                         profile)
+        if best_cost_by_heuristics > result['best_cost'] and algs[i].__name__ in HEURISTICS:
+            best_solution_by_heuristics = result['expanded_capacities']
+            best_cost_by_heuristics = result['best_cost']
+
+
+def run_alg(alg, student_prefs, college_prefs, college_capacities, budget, college_budgets, original_cost,
+            start_capacities, save_path, gurobi_threads=1, da_arrays=None, sweep=False, profile=False):
+    log = None
+    kwargs = {'threads': gurobi_threads} if alg.__name__ in GUROBI else {}
+    if da_arrays is not None:
+        kwargs['da_arrays'] = da_arrays
+    if sweep and alg.__name__ in SWEEPS:
+        kwargs['sweep'] = True
+    if profile and alg.__name__ in PROFILED:
+        kwargs['profile'] = True
+    if alg.__name__ in WARM_STARTED:
+        results = alg(student_prefs, college_prefs, college_capacities, budget, college_budgets, start_capacities,
+                      **kwargs)
+    else:
+        results = alg(student_prefs, college_prefs, college_capacities, budget, college_budgets, **kwargs)
+    if not isinstance(results, dict):
+        result = results[0]
+        log = results[1]
+    else:
+        result = results
+    result['improvement_rate'] = (original_cost - result['best_cost']) / original_cost
+    print('Allocated capacities are {}'.format(np.array(result['expanded_capacities']) - np.array(college_capacities)))
+    print('Expanded capacities are {}, new cost is {}, improvement rate is {}'
+          .format(result['expanded_capacities'], result['best_cost'], result['improvement_rate']))
+    # save result
+    utils.save_result('{}/{}'.format(save_path, alg.__name__), result, log)
+    return result
+
+
+def run_trials(trials, algs, jobs=1, gurobi_threads=1, sweep=False, profile=False):
+    # Runs every algorithm on every trial, given as (student_prefs, college_prefs, college_capacities, budget,
+    # college_budgets, original_cost, save_path, da_arrays). With jobs > 1 the (trial, algorithm) pairs run on a
+    # process pool that keeps at most `jobs` cores busy, a Gurobi algorithm counting for gurobi_threads of them. As in
+    # run_algs, the warm-started algorithms start from the best solution of the heuristics listed before them, so
+    # they wait until those have finished on the same trial. With sweep, the algorithms in SWEEPS also return the cost
+    # of every budget up to that of the trial, and with profile, the algorithms in PROFILED also return the time of
+    # every phase of their search.
+    if jobs == 1:
+        for trial in trials:
+            run_algs(*trial[:6], algs, trial[6], gurobi_threads, trial[7], sweep, profile)
+        return
+    pending = [(n, i) for n in range(len(trials)) for i in range(len(algs))]
+    heuristic_results = [{} for _ in trials]
+    running = {}
+    free_cores = jobs
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            for n, i in list(pending):
+                cores = min(gurobi_threads + (algs[i].__name__ in HYBRID) if algs[i].__name__ in GUROBI else 1, jobs)
+                if cores > free_cores or not _warm_start_ready(algs, i, heuristic_results[n]):
+                    continue
+                start_capacities = None
+                if algs[i].__name__ in WARM_STARTED:
+                    start_capacities = _best_heuristic_solution(heuristic_results[n], i)
+                future = executor.submit(run_alg, algs[i], *trials[n][:6], start_capacities, trials[n][6],
+                                         gurobi_threads, trials[n][7], sweep, profile)
+                running[future] = (n, i, cores)
+                pending.remove((n, i))
+                free_cores -= cores
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                n, i, cores = running.pop(future)
+                free_cores += cores
+                result = future.result()
+                if algs[i].__name__ in HEURISTICS:
+                    heuristic_results[n][i] = result
+
+
+def _warm_start_ready(algs, i, heuristic_results):
+    if algs[i].__name__ not in WARM_STARTED:
+        return True
+    return all(j in heuristic_results for j in range(i) if algs[j].__name__ in HEURISTICS)
+
+
+def _best_heuristic_solution(heuristic_results, i):
+    best_cost_by_heuristics = np.inf
+    best_solution_by_heuristics = None
+    for j in sorted(heuristic_results):
+        if j < i and best_cost_by_heuristics > heuristic_results[j]['best_cost']:
+            best_solution_by_heuristics = heuristic_results[j]['expanded_capacities']
+            best_cost_by_heuristics = heuristic_results[j]['best_cost']
+    return best_solution_by_heuristics
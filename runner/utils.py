@@ -1,7 +1,19 @@
+import hashlib
 import json
 import numpy as np
 import os
 import pandas as pd
+import shutil
+
+from ca_algs.deferred_acceptance import DeferredAcceptance, TruncatedDeferredAcceptance, lists_from_csr
+from ca_algs.shared_da import compact_dtype
+
+# arrays of a cached instance: its definition, then the DeferredAcceptance arrays derived from the preferences. The
+# preferences of an instance with truncated lists are CSR pairs, stored as their offsets and indices, and the arrays
+# derived from them are those of TruncatedDeferredAcceptance.
+INSTANCE_ARRAYS = ['student_prefs', 'college_prefs', 'college_capacities', 'college_budgets']
+DERIVED_ARRAYS = ['s_costs', 'c_scores']
+TRUNCATED_INSTANCE_ARRAYS = ['student_offsets', 'college_offsets'] + INSTANCE_ARRAYS
 
 
 def get_seed(save_path, load_seed):
@@ -13,19 +25,107 @@ def get_seed(save_path, load_seed):
         return np.random.randint(0, 2 ** 32)
 
 
+def get_setting(save_path, key):
+    if not os.path.exists('{}/setting.json'.format(save_path)):
+        return None
+    with open('{}/setting.json'.format(save_path), mode='rt') as f:
+        return json.load(f).get(key)
+
+
 def save_setting(save_path, **params):
-    if not os.path.isdir(save_path):
-        os.makedirs(save_path)
-    with open('{}/setting.json'.format(save_path), mode='wt') as f:
-        json.dump(params, f)
+    os.makedirs(save_path, exist_ok=True)
+    _write_atomically('{}/setting.json'.format(save_path), lambda f: json.dump(params, f))
 
 
 def save_result(save_path, result, log=None):
-    if not os.path.isdir(save_path):
-        os.makedirs(save_path)
-    with open('{}/result.json'.format(save_path), mode='wt') as f:
-        json.dump(result, f)
+    os.makedirs(save_path, exist_ok=True)
+    _write_atomically('{}/result.json'.format(save_path), lambda f: json.dump(result, f))
     if log is not None:
         df = pd.DataFrame(log)
         df.index.name = '#index'
-        df.to_csv('{}/results.csv'.format(save_path))
\ No newline at end of file
+        _write_atomically('{}/results.csv'.format(save_path), df.to_csv)
+
+
+def instance_hash(student_prefs, college_prefs, college_capacities, college_budgets):
+    digest = hashlib.sha256()
+    for values in [student_prefs, college_prefs, college_capacities, college_budgets]:
+        for array in (values if isinstance(values, tuple) else [values]):
+            array = np.asarray(array, dtype=np.int64)
+            digest.update(str(array.shape).encode())
+            digest.update(array.tobytes())
+    return digest.hexdigest()[:16]
+
+
+def save_instance(cache_path, student_prefs, college_prefs, college_capacities, college_budgets, da=None):
+    # Stores an instance under cache_path/<instance hash>/ as one .npy file per array, each in the smallest integer
+    # dtype that holds it, together with the DeferredAcceptance arrays of `da` (computed if not given), and returns
+    # the hash. The files are written into a temporary directory that is renamed into place.
+    key = instance_hash(student_prefs, college_prefs, college_capacities, college_budgets)
+    path = '{}/{}'.format(cache_path, key)
+    if os.path.isdir(path):
+        return key
+    truncated = isinstance(student_prefs, tuple)
+    if da is None:
+        da = (TruncatedDeferredAcceptance if truncated else DeferredAcceptance)(student_prefs, college_prefs)
+    if truncated:
+        (student_offsets, student_prefs), (college_offsets, college_prefs) = student_prefs, college_prefs
+        arrays = dict(zip(TRUNCATED_INSTANCE_ARRAYS, [student_offsets, college_offsets, student_prefs, college_prefs,
+                                                      college_capacities, college_budgets]))
+        arrays.update((name, getattr(da, name)) for name in TruncatedDeferredAcceptance.ARRAYS)
+    else:
+        arrays = dict(zip(INSTANCE_ARRAYS, [student_prefs, college_prefs, college_capacities, college_budgets]))
+        arrays.update((name, getattr(da, name)) for name in DERIVED_ARRAYS)
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    os.makedirs(tmp_path, exist_ok=True)
+    try:
+        for name, values in arrays.items():
+            array = np.asarray(values)
+            np.save('{}/{}.npy'.format(tmp_path, name),
+                    array.astype(compact_dtype(int(array.max()) if array.size > 0 else 0)))
+        os.rename(tmp_path, path)
+    except OSError:
+        # another process stored the same instance first
+        if not os.path.isdir(path):
+            raise
+    finally:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return key
+
+
+def load_instance(cache_path, key):
+    # Returns the arrays save_instance stored under `key`, memory-mapped read-only, or None if there are none. The
+    # DeferredAcceptance arrays are returned as da_arrays, the (s_rank, s_costs, c_scores) that
+    # DeferredAcceptance.from_arrays and the algorithms' da_arrays argument take, and truncated preferences as CSR
+    # pairs together with the arrays TruncatedDeferredAcceptance.from_arrays takes.
+    path = '{}/{}'.format(cache_path, key)
+    if key is None or not os.path.isdir(path):
+        return None
+    if os.path.exists('{}/student_offsets.npy'.format(path)):
+        names = TRUNCATED_INSTANCE_ARRAYS + TruncatedDeferredAcceptance.ARRAYS
+        arrays = {name: np.load('{}/{}.npy'.format(path, name), mmap_mode='r') for name in names}
+        arrays['da_arrays'] = tuple(arrays.pop(name) for name in TruncatedDeferredAcceptance.ARRAYS)
+        arrays['student_prefs'] = (arrays.pop('student_offsets'), arrays['student_prefs'])
+        arrays['college_prefs'] = (arrays.pop('college_offsets'), arrays['college_prefs'])
+        return arrays
+    arrays = {name: np.load('{}/{}.npy'.format(path, name), mmap_mode='r') for name in INSTANCE_ARRAYS + DERIVED_ARRAYS}
+    arrays['da_arrays'] = (arrays['student_prefs'], arrays.pop('s_costs'), arrays.pop('c_scores'))
+    return arrays
+
+
+def preference_lists(instance):
+    # the student and college preferences of a loaded instance as the lists the algorithms take
+    return tuple(lists_from_csr(*prefs) if isinstance(prefs, tuple) else prefs.tolist()
+                 for prefs in [instance['student_prefs'], instance['college_prefs']])
+
+
+def _write_atomically(path, write):
+    # write into a temporary file next to `path` and rename it into place, so that a file is either complete or
+    # missing even if several processes write results at once or one of them is interrupted
+    tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+    try:
+        with open(tmp_path, mode='wt') as f:
+            write(f)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)